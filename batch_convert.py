@@ -0,0 +1,422 @@
+import argparse
+import functools
+import glob
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from conversion_cache import atomic_write, default_cache_dir
+from glsl_cost import estimate_cost
+from glsl_loops import unbounded_loops
+from glsl_precision import infer_precision
+from glsl_specialize import Variant, specialize, variant_manifest
+from glsl_uniform_block import cpp_uniform_struct, uniform_block_members
+from juce_bundle import build_bundle
+from shadertoy_to_opengl import (DEFAULT_OPTIONS, OPTION_LABELS, ConversionProfile,
+                                 IncrementalConverter, open_conversion_cache, resolve_options)
+
+
+# Files picked up when a directory is given
+SHADER_PATTERNS = ('*.glsl', '*.frag', '*.fs', '*.shadertoy')
+DEFAULT_SUFFIX = '.opengl.glsl'
+
+_VARIANT_NAME_RE = re.compile(r'[\w.-]+\Z')
+
+_worker_cache = None
+# Kept for the life of the process, so a shader converted again after an
+# edit only converts the units that changed
+_worker_converter = None
+_worker_profiles = False
+_worker_options = {}
+_worker_variants = {}
+
+
+def output_path(path, root=None, output_dir=None, suffix=DEFAULT_SUFFIX):
+    """Where the output of the input at path goes: next to it with suffix
+    replacing the extension, or with output_dir at its place under root
+    in that tree (at its top when root is None)"""
+    stem = os.path.splitext(path)[0]
+    if output_dir is None:
+        return stem + suffix
+    relative = os.path.relpath(stem, root) if root else os.path.basename(stem)
+    return os.path.join(output_dir, relative + suffix)
+
+
+def is_output(path, suffix=DEFAULT_SUFFIX):
+    """Whether path is named like an output: it carries the suffix, or is
+    a specialized variant of a file that does"""
+    return (path.endswith(suffix)
+            or os.path.splitext(suffix)[0] + '.' in os.path.basename(path))
+
+
+def collect_jobs(inputs, output_dir=None, suffix=DEFAULT_SUFFIX, skip_output_names=None):
+    """(source, destination) pairs for files, directories and glob patterns
+
+    Outputs go next to their input with suffix replacing the extension,
+    or, with output_dir, into a tree that mirrors the input directories.
+    Files this run writes to are skipped, as are earlier outputs: files
+    that would be written next to one of the inputs, and any file named
+    like an output if skip_output_names is set, which it is by default
+    when outputs go next to their inputs.
+    Raises ValueError when two inputs, or an input and its own output,
+    would share a file.
+    """
+    found = []
+    seen = set()
+
+    def add(path, root):
+        path = os.path.normpath(path)
+        if path not in seen:
+            seen.add(path)
+            found.append((path, output_path(path, root, output_dir, suffix)))
+
+    for item in inputs:
+        if os.path.isdir(item):
+            paths = []
+            for pattern in SHADER_PATTERNS:
+                paths.extend(glob.glob(os.path.join(item, '**', pattern), recursive=True))
+            for path in sorted(paths):
+                add(path, item)
+        elif os.path.isfile(item):
+            add(item, None)
+        else:
+            matches = sorted(path for path in glob.glob(item, recursive=True)
+                             if os.path.isfile(path))
+            if not matches:
+                raise FileNotFoundError(f'no shaders match {item!r}')
+            for path in matches:
+                add(path, None)
+
+    destinations = {os.path.normpath(destination) for _, destination in found}
+    # What a run without output_dir would write, by the input it comes from
+    beside = {os.path.normpath(output_path(path, suffix=suffix)): path for path, _ in found}
+    if skip_output_names is None:
+        skip_output_names = output_dir is None
+    jobs = []
+    sources = {}  # destination -> source writing it
+    for path, destination in found:
+        target = os.path.normpath(destination)
+        if target == path:
+            raise ValueError(f'{path}: the output would overwrite the input; '
+                             f'use another suffix or an output directory')
+        if (path in destinations or beside.get(path, path) != path
+                or (skip_output_names and is_output(path, suffix))):
+            continue
+        if target in sources:
+            raise ValueError(f'{sources[target]} and {path} would both be written to '
+                             f'{destination}')
+        sources[target] = path
+        jobs.append((path, destination))
+    return jobs
+
+
+def load_variants(path):
+    """Variant name -> values from a JSON file, checking the names can be
+    used in file names"""
+    with open(path, encoding='utf-8') as f:
+        variants = json.load(f)
+    if not isinstance(variants, dict) or not all(isinstance(values, dict)
+                                                 for values in variants.values()):
+        raise ValueError(f'{path}: expected an object of variant name -> values')
+    for name in variants:
+        if not _VARIANT_NAME_RE.match(name):
+            raise ValueError(f'{path}: variant name {name!r} cannot be used in a file name')
+    return variants
+
+
+def _init_worker(cache_dir, profiles=False, options=None, variants=None):
+    global _worker_cache, _worker_converter, _worker_profiles, _worker_options, _worker_variants
+    if _worker_converter is None:
+        _worker_converter = IncrementalConverter()
+    _worker_cache = open_conversion_cache(cache_dir) if cache_dir else None
+    _worker_profiles = profiles
+    _worker_options = resolve_options(options)
+    _worker_variants = variants or {}
+
+
+def _write_output(destination, output):
+    atomic_write(destination, output.encode('utf-8'))
+    if _worker_options['uniform_block'] and uniform_block_members(output) is not None:
+        atomic_write(os.path.splitext(destination)[0] + '.h',
+                     cpp_uniform_struct(output).encode('utf-8'))
+
+
+def _write_variants(destination, output):
+    root, ext = os.path.splitext(destination)
+    variants = []
+    files = {}
+    for name, values in _worker_variants.items():
+        variant = Variant(name, values, specialize(output, values))
+        path = f'{root}.{name}{ext}'
+        _write_output(path, variant.code)
+        # Relative to the manifest, which sits beside the variants
+        files[name] = os.path.basename(path)
+        variants.append(variant)
+    manifest = variant_manifest(variants, files)
+    atomic_write(root + '.variants.json', (json.dumps(manifest, indent=2) + '\n').encode('utf-8'))
+
+
+def convert_file(job):
+    """Convert one (source, destination) job
+
+    Returns (source, bytes in, bytes out, error, profile, cost), where
+    profile is a ConversionProfile.as_dict() when profiles were requested
+    and the shader was converted rather than found in the cache, and cost
+    the CostReport.as_dict() of the output when profiles were requested,
+    with the loops whose bound is not proven under 'unbounded_loops' and,
+    with precision qualifiers on, the ambiguous values under
+    'precision_diagnostics'.  When the report itself fails, cost is
+    {'error': message} and the shader still counts as converted.
+    Outputs with a uniform block get the matching C++ struct in a .h file
+    beside them.  With variants, each is also written specialized as
+    name.<variant>.ext, listed in name.variants.json.
+    """
+    source, destination = job
+    profile = ConversionProfile() if _worker_profiles else None
+    convert = functools.partial(_worker_converter.convert, profile=profile)
+    try:
+        with open(source, encoding='utf-8', newline='') as f:
+            shader_code = f.read()
+        if _worker_cache is not None:
+            hits = _worker_cache.hits
+            output = _worker_cache.convert(shader_code, convert, **_worker_options)
+            if _worker_cache.hits > hits:
+                profile = None
+        else:
+            output = convert(shader_code, **_worker_options)
+        data = output.encode('utf-8')
+        _write_output(destination, output)
+        if _worker_variants:
+            _write_variants(destination, output)
+    except Exception as e:
+        return source, 0, 0, f'{type(e).__name__}: {e}', None, None
+    cost = None
+    if _worker_profiles:
+        # The output is written by now: a failing report must not fail it
+        try:
+            cost = estimate_cost(output).as_dict()
+            cost['unbounded_loops'] = [loop.as_dict() for loop in unbounded_loops(output)]
+            if _worker_options['precision_qualifiers']:
+                cost['precision_diagnostics'] = [
+                    diagnostic.as_dict() for diagnostic in infer_precision(output).diagnostics]
+        except Exception as e:
+            cost = {'error': f'{type(e).__name__}: {e}'}
+    return (source, len(shader_code.encode('utf-8')), len(data), None,
+            profile.as_dict() if profile is not None else None, cost)
+
+
+def run_batch(jobs, workers=None, cache_dir=None, profiles=False, options=None, variants=None):
+    """Convert every job, continuing past failures; yields convert_file results
+
+    variants maps variant names to the values each is specialized for.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(jobs) <= 1:
+        _init_worker(cache_dir, profiles, options, variants)
+        yield from map(convert_file, jobs)
+        return
+    # Hand out work in chunks so small shaders do not drown in IPC overhead
+    chunksize = max(1, len(jobs) // (workers * 8))
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(cache_dir, profiles, options, variants)) as pool:
+        yield from pool.map(convert_file, jobs, chunksize=chunksize)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='shadertoy_to_opengl',
+        description='Convert Shadertoy shaders to OpenGL/JUCE fragment shaders.')
+    parser.add_argument('inputs', nargs='+',
+                        help='shader files, directories (searched recursively) or glob patterns')
+    parser.add_argument('-o', '--output-dir',
+                        help='write outputs into this tree instead of next to the inputs')
+    parser.add_argument('-s', '--suffix', default=DEFAULT_SUFFIX,
+                        help=f'replaces the input extension (default: {DEFAULT_SUFFIX})')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--cache-dir', default=default_cache_dir(),
+                        help='conversion cache directory (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always convert, without reading or writing the cache')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='only print errors and the summary')
+    parser.add_argument('--json', action='store_true',
+                        help='print per-file and per-stage statistics and estimated '
+                             'costs as JSON instead')
+    parser.add_argument('--specialize', metavar='CONFIG.json',
+                        help='also write a variant of each output per entry of this JSON '
+                             'object of name -> {uniform or macro: value}')
+    parser.add_argument('--export-jsonl', metavar='OUT.jsonl',
+                        help='read the inputs as Shadertoy JSON exports and write the '
+                             'converted Image pass of each shader to OUT.jsonl as a stream')
+    parser.add_argument('--resume', action='store_true',
+                        help='with --export-jsonl, continue from the checkpoint an '
+                             'interrupted run left')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and convert inputs again whenever they change')
+    parser.add_argument('--poll', action='store_true',
+                        help='with --watch, scan for changes instead of using inotify')
+    parser.add_argument('--bundle', metavar='PATH',
+                        help='write every output into one C++ source file pair, PATH.h and '
+                             'PATH.cpp, instead of separate files')
+    parser.add_argument('--bundle-namespace', metavar='NAME',
+                        help='C++ namespace of the bundle (default: the file name of PATH)')
+    for name, default in DEFAULT_OPTIONS.items():
+        flag = name.replace('_', '-')
+        parser.add_argument(f'--no-{flag}' if default else f'--{flag}', dest=name,
+                            action='store_false' if default else 'store_true',
+                            help=f'{"skip" if default else "enable"}: {OPTION_LABELS[name]}')
+    args = parser.parse_args(argv)
+    options = {name: getattr(args, name) for name in DEFAULT_OPTIONS}
+
+    if args.bundle and args.specialize:
+        parser.error('--bundle cannot be combined with --specialize')
+    if args.watch and (args.bundle or args.json):
+        parser.error('--watch cannot be combined with --bundle or --json')
+    if args.export_jsonl:
+        if args.bundle or args.watch or args.specialize:
+            parser.error('--export-jsonl cannot be combined with --bundle, --watch '
+                         'or --specialize')
+        return _export_main(args, options)
+    try:
+        # Bundled shaders are named by their path in the input tree, which
+        # is where a relative output tree would put them
+        if args.bundle:
+            jobs = collect_jobs(args.inputs, os.curdir, args.suffix, skip_output_names=True)
+        else:
+            jobs = collect_jobs(args.inputs, args.output_dir, args.suffix)
+    except (FileNotFoundError, ValueError) as e:
+        parser.error(str(e))
+    if args.bundle:
+        return _bundle_main(args, jobs, options)
+    variants = None
+    if args.specialize:
+        try:
+            variants = load_variants(args.specialize)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+    if args.watch:
+        return _watch_main(args, options, variants)
+
+    started = time.perf_counter()
+    failed = 0
+    total_in = 0
+    files = []
+    stages = {}
+    for source, size_in, size_out, error, profile, cost in run_batch(
+            jobs, args.jobs, None if args.no_cache else args.cache_dir, args.json, options,
+            variants):
+        if args.json:
+            files.append({'source': source, 'bytes_in': size_in, 'bytes_out': size_out,
+                          'error': error, 'cached': error is None and profile is None,
+                          'profile': profile, 'cost': cost})
+            for name, stats in (profile or {}).get('stages', {}).items():
+                totals = stages.setdefault(name, dict.fromkeys(stats, 0))
+                for key, value in stats.items():
+                    totals[key] += value
+        if error is not None:
+            failed += 1
+            print(f'{source}: {error}', file=sys.stderr)
+            continue
+        total_in += size_in
+        if not args.quiet and not args.json:
+            print(source)
+    elapsed = max(time.perf_counter() - started, 1e-9)
+
+    converted = len(jobs) - failed
+    if args.json:
+        json.dump({'converted': converted, 'failed': failed, 'seconds': elapsed,
+                   'shaders_per_second': converted / elapsed,
+                   'mb_per_second': total_in / elapsed / 1e6,
+                   'stages': stages, 'files': files}, sys.stdout, indent=2)
+        print()
+    else:
+        print(f'Converted {converted} of {len(jobs)} shaders ({failed} failed) in '
+              f'{elapsed:.2f}s: {converted / elapsed:.1f} shaders/s, '
+              f'{total_in / elapsed / 1e6:.2f} MB/s')
+    return 1 if failed else 0
+
+
+def _export_main(args, options):
+    from shadertoy_export import convert_exports
+
+    def report(record):
+        if record['status'] == 'failed':
+            print(f'{record["id"]}: {record["error"]}', file=sys.stderr)
+        elif not args.quiet and not args.json:
+            print(f'{record["id"]}: {record["status"]}')
+
+    try:
+        summary = convert_exports(args.inputs, args.export_jsonl, options, args.jobs,
+                                  args.resume, report)
+    except (OSError, ValueError) as e:
+        print(f'{args.export_jsonl}: {e}', file=sys.stderr)
+        return 1
+    if args.json:
+        json.dump(summary.as_dict(), sys.stdout, indent=2)
+        print()
+    else:
+        print(summary.summary())
+    return 1 if summary.failed else 0
+
+
+def _watch_main(args, options, variants):
+    from shader_watch import ShaderWatch
+
+    def report(results, started):
+        for source, _, _, error, _, _ in results:
+            if error is not None:
+                print(f'{source}: {error}', file=sys.stderr)
+            elif not args.quiet:
+                print(f'{source} ({(time.perf_counter() - started) * 1000:.0f} ms)')
+
+    try:
+        watch = ShaderWatch(args.inputs, args.output_dir, args.suffix,
+                            None if args.no_cache else args.cache_dir, options, variants,
+                            args.poll)
+    except OSError as e:
+        print(f'cannot watch the inputs: {e}', file=sys.stderr)
+        return 1
+    try:
+        report(watch.start(args.jobs), time.perf_counter())
+        print(f'Watching for changes ({"polling" if watch.polling else "inotify"}); '
+              f'press Ctrl+C to stop')
+        while True:
+            paths = watch.wait()
+            report(watch.update(paths), time.perf_counter())
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        watch.close()
+
+
+def _bundle_main(args, jobs, options):
+    shaders = []
+    for source, destination in jobs:
+        name = os.path.relpath(destination[:len(destination) - len(args.suffix)], os.curdir)
+        shaders.append((name.replace(os.sep, '/'), source))
+    started = time.perf_counter()
+    try:
+        report = build_bundle(shaders, args.bundle, args.bundle_namespace, options, args.jobs)
+    except (OSError, ValueError) as e:
+        print(f'{args.bundle}: {e}', file=sys.stderr)
+        return 1
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    for source, error in report.errors:
+        print(f'{source}: {error}', file=sys.stderr)
+    if args.json:
+        json.dump(dict(report.as_dict(), seconds=elapsed), sys.stdout, indent=2)
+        print()
+    else:
+        if not args.quiet:
+            for name in report.converted:
+                print(name)
+        print(f'{report.summary()} in {elapsed:.2f}s')
+    return 1 if report.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,55 @@
+// Lots of float declarations, most without initializers
+float accumulate(float x)
+{
+    float a, b, c, d;
+    float sum;
+    float weight;
+    a = x * 0.5;
+    b = a + 1.0;
+    for (int i = 0; i < 16; i++) {
+        sum += a * float(i);
+        weight += 1.0;
+    }
+    c = sum / max(weight, 1.0);
+    d = c * b;
+    return d;
+}
+
+float blend(float t)
+{
+    float lo;
+    float hi;
+    float k;
+    if (t > 0.5) {
+        lo = 0.25;
+    }
+    hi = lo + 0.5;
+    k += t * t;
+    return mix(lo, hi, k);
+}
+
+float wave(vec2 p)
+{
+    float phase, amplitude, frequency, total;
+    amplitude = 0.5;
+    frequency = 1.0;
+    for (int octave = 0; octave < 5; octave++) {
+        total += amplitude * sin(p.x * frequency + phase);
+        phase += 1.7;
+        amplitude *= 0.5;
+        frequency *= 2.0;
+    }
+    return total;
+}
+
+void mainImage(out vec4 fragColor, in vec2 fragCoord)
+{
+    vec2 uv = fragCoord / iResolution.xy;
+    float r, g, b;
+    float shade;
+    r = accumulate(uv.x);
+    g = blend(uv.y);
+    b = wave(uv * 8.0 + iTime);
+    shade += r * 0.3 + g * 0.59 + b * 0.11;
+    fragColor = vec4(vec3(r, g, b) * shade, 1.0);
+}
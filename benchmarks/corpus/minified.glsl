@@ -0,0 +1 @@
+void mainImage(out vec4 O, vec2 U){float i,e,g;vec3 p;for(O*=i;i++<99.;g+=e*.2){p=g*normalize(vec3((U-.5*iResolution.xy)/iResolution.y,1));p.z-=iTime;e=length(sin(p))-.3;O+=.01/exp(e*1e3);}O.a=1.;O=sin(O*vec4(1,2,3,1));}
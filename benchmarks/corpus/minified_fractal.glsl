@@ -0,0 +1,3 @@
+#define R(p,a,r)mix(a*dot(p,a),p,cos(r))+sin(r)*cross(p,a)
+#define H(h)(cos((h)*6.3+vec3(0,23,21))*.5+.5)
+void mainImage(out vec4 O,vec2 C){O=vec4(0);vec3 p,r=iResolution,d=normalize(vec3((C-.5*r.xy)/r.y,1));for(float i=0.,g=0.,e,s;i++<99.;){p=g*d;p.z+=iTime*.3;p=R(p,normalize(H(iTime*.05)),iTime*.1);s=2.;for(int j=0;j++<8;){p=abs(p)-vec3(.8,1.5,.7);s*=e=1.8/clamp(dot(p,p),.2,1.);p=p*e-vec3(1,3,1);}g+=e=length(p.xz)/s;O.rgb+=mix(r/r,H(log(s)),.6)*.02*exp(-.2*i*i*e);}O=pow(O,vec4(3.0));}
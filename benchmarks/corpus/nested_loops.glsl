@@ -0,0 +1,47 @@
+// Deeply nested loops with counters in the loop conditions
+float field(vec3 p)
+{
+    float d = 1e9;
+    for (int x = 0; x < 3; x++) {
+        for (int y = 0; y < 3; y++) {
+            for (int z = 0; z < 3; z++) {
+                vec3 c = vec3(float(x), float(y), float(z)) - 1.0;
+                for (int k = 0; k < 2; k++) {
+                    if (k == 1) {
+                        c *= 0.5;
+                    }
+                    d = min(d, length(p - c) - 0.3);
+                }
+            }
+        }
+    }
+    return d;
+}
+
+vec3 trace(vec3 ro, vec3 rd)
+{
+    float t, steps;
+    vec3 col = vec3(0.0);
+    for (float i = 0.; i++ < 64.; ) {
+        vec3 p = ro + rd * t;
+        float d = field(p);
+        for (float j = 0.; j++ < 3.; ) {
+            d = min(d, field(p + rd * j * 0.01));
+        }
+        if (d < 0.001) {
+            col = vec3(1.0 - steps / 64.0);
+            break;
+        }
+        t += d;
+        steps += 1.0;
+    }
+    return col;
+}
+
+void mainImage(out vec4 fragColor, in vec2 fragCoord)
+{
+    vec2 uv = (fragCoord - 0.5 * iResolution.xy) / iResolution.y;
+    vec3 ro = vec3(0.0, 0.0, -4.0);
+    vec3 rd = normalize(vec3(uv, 1.5));
+    fragColor = vec4(trace(ro, rd), 1.0);
+}
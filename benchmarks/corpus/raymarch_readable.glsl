@@ -0,0 +1,144 @@
+// Readable raymarcher exercising most of the conversion rules
+#define MAX_STEPS 128
+#define MAX_DIST 100.0
+#define SURF_DIST 0.001
+#define PI 3.14159265
+#define TAU 6.28318531
+
+struct Hit {
+    float dist;
+    float material;
+};
+
+float2 hashUv(float2 p)
+{
+    p = float2(dot(p, float2(127.1, 311.7)), dot(p, float2(269.5, 183.3)));
+    return frac(sin(p) * 43758.5453);
+}
+
+mat2 rotate2d(float a)
+{
+    float c = cos(a), s = sin(a);
+    return mat2(c, -s, s, c);
+}
+
+float smin(float a, float b, float k)
+{
+    float h = saturate(0.5 + 0.5 * (b - a) / k);
+    return lerp(b, a, h) - k * h * (1.0 - h);
+}
+
+float sdTorus(vec3 p, vec2 t)
+{
+    vec2 q = vec2(length(p.xz) - t.x, p.y);
+    return length(q) - t.y;
+}
+
+float sdCapsule(vec3 p, vec3 a, vec3 b, float r)
+{
+    vec3 pa = p - a, ba = b - a;
+    float h = clamp(dot(pa, ba) / dot(ba, ba), 0.0, 1.0);
+    return length(pa - ba * h) - r;
+}
+
+Hit scene(vec3 p)
+{
+    Hit hit;
+    vec3 q = p;
+    q.xz = mul(rotate2d(iTime * 0.3), q.xz);
+    float torus = sdTorus(q - vec3(0.0, 1.0, 0.0), vec2(1.0, 0.25));
+    float ground = p.y;
+    float capsule = sdCapsule(p, vec3(-2.0, 0.5, 0.0), vec3(2.0, 0.5, 0.0), 0.2);
+    float blob = smin(torus, capsule, 0.4);
+    hit.dist = min(blob, ground);
+    hit.material = blob < ground ? 1.0 : 0.0;
+    return hit;
+}
+
+vec3 calcNormal(vec3 p)
+{
+    vec2 e = vec2(0.001, 0.0);
+    return normalize(vec3(
+        scene(p + e.xyy).dist - scene(p - e.xyy).dist,
+        scene(p + e.yxy).dist - scene(p - e.yxy).dist,
+        scene(p + e.yyx).dist - scene(p - e.yyx).dist));
+}
+
+float softShadow(vec3 ro, vec3 rd, float k)
+{
+    float res = 1.0;
+    float t;
+    for (int i = 0; i < 32; i++) {
+        float h = scene(ro + rd * t).dist;
+        res = min(res, k * h / max(t, 0.001));
+        t += clamp(h, 0.02, 0.2);
+        if (res < 0.005 || t > 10.0) break;
+    }
+    return saturate(res);
+}
+
+float ambientOcclusion(vec3 p, vec3 n)
+{
+    float occ, sca;
+    sca = 1.0;
+    for (int i = 0; i < 5; i++) {
+        float h = 0.01 + 0.12 * float(i) / 4.0;
+        float d = scene(p + h * n).dist;
+        occ += (h - d) * sca;
+        sca *= 0.95;
+    }
+    return saturate(1.0 - 3.0 * occ);
+}
+
+Hit march(vec3 ro, vec3 rd)
+{
+    Hit hit;
+    float t;
+    for (int i = 0; i < MAX_STEPS; i++) {
+        hit = scene(ro + rd * t);
+        if (hit.dist < SURF_DIST || t > MAX_DIST) break;
+        t += hit.dist;
+    }
+    hit.dist = t;
+    return hit;
+}
+
+vec3 shade(vec3 p, vec3 rd, float material)
+{
+    vec3 n = calcNormal(p);
+    vec3 light = normalize(vec3(0.6, 0.8, -0.4));
+    float diffuse = saturate(dot(n, light));
+    float specular = pow(saturate(dot(reflect(rd, n), light)), 2.0);
+    float shadow = softShadow(p + n * 0.01, light, 8.0);
+    float ao = ambientOcclusion(p, n);
+    vec3 albedo = material > 0.5 ? vec3(0.9, 0.4, 0.2) : vec3(0.3) + 0.2 * mod(floor(p.x) + floor(p.z), 2.0);
+    vec3 col = albedo * diffuse * shadow;
+    col += 0.2 * albedo * ao;
+    col += specular * shadow;
+    return col;
+}
+
+void mainImage(out vec4 fragColor, in vec2 fragCoord)
+{
+    vec2 uv = (fragCoord - 0.5 * iResolution.xy) / iResolution.y;
+    vec2 m = iMouse.xy / iResolution.xy;
+
+    vec3 ro = vec3(0.0, 2.0, -6.0);
+    ro.yz = mul(rotate2d(-m.y * PI * 0.25), ro.yz);
+    ro.xz = mul(rotate2d(-m.x * TAU), ro.xz);
+    vec3 forward = normalize(-ro + vec3(0.0, 0.5, 0.0));
+    vec3 right = normalize(cross(vec3(0.0, 1.0, 0.0), forward));
+    vec3 up = cross(forward, right);
+    vec3 rd = normalize(uv.x * right + uv.y * up + 1.5 * forward);
+
+    Hit hit = march(ro, rd);
+    vec3 col = vec3(0.6, 0.7, 0.9) - rd.y * 0.4;
+    if (hit.dist < MAX_DIST) {
+        col = shade(ro + rd * hit.dist, rd, hit.material);
+        col = mix(col, vec3(0.6, 0.7, 0.9), 1.0 - exp(-0.0005 * pow(hit.dist, 3.0)));
+    }
+
+    col += 0.05 * hashUv(fragCoord).x;
+    col = pow(col, vec3(0.4545));
+    fragColor = vec4(col, 1.0);
+}
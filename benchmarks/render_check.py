@@ -0,0 +1,85 @@
+"""Render the corpus with every optional pass on and check the image is unchanged
+
+    python benchmarks/render_check.py                 # every opt-in option
+    python benchmarks/render_check.py --only uniform_block,glsl_es
+
+Each shader in benchmarks/corpus is converted with the default options
+and once more with each option that is off by default turned on, and
+both conversions are rendered on the CPU with glsl_render.  A run fails
+when any channel of any pixel differs by more than --tolerance, or when
+an option makes a conversion the renderer cannot run.  Shaders whose
+default conversion does not render are listed as skipped.  Needs NumPy.
+"""
+import argparse
+import glob
+import os
+import sys
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from glsl_render import RenderError, render  # noqa: E402
+from shadertoy_to_opengl import DEFAULT_OPTIONS, convert_shadertoy_to_opengl  # noqa: E402
+
+# Options that only take effect along with others
+REQUIRES = {'glsl_es': {'uniform_block': True}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--corpus', default=os.path.join(HERE, 'corpus'),
+                        help='directory of Shadertoy shaders (default benchmarks/corpus)')
+    parser.add_argument('--size', default='64x36',
+                        help='render size as WIDTHxHEIGHT (default 64x36)')
+    parser.add_argument('--time', type=float, default=1.5,
+                        help='iTime to render at (default 1.5)')
+    parser.add_argument('--tolerance', type=float, default=1e-5,
+                        help='largest allowed difference in any channel')
+    parser.add_argument('--only', help='comma separated option names')
+    args = parser.parse_args(argv)
+
+    options = [name for name, default in DEFAULT_OPTIONS.items() if not default]
+    if args.only:
+        wanted = args.only.split(',')
+        unknown = set(wanted) - set(options)
+        if unknown:
+            parser.error(f'unknown opt-in options: {", ".join(sorted(unknown))}')
+        options = [name for name in options if name in wanted]
+    try:
+        width, height = (int(n) for n in args.size.split('x'))
+    except ValueError:
+        parser.error(f'bad --size {args.size!r}, expected WIDTHxHEIGHT')
+    uniforms = {'iTime': args.time}
+
+    failures = []
+    for path in sorted(glob.glob(os.path.join(args.corpus, '*.glsl'))):
+        name = os.path.basename(path)
+        with open(path, encoding='utf-8') as f:
+            shader_code = f.read()
+        try:
+            expected = render(convert_shadertoy_to_opengl(shader_code), width, height, uniforms)
+        except RenderError as e:
+            print(f'{name:28} skipped: {e}')
+            continue
+        for option in options:
+            settings = dict(REQUIRES.get(option, {}), **{option: True})
+            try:
+                image = render(convert_shadertoy_to_opengl(shader_code, **settings),
+                               width, height, uniforms)
+            except RenderError as e:
+                failures.append(f'{name} with {option}: {e}')
+                continue
+            difference = float(np.max(np.abs(np.nan_to_num(image) - np.nan_to_num(expected))))
+            print(f'{name:28} {option:24} {difference:.3g}')
+            if not difference <= args.tolerance:
+                failures.append(f'{name} with {option} differs by {difference:.3g}')
+
+    for failure in failures:
+        print(f'FAIL {failure}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
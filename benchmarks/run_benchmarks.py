@@ -0,0 +1,226 @@
+"""Time the conversion pipeline and each stage, and gate on regressions
+
+    python benchmarks/run_benchmarks.py                    # compare with baseline.json
+    python benchmarks/run_benchmarks.py --update-baseline  # record a new baseline
+    python benchmarks/run_benchmarks.py --quick            # scaling up to 100k chars
+
+Every stage runs on its own on the unconverted input with the lexer cache
+cleared, so each number covers the stage's own tokenization too.  The
+scaling inputs expose superlinear stages: the reported exponent is the
+log-log slope of time against input size over the two largest inputs.
+"""
+import argparse
+import glob
+import json
+import math
+import os
+import platform
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import shadertoy_to_opengl as converter  # noqa: E402
+from glsl_lexer import clear_lex_cache  # noqa: E402
+
+
+STAGES = (
+    'convert_shadertoy_to_opengl',
+    'fix_variable_initialization',
+    'fix_loop_semantics',
+    'unroll_loops',
+    'bound_loops',
+    'extract_mainimage_and_transform',
+    'apply_shadertoy_conventions',
+    'optimize_performance',
+    'remove_unused_code',
+    'handle_common_shadertoy_functions',
+    'add_shadertoy_constants',
+    'prepend_uniforms_and_precision',
+    'add_compatibility_extensions',
+    'qualify_precision',
+)
+
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline.json')
+
+# Building blocks for the scaling inputs; {n} keeps every function distinct
+_SCALING_FUNCTIONS = (
+    '''
+float accumulate{n}(float x)
+{{
+    float a, b, sum;
+    a = x * {n}.0;
+    for (int i = 0; i < 8; i++) {{
+        sum += a * float(i);
+        for (int j = 0; j < 4; j++) {{ b += pow(sum, 2.0) * 0.5; }}
+    }}
+    return mix(sum, b, 0.5) + saturate(a);
+}}
+''',
+    '''
+// Minified helper {n}
+vec3 fold{n}(vec3 p){{float s,e;for(float i=0.;i++<8.;){{p=abs(p)-vec3(.5);s*=e=1.8/clamp(dot(p,p),.2,1.);p=p*e;}}return p*lerp(s,e,.5)+frac(p.x);}}
+''',
+    '''
+float2 sample{n}(float2 uv)
+{{
+    float2 q = mul(float2x2(0.8, -0.6, 0.6, 0.8), uv);
+    float d = length(texture(iChannel0, q).rgb) * TAU;
+    return q * pow(d, 3.0) + hash(q);
+}}
+''',
+)
+
+
+def make_scaling_shader(size):
+    """A readable-plus-minified shader of at least size characters"""
+    parts = []
+    length = 0
+    n = 0
+    while length < size:
+        part = _SCALING_FUNCTIONS[n % len(_SCALING_FUNCTIONS)].format(n=n)
+        parts.append(part)
+        length += len(part)
+        n += 1
+    parts.append('''
+void mainImage(out vec4 fragColor, in vec2 fragCoord)
+{
+    vec2 uv = fragCoord / iResolution.xy;
+    float t;
+    for (float i = 0.; i++ < 4.; ) { t += accumulate0(uv.x + i); }
+    fragColor = vec4(vec3(t), 1.0);
+}
+''')
+    return ''.join(parts)
+
+
+def time_stage(stage, shader_code, min_time, max_repeats):
+    """Best wall time of stage(shader_code) over a few cold-cache runs"""
+    best = math.inf
+    total = 0.0
+    runs = 0
+    while runs < max_repeats and (runs == 0 or total < min_time):
+        clear_lex_cache()
+        started = time.perf_counter()
+        stage(shader_code)
+        elapsed = time.perf_counter() - started
+        best = min(best, elapsed)
+        total += elapsed
+        runs += 1
+    return best
+
+
+def run(sizes, stages, min_time, max_repeats, log=print):
+    cases = {}
+    inputs = [(os.path.relpath(path, HERE), open(path, encoding='utf-8').read())
+              for path in sorted(glob.glob(os.path.join(HERE, 'corpus', '*.glsl')))]
+    inputs.extend((f'scaling/{size}', make_scaling_shader(size)) for size in sizes)
+    for name, shader_code in inputs:
+        timings = {}
+        for stage in stages:
+            timings[stage] = time_stage(getattr(converter, stage), shader_code,
+                                        min_time, max_repeats)
+        cases[name] = {'size': len(shader_code), 'stages': timings}
+        log(f'{name:40} {len(shader_code):>9} chars  '
+            f'{timings.get(STAGES[0], min(timings.values())) * 1000:9.2f} ms')
+
+    exponents = {}
+    scaling = sorted((case['size'], case['stages']) for name, case in cases.items()
+                     if name.startswith('scaling/'))
+    if len(scaling) >= 2:
+        (size_a, times_a), (size_b, times_b) = scaling[-2:]
+        for stage in stages:
+            if times_a[stage] > 0 and times_b[stage] > 0:
+                exponents[stage] = (math.log(times_b[stage] / times_a[stage])
+                                    / math.log(size_b / size_a))
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cases': cases,
+        'scaling_exponents': exponents,
+    }
+
+
+def compare(results, baseline, threshold, min_delta, max_exponent):
+    """Human readable regressions of results against baseline"""
+    problems = []
+    for name, case in baseline.get('cases', {}).items():
+        current = results['cases'].get(name)
+        if current is None:
+            continue
+        for stage, before in case['stages'].items():
+            after = current['stages'].get(stage)
+            if after is None:
+                continue
+            if after > before * (1 + threshold) and after - before > min_delta:
+                problems.append(f'{name} {stage}: {before * 1000:.2f} ms -> '
+                                f'{after * 1000:.2f} ms ({after / before:.2f}x)')
+    for stage, exponent in results['scaling_exponents'].items():
+        if exponent > max_exponent:
+            problems.append(f'{stage} scales as n^{exponent:.2f} '
+                            f'(limit n^{max_exponent:.2f})')
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='comma separated scaling input sizes in characters')
+    parser.add_argument('--quick', action='store_true',
+                        help='skip scaling inputs larger than 100k characters')
+    parser.add_argument('--stages', help='comma separated subset of stages to time')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='baseline JSON to compare with or update')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='write the results as the new baseline instead of comparing')
+    parser.add_argument('--output', help='also write the results JSON here')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slowdown as a fraction of the baseline (default 0.25)')
+    parser.add_argument('--min-delta', type=float, default=0.002,
+                        help='ignore slowdowns smaller than this many seconds')
+    parser.add_argument('--max-exponent', type=float, default=1.3,
+                        help='fail when a stage scales worse than n^this')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='keep repeating a measurement until this many seconds')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='at most this many runs per measurement')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    if args.quick:
+        sizes = [size for size in sizes if size <= 100000]
+    stages = args.stages.split(',') if args.stages else list(STAGES)
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error(f'unknown stages: {", ".join(unknown)}')
+
+    results = run(sizes, stages, args.min_time, args.repeats)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    for stage, exponent in sorted(results['scaling_exponents'].items()):
+        print(f'{stage:40} n^{exponent:.2f}')
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f'Baseline written to {args.baseline}')
+        return 0
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    else:
+        print(f'No baseline at {args.baseline}; only checking scaling')
+    problems = compare(results, baseline, args.threshold, args.min_delta, args.max_exponent)
+    for problem in problems:
+        print(f'REGRESSION {problem}')
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
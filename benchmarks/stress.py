@@ -0,0 +1,197 @@
+"""Feed adversarial and megabyte-scale inputs and check conversion stays linear
+
+    python benchmarks/stress.py                  # every generator up to 1M chars
+    python benchmarks/stress.py --max-size 250000 --only nested_pow,unclosed_calls
+
+Each generator builds inputs of doubling sizes.  The exponent is the
+least-squares slope of log conversion time against log size over all the
+sizes, each timed as the best of --repeats runs; a run fails when any
+generator scales worse than --max-exponent or a single conversion takes
+longer than --timeout seconds.  The default limit leaves room for timing
+noise while still catching quadratic behaviour (n^2).
+"""
+import argparse
+import gc
+import math
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from glsl_lexer import clear_lex_cache  # noqa: E402
+from shadertoy_to_opengl import convert_shadertoy_to_opengl  # noqa: E402
+
+
+def _repeat(text, size):
+    return text * (size // len(text) + 1)
+
+
+def _main_image(body):
+    return f'void mainImage(out vec4 O, vec2 U){{{body}}}\n'
+
+
+def nested_pow(size):
+    """pow(pow(pow(...))) nested as deep as the size allows"""
+    depth = size // 12
+    return _main_image('float x = ' + 'pow(' * depth + 'x' + ', 2.0)' * depth + ';')
+
+
+def nested_mix(size):
+    depth = size // 16
+    return _main_image('vec3 c = ' + 'mix(a, ' * depth + 'b' + ', 0.5)' * depth + ';')
+
+
+def nested_parens(size):
+    depth = size // 2
+    return _main_image('float x = ' + '(' * depth + '1.0' + ')' * depth + ';')
+
+
+def unclosed_calls(size):
+    """Calls that never close: mul(a, b mix(a, b, 0.5 saturate( ..."""
+    return _main_image(_repeat('mul(a, b mix(a, b, 0.5 saturate(x pow(y, 2.0 ', size))
+
+
+def unbalanced_closers(size):
+    return _main_image(_repeat('x = a) ] } ; ', size))
+
+
+def float_declarations(size):
+    """float declarations that run on without a semicolon"""
+    return _main_image('float ' + ', '.join(f'v{n}' for n in range(size // 6)))
+
+
+def many_floats(size):
+    return _main_image(_repeat('float a; a += 1.0; float b; b = a; ', size))
+
+
+def chained_assignments(size):
+    return _main_image('float a, b; a = ' + 'b = ' * (size // 4) + '1.0;')
+
+
+def loop_headers(size):
+    """for headers that use the i++<N idiom, and ones that never close"""
+    return _main_image(_repeat('for(float i=0.;i++<9.;){x+=i;} for(;;', size))
+
+
+def unterminated_comments(size):
+    return _repeat('x = 1.0; /* comment without an end ', size)
+
+
+def directive_lines(size):
+    return _repeat('#define F(x) mix(x, x, 0.5) \\\n  * pow(x, 2.0)\n#ifdef X\n#endif\n', size)
+
+
+def hashes_mid_line(size):
+    return _main_image(_repeat('x = a # b ## c; ', size))
+
+
+def minified_functions(size):
+    """Many small minified functions, like a concatenation of golfed shaders"""
+    parts = []
+    length = 0
+    n = 0
+    while length < size:
+        part = (f'float f{n}(vec3 p){{float d,e;for(float i=0.;i++<8.;)'
+                f'{{p=abs(p)-.5;e+=pow(d,2.0);d=mix(d,e,.5);}}return saturate(d);}}\n')
+        parts.append(part)
+        length += len(part)
+        n += 1
+    parts.append(_main_image('O = vec4(f0(vec3(U, 1.0)));'))
+    return ''.join(parts)
+
+
+def one_long_line(size):
+    """A whole shader body on a single line with no whitespace at all"""
+    return _main_image(_repeat('O.x+=mix(O.y,pow(O.z,2.0),0.5)*saturate(O.w);', size))
+
+
+GENERATORS = (
+    nested_pow, nested_mix, nested_parens, unclosed_calls, unbalanced_closers,
+    float_declarations, many_floats, chained_assignments, loop_headers,
+    unterminated_comments, directive_lines, hashes_mid_line, minified_functions,
+    one_long_line,
+)
+
+
+def time_conversion(shader_code, repeats=1):
+    best = math.inf
+    for _ in range(repeats):
+        clear_lex_cache()
+        gc.collect()
+        started = time.perf_counter()
+        convert_shadertoy_to_opengl(shader_code)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def scaling_exponent(timings):
+    """Least-squares slope of log time against log size over (size, time) pairs"""
+    points = [(math.log(size), math.log(elapsed)) for size, elapsed in timings if elapsed > 0]
+    if len(points) < 2:
+        return 0.0
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    spread = sum((x - mean_x) ** 2 for x, _ in points)
+    if not spread:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / spread
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--max-size', type=int, default=1000000,
+                        help='largest input in characters (default 1M)')
+    parser.add_argument('--steps', type=int, default=4,
+                        help='number of doubling sizes per generator')
+    parser.add_argument('--max-exponent', type=float, default=1.5,
+                        help='fail when conversion time grows faster than n^this')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='runs per size; the fastest one counts')
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='fail when one conversion takes longer than this')
+    parser.add_argument('--only', help='comma separated generator names')
+    args = parser.parse_args(argv)
+
+    generators = GENERATORS
+    if args.only:
+        wanted = args.only.split(',')
+        generators = [g for g in GENERATORS if g.__name__ in wanted]
+        unknown = set(wanted) - {g.__name__ for g in generators}
+        if unknown:
+            parser.error(f'unknown generators: {", ".join(sorted(unknown))}')
+
+    sizes = [args.max_size >> shift for shift in reversed(range(args.steps))]
+    failures = []
+    for generator in generators:
+        timings = []
+        for size in sizes:
+            shader_code = generator(size)
+            try:
+                elapsed = time_conversion(shader_code, args.repeats)
+            except Exception as e:
+                failures.append(f'{generator.__name__}: {type(e).__name__}: {e} '
+                                f'at {len(shader_code)} chars')
+                break
+            timings.append((len(shader_code), elapsed))
+            if elapsed > args.timeout:
+                failures.append(f'{generator.__name__}: {elapsed:.1f}s for '
+                                f'{len(shader_code)} chars')
+                break
+        if not timings:
+            print(f'{generator.__name__:24} failed')
+            continue
+        size_b, time_b = timings[-1]
+        exponent = scaling_exponent(timings)
+        print(f'{generator.__name__:24} {size_b:>9} chars {time_b:8.3f}s  n^{exponent:.2f}')
+        if exponent > args.max_exponent:
+            failures.append(f'{generator.__name__} scales as n^{exponent:.2f}')
+
+    for failure in failures:
+        print(f'FAIL {failure}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+
+def default_cache_dir():
+    """Per-user cache directory, following XDG_CACHE_HOME when it is set"""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'shadertoy_to_opengl')
+
+
+def atomic_write(path, data):
+    """Write bytes to path so that readers see the old or the new file, never a mix"""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    # Write next to the target and rename; other processes may be reading
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=directory)
+    try:
+        # Owned by the file object at once, so every error path closes it
+        with os.fdopen(fd, 'wb') as f:
+            # mkstemp creates private files; keep the mode a plain write would give
+            try:
+                mode = os.stat(path).st_mode & 0o777
+            except FileNotFoundError:
+                mode = 0o644
+            os.chmod(tmp_path, mode)
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class ConversionCache:
+    """Content-addressed cache of conversion results
+
+    Entries are keyed by a hash of the input, the enabled options and the
+    converter fingerprint, so a change to the conversion rules produces
+    new keys and stale results are never returned; they just age out.  A
+    bounded in-memory LRU sits in front of an optional on-disk tier whose
+    files are written atomically and evicted least recently used first
+    once the tier grows past max_disk_bytes.
+    """
+
+    # Eviction trims the disk tier to this fraction of its limit, so a full
+    # cache does not rescan its directory on every write
+    EVICT_TO = 0.9
+
+    def __init__(self, fingerprint, directory=None, max_entries=512,
+                 max_disk_bytes=64 * 1024 * 1024):
+        self.fingerprint = fingerprint
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._disk_bytes = None  # measured on the first write
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def hits(self):
+        return self.memory_hits + self.disk_hits
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'memory_entries': len(self._memory),
+        }
+
+    def key(self, shader_code, options=None):
+        digest = hashlib.sha256()
+        digest.update(self.fingerprint.encode())
+        digest.update(b'\0')
+        digest.update(repr(sorted((options or {}).items())).encode())
+        digest.update(b'\0')
+        digest.update(shader_code.encode('utf-8', 'surrogatepass'))
+        return digest.hexdigest()
+
+    def convert(self, shader_code, convert, **options):
+        """Return convert(shader_code, **options), from the cache if possible"""
+        key = self.key(shader_code, options)
+        output = self.get(key)
+        if output is None:
+            output = convert(shader_code, **options)
+            self.put(key, output)
+        return output
+
+    def get(self, key):
+        """Cached output for key, or None; counts a hit or a miss"""
+        output = self._memory.get(key)
+        if output is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return output
+        output = self._read(key)
+        if output is None:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self._remember(key, output)
+        return output
+
+    def put(self, key, output):
+        self._remember(key, output)
+        if self.directory is not None:
+            self._write(key, output)
+
+    def _remember(self, key, output):
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = output
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def _read(self, key):
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8', newline='') as f:
+                output = f.read()
+            # The modification time doubles as the last use for eviction
+            os.utime(path)
+        except OSError:
+            return None
+        return output
+
+    def _write(self, key, output):
+        path = self._path(key)
+        data = output.encode('utf-8')
+        try:
+            atomic_write(path, data)
+        except OSError:
+            return  # a cache that cannot be written is just a slower cache
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(size for _, size, _ in self._disk_entries())
+        else:
+            self._disk_bytes += len(data)
+        if self._disk_bytes > self.max_disk_bytes:
+            self._evict()
+
+    def _disk_entries(self):
+        """(last use, size, path) of every entry in the disk tier"""
+        entries = []
+        try:
+            shards = list(os.scandir(self.directory))
+        except OSError:
+            return entries
+        for shard in shards:
+            if not shard.is_dir():
+                continue
+            try:
+                for entry in os.scandir(shard.path):
+                    if entry.name.startswith('.tmp-'):
+                        continue
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            except OSError:
+                continue  # removed by another process meanwhile
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._disk_entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_disk_bytes * self.EVICT_TO
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+        self._disk_bytes = total
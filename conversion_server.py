@@ -0,0 +1,387 @@
+import argparse
+import asyncio
+import collections
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from shadertoy_to_opengl import (ConversionProfile, IncrementalConverter, open_conversion_cache,
+                                 resolve_options)
+
+
+DEFAULT_PORT = 8765
+
+# Requests with a larger body are refused
+MAX_BODY = 16 * 1024 * 1024
+
+# Shaders of one batch that go to a worker together; fewer round trips for
+# many small shaders, while a big batch still spreads over the pool
+MAX_CHUNK = 16
+
+# Latencies kept for the percentiles in /stats
+LATENCY_WINDOW = 2048
+
+# Converted once in each worker as it starts, so the first real request
+# does not pay for compiling regexes and warming the lexer
+_WARM_UP_SHADER = '''
+void mainImage(out vec4 fragColor, in vec2 fragCoord)
+{
+    vec2 uv = fragCoord / iResolution.xy;
+    float d;
+    for (int i = 0; i < 4; i++) d += sin(uv.x * float(i) + iTime);
+    fragColor = vec4(0.5 + 0.5 * cos(iTime + uv.xyx + vec3(0, 2, 4)) * d, 1.0);
+}
+'''
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            413: 'Payload Too Large', 431: 'Request Header Fields Too Large',
+            500: 'Internal Server Error',
+            503: 'Service Unavailable'}
+
+_worker_cache = None
+_worker_converter = None
+
+
+def _init_worker(cache_dir):
+    global _worker_cache, _worker_converter
+    _worker_cache = open_conversion_cache(cache_dir)
+    _worker_converter = IncrementalConverter()
+    _worker_converter.convert(_WARM_UP_SHADER)
+
+
+def _convert_chunk(jobs):
+    """Results of (code, options, profile) jobs, converted in a worker"""
+    results = []
+    for code, options, want_profile in jobs:
+        started = time.perf_counter()
+        profile = ConversionProfile() if want_profile else None
+        result = {'code': None, 'error': None}
+        try:
+            hits = _worker_cache.hits
+            result['code'] = _worker_cache.convert(
+                code, lambda code, **options: _worker_converter.convert(code, profile, **options),
+                **options)
+            result['cached'] = _worker_cache.hits > hits
+        except Exception as e:
+            result['error'] = f'{type(e).__name__}: {e}'
+        result['seconds'] = time.perf_counter() - started
+        if want_profile:
+            result['profile'] = None if result.get('cached') else profile.as_dict()
+        results.append(result)
+    return results
+
+
+class Overloaded(Exception):
+    """More shaders are queued than the server takes"""
+
+
+class RequestError(Exception):
+    """A request the server cannot make sense of"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Nearest-rank percentiles of values, in the same unit, or None each
+    when there are none"""
+    ordered = sorted(values)
+    result = {}
+    for point in points:
+        key = f'p{point}'
+        if not ordered:
+            result[key] = None
+            continue
+        result[key] = ordered[max(0, math.ceil(point / 100 * len(ordered)) - 1)]
+    result['max'] = ordered[-1] if ordered else None
+    return result
+
+
+class ConversionServer:
+    """Converts shaders for local clients on a warm process pool
+
+    Requests are HTTP/1.1 over TCP or a Unix socket:
+
+    - POST /convert with {"code": ..., "options": {...}, "profile": bool}
+      converts one shader; with {"shaders": [...]} a batch, where each item
+      is code or an object like the single request, and "options" and
+      "profile" at the top are the defaults for the items
+    - GET /stats returns queue depth, counters and latency percentiles
+
+    At most two chunks per worker are converting at a time; the rest wait
+    in the queue, and once it holds max_queue shaders new requests are
+    refused with 503 until it drains.
+    """
+
+    def __init__(self, workers=None, max_queue=None, cache_dir=None, max_body=MAX_BODY):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue or self.workers * 64
+        self.cache_dir = cache_dir
+        self.max_body = max_body
+        self._pool = None
+        self._slots = None
+        self._queued = 0
+        self._converting = 0
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._request_latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.started = time.time()
+        self.requests = 0
+        self.conversions = 0
+        self.errors = 0
+        self.rejected = 0
+        self.cached = 0
+
+    def start_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                             initargs=(self.cache_dir,))
+            self._slots = asyncio.Semaphore(self.workers * 2)
+            # Start every worker now rather than on the first request
+            for _ in range(self.workers):
+                self._pool.submit(int)
+
+    async def serve(self, host='127.0.0.1', port=DEFAULT_PORT, path=None):
+        """Start listening on path, a Unix socket, or else host:port"""
+        self.start_pool()
+        if path is not None:
+            return await asyncio.start_unix_server(self._handle, path)
+        return await asyncio.start_server(self._handle, host, port)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    async def convert(self, jobs):
+        """Results of (code, options, profile) jobs, in order; raises
+        Overloaded when the queue is full, and RequestError when the jobs
+        would not fit in it even empty"""
+        if len(jobs) > self.max_queue:
+            self.rejected += 1
+            raise RequestError(f'a batch holds at most {self.max_queue} shaders, '
+                               f'not {len(jobs)}; split it', 413)
+        if self._queued + len(jobs) > self.max_queue:
+            self.rejected += 1
+            raise Overloaded(f'{self._queued} shaders are queued already')
+        self.start_pool()
+        size = min(MAX_CHUNK, max(1, math.ceil(len(jobs) / self.workers)))
+        chunks = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+        # Shaders of each chunk still waiting for a slot
+        waiting = [len(chunk) for chunk in chunks]
+        self._queued += len(jobs)
+        started = time.perf_counter()
+        try:
+            done = await asyncio.gather(*(self._convert_chunk(chunk, n, waiting, started)
+                                          for n, chunk in enumerate(chunks)))
+        finally:
+            self._queued -= sum(waiting)
+        return [result for chunk in done for result in chunk]
+
+    async def _convert_chunk(self, chunk, n, waiting, started):
+        loop = asyncio.get_running_loop()
+        async with self._slots:
+            self._queued -= waiting[n]
+            waiting[n] = 0
+            self._converting += len(chunk)
+            try:
+                results = await loop.run_in_executor(self._pool, _convert_chunk, chunk)
+            finally:
+                self._converting -= len(chunk)
+        latency = (time.perf_counter() - started) * 1000
+        for result in results:
+            self.conversions += 1
+            self.errors += result['error'] is not None
+            self.cached += bool(result.get('cached'))
+            self._latencies.append(latency)
+        return results
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queue_depth': self._queued,
+            'converting': self._converting,
+            'max_queue': self.max_queue,
+            'uptime_seconds': time.time() - self.started,
+            'requests': self.requests,
+            'conversions': self.conversions,
+            'cached': self.cached,
+            'errors': self.errors,
+            'rejected': self.rejected,
+            'shader_latency_ms': percentiles(self._latencies),
+            'request_latency_ms': percentiles(self._request_latencies),
+        }
+
+    def _jobs(self, request):
+        if not isinstance(request, dict):
+            raise RequestError('expected a JSON object')
+        defaults = request.get('options') or {}
+        profile = bool(request.get('profile'))
+        items = request['shaders'] if 'shaders' in request else [request]
+        if not isinstance(items, list) or not items:
+            raise RequestError('"shaders" must be a non-empty list')
+        jobs = []
+        for item in items:
+            if isinstance(item, str):
+                item = {'code': item}
+            if not isinstance(item, dict) or not isinstance(item.get('code'), str):
+                raise RequestError('each shader needs its "code" as a string')
+            try:
+                options = resolve_options(dict(defaults, **(item.get('options') or {})))
+            except (TypeError, ValueError) as e:
+                raise RequestError(str(e)) from None
+            jobs.append((item['code'], options, bool(item.get('profile', profile))))
+        return jobs
+
+    async def _respond(self, method, target, body):
+        """(status, JSON-able body) for a request"""
+        path = target.split('?', 1)[0]
+        if path == '/stats':
+            if method != 'GET':
+                return 405, {'error': 'use GET'}
+            return 200, self.stats()
+        if path != '/convert':
+            return 404, {'error': f'no such endpoint: {path}'}
+        if method != 'POST':
+            return 405, {'error': 'use POST'}
+        try:
+            request = json.loads(body)
+        except ValueError as e:
+            raise RequestError(f'invalid JSON: {e}') from None
+        jobs = self._jobs(request)
+        try:
+            results = await self.convert(jobs)
+        except Overloaded as e:
+            return 503, {'error': str(e)}
+        if 'shaders' in request:
+            return 200, {'results': results}
+        return 200, results[0]
+
+    @staticmethod
+    async def _read_line(reader):
+        """The next line of a request head; raises RequestError when it is
+        longer than the stream buffer"""
+        try:
+            return await reader.readline()
+        except ValueError:
+            # asyncio.LimitOverrunError, reraised by readline()
+            raise RequestError('request line or header too long', 431) from None
+
+    @staticmethod
+    async def _send(writer, status, payload, keep_alive):
+        data = json.dumps(payload).encode('utf-8')
+        head = [f'HTTP/1.1 {status} {_REASONS[status]}',
+                'Content-Type: application/json',
+                f'Content-Length: {len(data)}',
+                f'Connection: {"keep-alive" if keep_alive else "close"}']
+        if status == 503:
+            head.append('Retry-After: 1')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + data)
+        # A client that does not read its results holds up only itself
+        await writer.drain()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await self._read_line(reader)
+                    if not request_line.strip():
+                        return
+                    started = time.perf_counter()
+                    try:
+                        method, target, version = request_line.decode('latin-1').split()
+                    except ValueError:
+                        return
+                    headers = {}
+                    while True:
+                        line = await self._read_line(reader)
+                        if line in (b'\r\n', b'\n', b''):
+                            break
+                        name, _, value = line.decode('latin-1').partition(':')
+                        headers[name.strip().lower()] = value.strip()
+                except RequestError as e:
+                    # The rest of the line is still unread: answer and hang up
+                    await self._send(writer, e.status, {'error': str(e)}, False)
+                    return
+                keep_alive = (headers.get('connection', '').lower() != 'close'
+                              and version != 'HTTP/1.0')
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                try:
+                    if not 0 <= length <= self.max_body:
+                        # The body is not read, so the connection cannot go on
+                        keep_alive = False
+                        if length < 0:
+                            raise RequestError('bad Content-Length')
+                        raise RequestError(f'bodies are limited to {self.max_body} bytes', 413)
+                    if headers.get('expect', '').lower() == '100-continue':
+                        writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+                    body = await reader.readexactly(length) if length else b''
+                    self.requests += 1
+                    status, payload = await self._respond(method, target, body)
+                except RequestError as e:
+                    status, payload = e.status, {'error': str(e)}
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except Exception as e:
+                    status, payload = 500, {'error': f'{type(e).__name__}: {e}'}
+                await self._send(writer, status, payload, keep_alive)
+                if target.startswith('/convert'):
+                    self._request_latencies.append((time.perf_counter() - started) * 1000)
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def _serve(args):
+    server = ConversionServer(args.jobs, args.max_queue,
+                              None if args.no_cache else args.cache_dir)
+    listener = await server.serve(args.host, args.port, args.unix)
+    where = args.unix or f'http://{args.host}:{args.port}'
+    print(f'Converting on {where} with {server.workers} workers; press Ctrl+C to stop',
+          flush=True)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.close()
+
+
+def main(argv=None):
+    from conversion_cache import default_cache_dir
+
+    parser = argparse.ArgumentParser(
+        description='Serve shader conversions to local clients over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='port to listen on (default: %(default)s)')
+    parser.add_argument('--unix', metavar='PATH',
+                        help='listen on this Unix socket instead of TCP')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--max-queue', type=int, default=None,
+                        help='shaders waiting before requests are refused '
+                             '(default: 64 per worker)')
+    parser.add_argument('--cache-dir', default=default_cache_dir(),
+                        help='conversion cache directory (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='keep the conversion cache in memory only')
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,438 @@
+from collections import namedtuple
+
+from glsl_lexer import IDENT, PREPROC, directive_line_end
+
+
+# How an identifier is used
+READ = 'read'
+ASSIGN = 'assign'
+COMPOUND_ASSIGN = 'compound-assign'
+INCREMENT = 'increment'
+LOOP_CONDITION = 'loop-condition'
+
+# What a declaration introduces
+VARIABLE = 'variable'
+PARAMETER = 'parameter'
+MEMBER = 'member'
+
+BUILTIN_TYPES = frozenset((
+    'void', 'bool', 'int', 'uint', 'float', 'double',
+    'vec2', 'vec3', 'vec4', 'ivec2', 'ivec3', 'ivec4',
+    'uvec2', 'uvec3', 'uvec4', 'bvec2', 'bvec3', 'bvec4',
+    'mat2', 'mat3', 'mat4', 'mat2x2', 'mat2x3', 'mat2x4',
+    'mat3x2', 'mat3x3', 'mat3x4', 'mat4x2', 'mat4x3', 'mat4x4',
+    'sampler2D', 'sampler3D', 'samplerCube', 'sampler2DArray',
+))
+
+QUALIFIERS = frozenset((
+    'const', 'uniform', 'in', 'out', 'inout', 'varying', 'attribute',
+    'highp', 'mediump', 'lowp', 'flat', 'smooth', 'centroid', 'invariant',
+))
+
+KEYWORDS = frozenset((
+    'if', 'else', 'for', 'while', 'do', 'return', 'break', 'continue',
+    'discard', 'switch', 'case', 'default', 'struct', 'true', 'false',
+    'precision',
+)) | QUALIFIERS
+
+# Brackets that decide whether a read inside them is a loop condition
+_DECIDING_ROLES = frozenset(('while', 'for', 'params', 'function', 'block'))
+
+_COMPOUND_OPERATORS = frozenset((
+    '+=', '-=', '*=', '/=', '%=', '<<=', '>>=', '&=', '|=', '^=',
+))
+
+
+class Scope:
+    """A lexical scope: global, function, for, block or struct"""
+
+    __slots__ = ('kind', 'parent', 'function', 'names', '_inherited')
+
+    def __init__(self, kind, parent=None, function=None):
+        self.kind = kind
+        self.parent = parent
+        self.function = function if function is not None else (parent and parent.function)
+        self.names = {}
+        self._inherited = {}
+
+    def lookup(self, name):
+        scope = self
+        while scope is not None:
+            decl = scope.names.get(name)
+            if decl is not None:
+                return decl
+            scope = scope.parent
+        return None
+
+    def _resolve(self, name):
+        """lookup() for use while the scopes are being built
+
+        Declarations only ever go into the innermost open scope, so what a
+        scope sees of its enclosing scopes cannot change while it is open
+        and is remembered; deeply nested scopes then resolve in constant
+        time.  Only valid until the scope is closed.
+        """
+        visited = []
+        scope = self
+        decl = None
+        while scope is not None:
+            decl = scope.names.get(name)
+            if decl is not None:
+                break
+            if name in scope._inherited:
+                decl = scope._inherited[name]
+                break
+            visited.append(scope)
+            scope = scope.parent
+        for scope in visited:
+            scope._inherited[name] = decl
+        return decl
+
+    def encloses(self, other):
+        """True when other is this scope or nested inside it"""
+        while other is not None:
+            if other is self:
+                return True
+            other = other.parent
+        return False
+
+    def __repr__(self):
+        if self.function:
+            return f'<Scope {self.kind} in {self.function}>'
+        return f'<Scope {self.kind}>'
+
+
+Declaration = namedtuple(
+    'Declaration', 'name type scope token index role qualifiers initialized array')
+
+# index is the position of the use in stream.code; for plain assignments end
+# is the position of the end of the statement, where the write takes effect
+Usage = namedtuple('Usage', 'name scope kind token index end declaration')
+
+
+class UsageIndex:
+    """Identifier -> uses, with every use resolved to its declaration"""
+
+    def __init__(self):
+        self.declarations = []
+        self.uses = {}
+        self.macro_identifiers = set()
+        self._by_declaration = {}
+
+    def add_declaration(self, decl):
+        self.declarations.append(decl)
+        self._by_declaration[decl] = []
+
+    def add_use(self, use):
+        self.uses.setdefault(use.name, []).append(use)
+        if use.declaration is not None:
+            self._by_declaration[use.declaration].append(use)
+
+    def uses_of(self, decl):
+        """Uses that resolve to decl, in source order"""
+        return self._by_declaration.get(decl, [])
+
+    def used_names(self):
+        return set(self.uses) | self.macro_identifiers
+
+
+def build_usage_index(stream):
+    """Return the usage index for a token stream, built once per stream"""
+    return stream.derived('usage-index', _build_usage_index)
+
+
+def _statement_end(code, i, ends):
+    """Index of the ';' (or unmatched closing bracket) ending the statement at i
+
+    Bracketed groups are jumped over and every position passed on the way
+    is remembered in ends, so however many assignments a statement chains
+    together, finding where they all take effect costs linear time.
+    """
+    count = len(code)
+    visited = []
+    j = i
+    while j < count and j not in ends:
+        text = code[j].text
+        if text == ';' or text in (')', ']', '}'):
+            break
+        visited.append(j)
+        if text in ('(', '[', '{'):
+            close = code.matching(j)
+            if close is None:
+                j = count
+                break
+            j = close
+        j += 1
+    end = ends.get(j, j)
+    for j in visited:
+        ends[j] = end
+    return end
+
+
+def _build_usage_index(stream):
+    code = stream.code
+    source = stream.source
+    count = len(code)
+    index = UsageIndex()
+
+    # Directive lines are not part of the scope structure; remember which
+    # identifiers they mention so callers can stay conservative about them
+    in_directive = [False] * count
+    types = set(BUILTIN_TYPES)
+    i = 0
+    while i < count:
+        tok = code[i]
+        if tok.kind == PREPROC:
+            line_end = directive_line_end(source, tok.start)
+            while i < count and code[i].start < line_end:
+                in_directive[i] = True
+                if code[i].kind == IDENT:
+                    index.macro_identifiers.add(code[i].text)
+                i += 1
+            continue
+        if tok.text == 'struct' and i + 1 < count and code[i + 1].kind == IDENT:
+            types.add(code[i + 1].text)
+        elif (tok.kind == IDENT and tok.text not in KEYWORDS and i + 1 < count
+              and code[i + 1].kind == IDENT and code[i + 1].text not in KEYWORDS):
+            # Two names in a row are a type and a declarator, which also
+            # covers structs declared in code that is not part of this stream
+            types.add(tok.text)
+        i += 1
+
+    scope = Scope('global')
+    # Open brackets: [text, role, scope to restore on close, extra, decider],
+    # where decider is the stack index of the innermost bracket that decides
+    # whether a read is a loop condition
+    stack = []
+
+    def open_bracket(text, role, restore):
+        if role in _DECIDING_ROLES:
+            decider = len(stack)
+        else:
+            decider = stack[-1][4] if stack else None
+        stack.append([text, role, restore, 0, decider])
+
+    declaring = None        # (type, qualifiers, role, depth) of the current declaration
+    declarator_at = -1      # code index of the next declarator name
+    function_body = False   # next '{' is the body of the function whose params are open
+    for_body = False        # next '{' is the body of a for loop
+    statement_scopes = []   # (depth, scope to restore) of brace-less loop and branch bodies
+    declaring_single = None # (type, qualifiers, role) of the parameter being declared
+    statement_ends = {}
+
+    for i in range(count):
+        if in_directive[i]:
+            continue
+        tok = code[i]
+        text = tok.text
+        prev = code[i - 1].text if i else ''
+        nxt = code[i + 1].text if i + 1 < count else ''
+
+        if text == '(':
+            if prev == 'for':
+                open_bracket('(', 'for', scope)
+                scope = Scope('for', scope)
+            elif prev in ('while', 'if'):
+                open_bracket('(', prev, scope)
+            elif (i >= 2 and code[i - 1].kind == IDENT and code[i - 2].text in types
+                  and scope.kind == 'global' and not stack):
+                open_bracket('(', 'params', scope)
+                scope = Scope('function', scope, function=code[i - 1].text)
+            else:
+                open_bracket('(', 'group', scope)
+            continue
+
+        if text == '[':
+            open_bracket('[', 'index', scope)
+            continue
+
+        if text == '{':
+            if function_body:
+                open_bracket('{', 'function', scope.parent)
+            elif for_body:
+                open_bracket('{', 'for', scope.parent)
+                scope = Scope('block', scope)
+            elif prev == 'struct' or (i >= 2 and code[i - 2].text == 'struct'):
+                open_bracket('{', 'struct', scope)
+                scope = Scope('struct', scope)
+            else:
+                open_bracket('{', 'block', scope)
+                scope = Scope('block', scope)
+            function_body = for_body = False
+            continue
+
+        if text in (')', ']', '}'):
+            if not stack:
+                continue
+            _, role, restore, _, _ = stack.pop()
+            if declaring is not None and len(stack) < declaring[3]:
+                declaring = None
+            if text == ')':
+                if role == 'params':
+                    if nxt == '{':
+                        function_body = True
+                    else:
+                        scope = restore
+                elif role == 'for':
+                    if nxt == '{':
+                        for_body = True
+                    else:
+                        statement_scopes.append((len(stack), restore))
+                elif role in ('if', 'while') and nxt != '{':
+                    statement_scopes.append((len(stack), scope))
+                    scope = Scope('block', scope)
+            elif text == '}':
+                scope = restore
+                while statement_scopes and statement_scopes[-1][0] == len(stack) and nxt != 'else':
+                    scope = statement_scopes.pop()[1]
+            continue
+
+        if text == ';':
+            if stack and stack[-1][1] == 'for':
+                stack[-1][3] += 1
+            if declaring is not None and len(stack) == declaring[3]:
+                declaring = None
+            while statement_scopes and statement_scopes[-1][0] == len(stack):
+                scope = statement_scopes.pop()[1]
+            continue
+
+        if text == 'else' and nxt not in ('{', 'if'):
+            statement_scopes.append((len(stack), scope))
+            scope = Scope('block', scope)
+            continue
+
+        if text == ',' and declaring is not None and len(stack) == declaring[3]:
+            if i + 1 < count and code[i + 1].kind == IDENT and code[i + 1].text not in types:
+                declarator_at = i + 1
+            continue
+
+        if tok.kind != IDENT:
+            continue
+
+        if text in types:
+            # A type followed by a name that is not a function is a declaration
+            if (i + 1 < count and code[i + 1].kind == IDENT and code[i + 1].text not in types
+                    and code[i + 1].text not in KEYWORDS
+                    and not (i + 2 < count and code[i + 2].text == '(')):
+                qualifiers = []
+                j = i - 1
+                while j >= 0 and code[j].text in QUALIFIERS:
+                    qualifiers.append(code[j].text)
+                    j -= 1
+                in_params = bool(stack) and stack[-1][1] == 'params'
+                role = PARAMETER if in_params else MEMBER if scope.kind == 'struct' else VARIABLE
+                declaring = None if in_params else (text, tuple(qualifiers), role, len(stack))
+                if in_params:
+                    declaring_single = (text, tuple(qualifiers), role)
+                declarator_at = i + 1
+            continue
+
+        if i == declarator_at:
+            decl_type, qualifiers, role = (declaring[:3] if declaring is not None
+                                           else declaring_single)
+            decl = Declaration(text, decl_type, scope, tok, i, role, qualifiers,
+                               nxt == '=', nxt == '[')
+            scope.names[text] = decl
+            index.add_declaration(decl)
+            continue
+
+        if text in KEYWORDS or prev == '.' or nxt == '(':
+            continue
+
+        # Classify the use
+        end = i
+        if nxt in ('++', '--') or prev in ('++', '--'):
+            kind = INCREMENT
+        elif nxt in _COMPOUND_OPERATORS:
+            kind = COMPOUND_ASSIGN
+        elif nxt == '=':
+            kind = ASSIGN
+            end = _statement_end(code, i, statement_ends)
+        else:
+            kind = READ
+            if stack and stack[-1][4] is not None:
+                _, role, _, section, _ = stack[stack[-1][4]]
+                if role == 'while' or (role == 'for' and section == 1):
+                    kind = LOOP_CONDITION
+        index.add_use(Usage(text, scope, kind, tok, i, end, scope._resolve(text)))
+
+    return index
+
+
+# Qualifiers of globals that belong to the shader's interface with the
+# pipeline, so they stay even when the shader never mentions them
+_INTERFACE_QUALIFIERS = frozenset((
+    'in', 'out', 'inout', 'varying', 'attribute', 'invariant', 'flat', 'smooth', 'centroid',
+))
+
+# What a top-level unit (see split_top_level_units) gives meaning to: the
+# names it defines, whether it must stay however little is used (entry
+# point, interface, directives other than #define, anything not
+# understood), and whether it is a macro that pastes tokens into names
+# that appear nowhere in the source
+UnitSymbols = namedtuple('UnitSymbols', 'defines root pastes')
+
+_ROOT_UNIT = UnitSymbols(frozenset(), True, False)
+
+
+def unit_symbols(stream):
+    """UnitSymbols of the token stream of one top-level unit, computed once per stream"""
+    return stream.derived('unit-symbols', _unit_symbols)
+
+
+def _unit_symbols(stream):
+    code = stream.code
+    count = len(code)
+    if not count:
+        return _ROOT_UNIT
+    if code[0].kind == PREPROC:
+        if code[0].text[1:].strip() != 'define' or count < 2 or code[1].kind != IDENT:
+            return _ROOT_UNIT
+        pastes = any(tok.text == '#' for tok in code[2:])
+        return UnitSymbols(frozenset((code[1].text,)), pastes, pastes)
+
+    i = 0
+    while i < count and code[i].text in QUALIFIERS:
+        if code[i].text in _INTERFACE_QUALIFIERS:
+            return _ROOT_UNIT
+        i += 1
+    names = set()
+    if i + 2 < count and code[i].text == 'struct':
+        if code[i + 1].kind != IDENT or code[i + 2].text != '{':
+            return _ROOT_UNIT
+        names.add(code[i + 1].text)
+        i = code.matching(i + 2)
+        if i is None:
+            return _ROOT_UNIT
+        if i + 2 == count and code[i + 1].text == ';':
+            return UnitSymbols(frozenset(names), False, False)
+    elif i >= count or code[i].kind != IDENT or code[i].text in KEYWORDS:
+        return _ROOT_UNIT
+    i += 1
+    if i < count and code[i].text == '[':
+        i = code.matching(i)
+        if i is None:
+            return _ROOT_UNIT
+        i += 1
+
+    # Declarators, or the name of a function
+    while i < count:
+        tok = code[i]
+        if tok.kind != IDENT or tok.text in KEYWORDS:
+            return _ROOT_UNIT
+        if i + 1 < count and code[i + 1].text == '(':
+            if names:
+                return _ROOT_UNIT
+            return UnitSymbols(frozenset((tok.text,)), tok.text == 'main', False)
+        names.add(tok.text)
+        i += 1
+        while i < count and code[i].text not in (',', ';'):
+            if code[i].text in ('(', '[', '{'):
+                i = code.matching(i)
+                if i is None:
+                    return _ROOT_UNIT
+            i += 1
+        if i + 1 == count and code[i].text == ';':
+            return UnitSymbols(frozenset(names), False, False)
+        i += 1
+    return _ROOT_UNIT
@@ -0,0 +1,1344 @@
+import math
+import re
+from collections import namedtuple
+
+from glsl_analysis import BUILTIN_TYPES, KEYWORDS, QUALIFIERS
+from glsl_lexer import (IDENT, NUMBER, PREPROC, RewriteBuffer, directive_line_end, lex_glsl,
+                        matching_bracket, split_arguments)
+
+
+# Expression nodes.  first and stop delimit the node in stream.code (stop is
+# exclusive, parentheses around the node are not part of it); nodes built
+# by an optimization have neither.
+Literal = namedtuple('Literal', 'text first stop', defaults=(None, None))
+Name = namedtuple('Name', 'name first stop', defaults=(None, None))
+Call = namedtuple('Call', 'name args first stop', defaults=(None, None))
+Unary = namedtuple('Unary', 'op operand first stop', defaults=(None, None))
+Postfix = namedtuple('Postfix', 'op operand first stop', defaults=(None, None))
+Binary = namedtuple('Binary', 'op left right first stop', defaults=(None, None))
+Conditional = namedtuple('Conditional', 'condition then otherwise first stop',
+                         defaults=(None, None))
+Assign = namedtuple('Assign', 'op target value first stop', defaults=(None, None))
+Member = namedtuple('Member', 'value field first stop', defaults=(None, None))
+Index = namedtuple('Index', 'value index first stop', defaults=(None, None))
+
+# Fields holding sub-expressions; Call.args is a tuple of them
+_CHILDREN = {
+    Literal: (), Name: (), Call: ('args',), Unary: ('operand',), Postfix: ('operand',),
+    Binary: ('left', 'right'), Conditional: ('condition', 'then', 'otherwise'),
+    Assign: ('target', 'value'), Member: ('value',), Index: ('value', 'index'),
+}
+
+# Operator precedence, loosest first
+ASSIGNMENT = 2
+CONDITIONAL = 3
+UNARY = 15
+POSTFIX = 16
+PRIMARY = 17
+
+BINARY_PRECEDENCE = {
+    '||': 4, '^^': 5, '&&': 6, '|': 7, '^': 8, '&': 9, '==': 10, '!=': 10,
+    '<': 11, '>': 11, '<=': 11, '>=': 11, '<<': 12, '>>': 12,
+    '+': 13, '-': 13, '*': 14, '/': 14, '%': 14,
+}
+
+ASSIGN_OPERATORS = frozenset((
+    '=', '+=', '-=', '*=', '/=', '%=', '<<=', '>>=', '&=', '|=', '^=',
+))
+
+_PREFIX_OPERATORS = frozenset(('-', '+', '!', '~', '++', '--'))
+
+# Built-in functions without side effects; calls to anything else may
+# write globals or out parameters
+PURE_FUNCTIONS = frozenset((
+    'radians', 'degrees', 'sin', 'cos', 'tan', 'asin', 'acos', 'atan',
+    'sinh', 'cosh', 'tanh', 'asinh', 'acosh', 'atanh',
+    'pow', 'exp', 'log', 'exp2', 'log2', 'sqrt', 'inversesqrt',
+    'abs', 'sign', 'floor', 'ceil', 'trunc', 'round', 'roundEven', 'fract', 'mod',
+    'min', 'max', 'clamp', 'mix', 'step', 'smoothstep',
+    'length', 'distance', 'dot', 'cross', 'normalize', 'faceforward', 'reflect', 'refract',
+    'matrixCompMult', 'outerProduct', 'transpose', 'determinant', 'inverse',
+    'lessThan', 'lessThanEqual', 'greaterThan', 'greaterThanEqual', 'equal', 'notEqual',
+    'any', 'all', 'not', 'dFdx', 'dFdy', 'fwidth',
+)) | frozenset((
+    'texture', 'texture2D', 'texture2DLod', 'texture2DProj', 'texture3D', 'textureCube',
+    'textureCubeLod', 'textureLod', 'textureGrad', 'textureProj', 'texelFetch',
+))
+
+TEXTURE_FUNCTIONS = frozenset(name for name in PURE_FUNCTIONS if name.startswith('tex'))
+
+# Shader inputs that can be read anywhere and are never written
+BUILTIN_INPUTS = {'gl_FragCoord': 'vec4', 'gl_FrontFacing': 'bool', 'gl_PointCoord': 'vec2'}
+
+
+class _Unparsable(Exception):
+    pass
+
+
+# Expressions nested deeper than this are left alone, which keeps the
+# recursive passes well inside Python's recursion limit
+_MAX_NESTING = 64
+
+
+class _Parser:
+    """Precedence-climbing parser over code[first:stop]"""
+
+    def __init__(self, code, nodes):
+        self.code = code
+        self.nodes = nodes
+        self.pos = 0
+        self.stop = 0
+        self.nesting = 0
+
+    def parse(self, first, stop):
+        saved = self.pos, self.stop
+        self.pos, self.stop = first, stop
+        node = self.expression(ASSIGNMENT)
+        if self.pos != stop:
+            raise _Unparsable
+        self.pos, self.stop = saved
+        return node
+
+    def peek(self):
+        return self.code[self.pos].text if self.pos < self.stop else ''
+
+    def node(self, node):
+        self.nodes[node.first, node.stop] = node
+        return node
+
+    def closing(self, index):
+        close = matching_bracket(self.code, index)
+        if close is None or close >= self.stop:
+            raise _Unparsable
+        return close
+
+    def expression(self, min_precedence):
+        first = self.pos
+        self.nesting += 1
+        if self.nesting > _MAX_NESTING:
+            raise _Unparsable
+        try:
+            return self._operators(first, self.unary(), min_precedence)
+        finally:
+            self.nesting -= 1
+
+    def _operators(self, first, left, min_precedence):
+        while True:
+            op = self.peek()
+            if op in ASSIGN_OPERATORS and min_precedence <= ASSIGNMENT:
+                self.pos += 1
+                value = self.expression(ASSIGNMENT)
+                left = self.node(Assign(op, left, value, first, self.pos))
+            elif op == '?' and min_precedence <= CONDITIONAL:
+                self.pos += 1
+                then = self.expression(ASSIGNMENT)
+                if self.peek() != ':':
+                    raise _Unparsable
+                self.pos += 1
+                otherwise = self.expression(ASSIGNMENT)
+                left = self.node(Conditional(left, then, otherwise, first, self.pos))
+            else:
+                precedence = BINARY_PRECEDENCE.get(op)
+                if precedence is None or precedence < min_precedence:
+                    return left
+                self.pos += 1
+                right = self.expression(precedence + 1)
+                left = self.node(Binary(op, left, right, first, self.pos))
+
+    def unary(self):
+        first = self.pos
+        op = self.peek()
+        if op in _PREFIX_OPERATORS:
+            self.pos += 1
+            self.nesting += 1
+            if self.nesting > _MAX_NESTING:
+                raise _Unparsable
+            try:
+                operand = self.unary()
+            finally:
+                self.nesting -= 1
+            return self.node(Unary(op, operand, first, self.pos))
+        node = self.primary()
+        while True:
+            op = self.peek()
+            if op == '.':
+                if self.pos + 1 >= self.stop or self.code[self.pos + 1].kind != IDENT:
+                    raise _Unparsable
+                self.pos += 2
+                node = self.node(Member(node, self.code[self.pos - 1].text, first, self.pos))
+            elif op == '[':
+                close = self.closing(self.pos)
+                index = self.parse(self.pos + 1, close)
+                self.pos = close + 1
+                node = self.node(Index(node, index, first, self.pos))
+            elif op in ('++', '--'):
+                self.pos += 1
+                node = self.node(Postfix(op, node, first, self.pos))
+            else:
+                return node
+
+    def primary(self):
+        if self.pos >= self.stop:
+            raise _Unparsable
+        first = self.pos
+        tok = self.code[first]
+        if tok.kind == NUMBER or tok.text in ('true', 'false'):
+            self.pos += 1
+            return self.node(Literal(tok.text, first, self.pos))
+        if tok.kind == IDENT and tok.text not in KEYWORDS:
+            if self.peek_next() != '(':
+                self.pos += 1
+                return self.node(Name(tok.text, first, self.pos))
+            ranges, close = split_arguments(self.code, first + 1)
+            if close is None or close >= self.stop:
+                raise _Unparsable
+            args = tuple(self.parse(arg_first, arg_stop) for arg_first, arg_stop in ranges)
+            self.pos = close + 1
+            return self.node(Call(tok.text, args, first, self.pos))
+        if tok.text == '(':
+            close = self.closing(first)
+            node = self.parse(first + 1, close)
+            self.pos = close + 1
+            return node
+        raise _Unparsable
+
+    def peek_next(self):
+        return self.code[self.pos + 1].text if self.pos + 1 < self.stop else ''
+
+
+def parse_expression(code, first, stop, nodes=None):
+    """Expression tree for code[first:stop], or None when it is not one expression
+
+    nodes, when given, receives every parsed node keyed by its (first, stop).
+    A top-level comma sequence is not an expression here.
+    """
+    try:
+        return _Parser(code, {} if nodes is None else nodes).parse(first, stop)
+    except _Unparsable:
+        return None
+
+
+def precedence(node):
+    kind = type(node)
+    if kind is Binary:
+        return BINARY_PRECEDENCE[node.op]
+    if kind is Literal:
+        return UNARY if node.text.startswith('-') else PRIMARY
+    if kind in (Name, Call):
+        return PRIMARY
+    if kind in (Member, Index, Postfix):
+        return POSTFIX
+    if kind is Unary:
+        return UNARY
+    if kind is Conditional:
+        return CONDITIONAL
+    return ASSIGNMENT
+
+
+def _child_precedences(node):
+    """Loosest precedence each child may have without parentheses"""
+    kind = type(node)
+    if kind is Binary:
+        own = BINARY_PRECEDENCE[node.op]
+        return (own, own + 1)
+    if kind is Call:
+        return (ASSIGNMENT,)
+    if kind in (Unary, Postfix):
+        return (UNARY if kind is Unary else POSTFIX,)
+    if kind is Member:
+        return (POSTFIX,)
+    if kind is Index:
+        return (POSTFIX, 0)
+    if kind is Conditional:
+        return (CONDITIONAL + 1, ASSIGNMENT, ASSIGNMENT)
+    return (UNARY, ASSIGNMENT)
+
+
+def map_children(node, function):
+    """node with function applied to every child, or node itself if none changed"""
+    fields = _CHILDREN[type(node)]
+    if not fields:
+        return node
+    changes = {}
+    for field in fields:
+        value = getattr(node, field)
+        if field == 'args':
+            new = tuple(function(arg) for arg in value)
+            if any(a is not b for a, b in zip(new, value)):
+                changes[field] = new
+        else:
+            new = function(value)
+            if new is not value:
+                changes[field] = new
+    return node._replace(**changes) if changes else node
+
+
+def walk(node):
+    """node and every expression nested in it, parents first"""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        for field in reversed(_CHILDREN[type(node)]):
+            value = getattr(node, field)
+            if field == 'args':
+                stack.extend(reversed(value))
+            else:
+                stack.append(value)
+
+
+_FLOAT_LITERAL_RE = re.compile(r'(?:\d+\.\d*|\.\d+|\d+(?=[eE]))(?:[eE][+-]?\d+)?[fF]?\Z')
+_INT_LITERAL_RE = re.compile(r'(?:0|[1-9]\d*)\Z')
+
+
+def constant_value(node):
+    """(value, is_float) for a numeric literal, optionally negated, else None"""
+    sign = 1
+    if type(node) is Unary and node.op in ('-', '+'):
+        sign = -1 if node.op == '-' else 1
+        node = node.operand
+    if type(node) is not Literal:
+        return None
+    text = node.text
+    if text.startswith('-'):
+        sign = -sign
+        text = text[1:]
+    if _FLOAT_LITERAL_RE.match(text):
+        return sign * float(text.rstrip('fF')), True
+    if _INT_LITERAL_RE.match(text):
+        return sign * int(text), False
+    return None
+
+
+def literal(value, is_float=True):
+    """Literal for a number, or None when GLSL cannot spell it"""
+    if not is_float:
+        if not -2 ** 31 <= value < 2 ** 31:
+            return None
+        return Literal(str(value))
+    if not math.isfinite(value):
+        return None
+    # Nine significant digits are enough to round-trip a 32-bit float
+    text = '%.9g' % value
+    if '.' not in text and 'e' not in text:
+        text += '.0'
+    return Literal(text)
+
+
+def _float_arguments(args):
+    values = []
+    for arg in args:
+        constant = constant_value(arg)
+        if constant is None or not constant[1]:
+            return None
+        values.append(constant[0])
+    return values
+
+
+def _fold_call(name, values):
+    if name in _FOLDABLE_CALLS and len(values) == _FOLDABLE_CALLS[name][0]:
+        try:
+            return _FOLDABLE_CALLS[name][1](*values)
+        except (ValueError, OverflowError):
+            return None
+    return None
+
+
+_FOLDABLE_CALLS = {
+    'radians': (1, math.radians), 'degrees': (1, math.degrees),
+    'sin': (1, math.sin), 'cos': (1, math.cos), 'exp': (1, math.exp), 'exp2': (1, math.exp2),
+    'sqrt': (1, math.sqrt), 'abs': (1, abs), 'floor': (1, math.floor), 'ceil': (1, math.ceil),
+    'fract': (1, lambda x: x - math.floor(x)), 'min': (2, min), 'max': (2, max),
+    'pow': (2, lambda x, y: x ** y if x > 0 else math.nan),
+}
+
+
+_COMPARISONS = {
+    '<': lambda a, b: a < b, '>': lambda a, b: a > b, '<=': lambda a, b: a <= b,
+    '>=': lambda a, b: a >= b, '==': lambda a, b: a == b, '!=': lambda a, b: a != b,
+}
+
+
+def boolean_value(node):
+    """True or False for a true or false literal, else None"""
+    if type(node) is Literal and node.text in ('true', 'false'):
+        return node.text == 'true'
+    return None
+
+
+def _fold_binary(op, left, right):
+    if left[1] != right[1]:
+        return None
+    if op in _COMPARISONS:
+        return Literal('true' if _COMPARISONS[op](left[0], right[0]) else 'false')
+    if op not in ('+', '-', '*', '/'):
+        return None
+    a, b = left[0], right[0]
+    if op == '+':
+        value = a + b
+    elif op == '-':
+        value = a - b
+    elif op == '*':
+        value = a * b
+    elif b == 0:
+        return None
+    elif left[1]:
+        value = a / b
+    else:
+        # GLSL integer division truncates towards zero
+        value = abs(a) // abs(b) * (1 if (a < 0) == (b < 0) else -1)
+    return literal(value, left[1])
+
+
+def _fold_logic(node):
+    """node with a true or false literal operand of &&, || or ?: taken into account"""
+    kind = type(node)
+    if kind is Conditional:
+        condition = boolean_value(node.condition)
+        if condition is not None:
+            return node.then if condition else node.otherwise
+        return node
+    if kind is Unary:
+        operand = boolean_value(node.operand)
+        if node.op == '!' and operand is not None:
+            return Literal('false' if operand else 'true')
+        return node
+    left = boolean_value(node.left)
+    right = boolean_value(node.right)
+    if node.op == '&&':
+        # The right operand is only evaluated when the left one is true
+        if left is not None:
+            return node.right if left else node.left
+        if right is True:
+            return node.left
+    elif node.op == '||':
+        if left is not None:
+            return node.left if left else node.right
+        if right is False:
+            return node.left
+    return node
+
+
+def _fold_swizzle(node):
+    """Components picked out of a constructor of literals, e.g. vec2(1.0, 2.0).y"""
+    value = node.value
+    if (type(value) is not Call or value.name not in BUILTIN_TYPES
+            or not value.name.endswith(('vec2', 'vec3', 'vec4')) or not node.field.isalpha()):
+        return node
+    size = int(value.name[-1])
+    args = value.args
+    if len(args) == 1 and type(args[0]) is Literal:
+        args = args * size
+    if len(args) != size or any(type(arg) is not Literal and constant_value(arg) is None
+                                for arg in args):
+        return node
+    for letters in ('xyzw', 'rgba', 'stpq'):
+        if all(letter in letters[:size] for letter in node.field):
+            picked = tuple(args[letters.index(letter)] for letter in node.field)
+            break
+    else:
+        return node
+    if len(picked) == 1:
+        return picked[0]
+    return Call(value.name[:-1] + str(len(picked)), picked)
+
+
+def fold_constants(node):
+    """node with arithmetic on literals evaluated, and x * 1.0, x + 0.0 and x / 1.0 reduced to x
+
+    Floating point results are computed in double precision and written
+    with the nine significant digits a 32-bit float can hold.  Integer and
+    float literals are never mixed, as GLSL ES does not convert between them.
+    Comparisons of literals become true or false, which in turn settle
+    &&, || and ?:, and swizzles of constructors of literals pick their
+    components.
+    """
+    node = map_children(node, fold_constants)
+    kind = type(node)
+    if kind is Conditional or (kind is Binary and node.op in ('&&', '||')) or (
+            kind is Unary and node.op == '!'):
+        return _fold_logic(node)
+    if kind is Member:
+        return _fold_swizzle(node)
+    if kind is Binary:
+        left = constant_value(node.left)
+        right = constant_value(node.right)
+        if left is not None and right is not None:
+            return _fold_binary(node.op, left, right) or node
+        if right is not None and (
+                (right[0] == 0 and node.op in ('+', '-'))
+                or (right[0] == 1 and node.op in ('*', '/'))):
+            return node.left
+        if left is not None and (
+                (left[0] == 0 and node.op == '+') or (left[0] == 1 and node.op == '*')):
+            return node.right
+    elif kind is Call and node.args:
+        values = _float_arguments(node.args)
+        if values is not None:
+            value = _fold_call(node.name, values)
+            if value is not None:
+                return literal(float(value)) or node
+    return node
+
+
+def duplicable(node, is_safe_name):
+    """Whether node can be written out twice without computing more
+
+    Only literals, and names (with swizzles or constant indices) accepted
+    by is_safe_name; names from macros could expand to anything.
+    """
+    kind = type(node)
+    if kind is Literal:
+        return True
+    if kind is Name:
+        return is_safe_name(node.name)
+    if kind is Member:
+        return duplicable(node.value, is_safe_name)
+    if kind is Index:
+        return duplicable(node.value, is_safe_name) and type(node.index) is Literal
+    return False
+
+
+def _product(operand, times):
+    node = operand
+    for _ in range(times - 1):
+        node = Binary('*', node, operand)
+    return node
+
+
+def reduce_strength(node, is_safe_name=lambda name: True):
+    """node with costly operations replaced by cheaper exact equivalents
+
+    - pow(x, n) with n = 2, 3 or 4 becomes x * x ..., n = -1 or -2 becomes
+      1.0 / x or 1.0 / (x * x), n = 1 becomes x and n = 0.5 becomes sqrt(x);
+      GLSL leaves pow() undefined for x < 0, so nothing defined changes.
+      Only operands that duplicable() accepts are repeated.
+    - x / c becomes x * (1.0 / c) for a float literal c.
+    - mix(a, b, 0.5) becomes (a + b) * 0.5.
+    """
+    node = map_children(node, lambda child: reduce_strength(child, is_safe_name))
+    kind = type(node)
+    if kind is Call and node.name == 'pow' and len(node.args) == 2:
+        base, exponent = node.args
+        constant = constant_value(exponent)
+        if constant is None or not constant[1]:
+            return node
+        power = constant[0]
+        if power == 1:
+            return base
+        if power == 0.5:
+            return Call('sqrt', (base,))
+        if power == -1:
+            return Binary('/', Literal('1.0'), base)
+        if power in (2, 3, 4) and duplicable(base, is_safe_name):
+            return _product(base, int(power))
+        if power == -2 and duplicable(base, is_safe_name):
+            return Binary('/', Literal('1.0'), _product(base, 2))
+    elif kind is Call and node.name == 'mix' and len(node.args) == 3:
+        constant = constant_value(node.args[2])
+        if constant == (0.5, True):
+            return Binary('*', Binary('+', node.args[0], node.args[1]), Literal('0.5'))
+    elif kind is Binary and node.op == '/':
+        constant = constant_value(node.right)
+        if constant is not None and constant[1] and constant[0] not in (0, 1):
+            reciprocal = literal(1 / constant[0])
+            if reciprocal is not None:
+                return Binary('*', node.left, reciprocal)
+    return node
+
+
+def _element_type(type_name):
+    for prefix, element in (('ivec', 'int'), ('uvec', 'uint'), ('bvec', 'bool'),
+                            ('vec', 'float')):
+        if type_name.startswith(prefix):
+            return prefix, element
+    return None, None
+
+
+def _arithmetic_type(op, left, right):
+    if op in ('==', '!=', '<', '>', '<=', '>=', '&&', '||', '^^'):
+        return 'bool'
+    if left is None or right is None or op not in ('+', '-', '*', '/'):
+        return None
+    if left == right:
+        return left
+    if _element_type(right)[1] == left:
+        return right
+    if _element_type(left)[1] == right:
+        return left
+    if left == 'float' and right.startswith('mat'):
+        return right
+    if right == 'float' and left.startswith('mat'):
+        return left
+    if op == '*' and left.startswith('mat') and right.startswith('vec'):
+        return 'vec' + left[-1]
+    if op == '*' and left.startswith('vec') and right.startswith('mat'):
+        return 'vec' + right[3]
+    return None
+
+
+def infer_type(node, types):
+    """GLSL type of node given types (name -> type, arrays as 'float[]'), or None"""
+    kind = type(node)
+    if kind is Literal:
+        if node.text in ('true', 'false'):
+            return 'bool'
+        constant = constant_value(node)
+        if constant is None:
+            return 'uint' if node.text.endswith(('u', 'U')) else None
+        return 'float' if constant[1] else 'int'
+    if kind is Name:
+        return types.get(node.name)
+    if kind is Unary:
+        return 'bool' if node.op == '!' else infer_type(node.operand, types)
+    if kind is Binary:
+        return _arithmetic_type(node.op, infer_type(node.left, types),
+                                infer_type(node.right, types))
+    if kind is Member:
+        base = infer_type(node.value, types)
+        prefix, element = _element_type(base or '')
+        if prefix is None or not re.fullmatch(r'[xyzw]{1,4}|[rgba]{1,4}|[stpq]{1,4}', node.field):
+            return None
+        return element if len(node.field) == 1 else f'{prefix}{len(node.field)}'
+    if kind is Index:
+        base = infer_type(node.value, types) or ''
+        if base.endswith('[]'):
+            return base[:-2]
+        if base.startswith('mat'):
+            return 'vec' + base[-1]
+        return _element_type(base)[1]
+    if kind is Conditional:
+        then = infer_type(node.then, types)
+        return then if then == infer_type(node.otherwise, types) else None
+    if kind is Call:
+        return _call_type(node, types)
+    return None
+
+
+def _call_type(node, types):
+    name = node.name
+    args = node.args
+    if name in BUILTIN_TYPES:
+        return name if name != 'void' and not name.startswith('sampler') else None
+    if name in TEXTURE_FUNCTIONS:
+        sampler = types.get(args[0].name) if args and type(args[0]) is Name else None
+        return 'vec4' if sampler in ('sampler2D', 'sampler3D', 'samplerCube') else None
+    if name in ('length', 'distance', 'dot', 'determinant'):
+        return 'float'
+    if name == 'cross':
+        return 'vec3'
+    if name not in PURE_FUNCTIONS or not args:
+        return None
+    # The remaining built-ins return the type of their first argument, or
+    # of the last for step() and smoothstep(), whose edges may be scalars
+    if name in ('step', 'smoothstep'):
+        return infer_type(args[-1], types)
+    if name in ('lessThan', 'lessThanEqual', 'greaterThan', 'greaterThanEqual', 'equal',
+                'notEqual', 'any', 'all', 'not', 'outerProduct'):
+        return None
+    return infer_type(args[0], types)
+
+
+def _cost(node, costs):
+    """Rough ALU cost of evaluating node; texture fetches count the most"""
+    key = id(node)
+    cost = costs.get(key)
+    if cost is None:
+        kind = type(node)
+        if kind is Call:
+            own = (16 if node.name in TEXTURE_FUNCTIONS else 1 if node.name in BUILTIN_TYPES
+                   else 4)
+            cost = own + sum(_cost(arg, costs) for arg in node.args)
+        elif kind in (Binary, Unary, Index, Conditional):
+            cost = 1 + sum(_cost(getattr(node, field), costs) for field in _CHILDREN[kind])
+        elif kind is Member:
+            cost = _cost(node.value, costs)
+        else:
+            cost = 0
+        costs[key] = cost
+    return cost
+
+
+def expression_key(node, keys=None):
+    """Hashable structure of node, equal for expressions that compute the same thing"""
+    keys = {} if keys is None else keys
+    key = keys.get(id(node))
+    if key is None:
+        kind = type(node)
+        parts = [kind.__name__]
+        for field in node._fields[:-2]:
+            value = getattr(node, field)
+            if field in _CHILDREN[kind]:
+                if field == 'args':
+                    parts.append(tuple(expression_key(arg, keys) for arg in value))
+                else:
+                    parts.append(expression_key(value, keys))
+            else:
+                parts.append(value)
+        if kind is Literal:
+            parts[1] = constant_value(node) or node.text
+        key = keys[id(node)] = tuple(parts)
+    return key
+
+
+# Smallest _cost() worth keeping in a temporary
+_MIN_SHARED_COST = 2
+
+
+# ancestors holds the ids of the enclosing occurrences of other groups
+_Occurrence = namedtuple('_Occurrence', 'node step ancestors')
+
+
+class _Group:
+    __slots__ = ('key', 'type', 'names', 'cost', 'occurrences')
+
+    def __init__(self, key, type_name, names, cost):
+        self.key = key
+        self.type = type_name
+        self.names = names
+        self.cost = cost
+        self.occurrences = []
+
+
+def _root_name(node):
+    while type(node) in (Member, Index):
+        node = node.value
+    return node.name if type(node) is Name else None
+
+
+def _effects(node):
+    """(name a top-level assignment writes, whether anything else is written,
+    names passed to functions that might write them through out parameters)"""
+    target = None
+    side_effects = False
+    if type(node) is Assign:
+        target = _root_name(node.target)
+        side_effects = target is None
+    passed = set()
+    for part in walk(node):
+        kind = type(part)
+        if kind is Assign and part is not node:
+            side_effects = True
+        elif kind is Postfix or (kind is Unary and part.op in ('++', '--')):
+            side_effects = True
+        elif kind is Call and part.name not in PURE_FUNCTIONS and part.name not in BUILTIN_TYPES:
+            passed.update(_root_name(arg) for arg in part.args)
+    passed.discard(None)
+    return target, side_effects, passed
+
+
+class _Run:
+    """Straight-line statements of one block, searched for shared subexpressions
+
+    Every expression is simplified as it is added.  A group collects the
+    occurrences of one pure expression until a statement writes a name it
+    reads; groups seen at least twice become a temporary declared in front
+    of the statement holding the first occurrence.
+    """
+
+    def __init__(self, optimizer, shared=True):
+        self.optimizer = optimizer
+        self.shared = shared and not optimizer.fold_only
+        self.steps = []          # (original, simplified, statement index)
+        self.live = {}           # key -> _Group
+        self.by_name = {}        # name -> keys of live groups reading it
+        self.closed = []
+        self.keys = {}
+        self.costs = {}
+        self.reads = {}
+
+    def add(self, node, scope, statement, declared=()):
+        optimizer = self.optimizer
+        simplified = optimizer.simplify(node, scope)
+        step = len(self.steps)
+        self.steps.append((node, simplified, statement))
+        if not self.shared:
+            return
+        target, side_effects, passed = _effects(simplified)
+        if side_effects:
+            self.barrier()
+            return
+        self.write(passed)
+        self._collect(simplified, optimizer.types(scope), scope, step, declared)
+        self.write(passed)
+        if target is not None:
+            self.write((target,))
+
+    def _collect(self, node, types, scope, step, declared):
+        stack = [(node, ())]
+        while stack:
+            node, ancestors = stack.pop()
+            kind = type(node)
+            if kind is Conditional:
+                # Only the condition is certain to be evaluated
+                stack.append((node.condition, ancestors))
+                continue
+            if kind is Binary and node.op in ('&&', '||', '^^'):
+                stack.append((node.left, ancestors))
+                continue
+            if kind is Assign:
+                stack.append((node.value, ancestors))
+                target = node.target
+                while type(target) in (Member, Index):
+                    if type(target) is Index:
+                        stack.append((target.index, ancestors))
+                    target = target.value
+                continue
+            group = self._group(node, types, scope, declared)
+            if group is not None:
+                group.occurrences.append(_Occurrence(node, step, ancestors))
+                ancestors = ancestors + (id(node),)
+            for field in _CHILDREN[kind]:
+                value = getattr(node, field)
+                if field == 'args':
+                    stack.extend((arg, ancestors) for arg in value)
+                else:
+                    stack.append((value, ancestors))
+
+    def _group(self, node, types, scope, declared):
+        kind = type(node)
+        if kind not in (Call, Binary, Unary) or (kind is Call and node.name in BUILTIN_TYPES):
+            return None
+        if _cost(node, self.costs) < _MIN_SHARED_COST:
+            return None
+        names = self._reads(node, scope)
+        if names is None or not names.isdisjoint(declared):
+            return None
+        key = expression_key(node, self.keys)
+        group = self.live.get(key)
+        if group is not None:
+            return group
+        type_name = infer_type(node, types)
+        if type_name is None:
+            return None
+        group = self.live[key] = _Group(key, type_name, names, _cost(node, self.costs))
+        for name in names:
+            self.by_name.setdefault(name, set()).add(key)
+        return group
+
+    def _reads(self, node, scope):
+        """Names a shareable expression reads, or None if it cannot be shared"""
+        key = id(node)
+        try:
+            return self.reads[key]
+        except KeyError:
+            pass
+        kind = type(node)
+        if kind is Name:
+            names = (frozenset((node.name,)) if self.optimizer.is_safe_name(node.name, scope)
+                     else None)
+        elif (kind in (Assign, Postfix) or (kind is Unary and node.op in ('++', '--'))
+              or (kind is Call and node.name not in PURE_FUNCTIONS
+                  and node.name not in BUILTIN_TYPES)):
+            names = None
+        else:
+            names = frozenset()
+            for field in _CHILDREN[kind]:
+                value = getattr(node, field)
+                for child in (value if field == 'args' else (value,)):
+                    child_names = self._reads(child, scope)
+                    if child_names is None:
+                        names = None
+                        break
+                    names |= child_names
+                if names is None:
+                    break
+        self.reads[key] = names
+        return names
+
+    def write(self, names):
+        """Close the groups that read any of names"""
+        for name in names:
+            for key in self.by_name.pop(name, ()):
+                group = self.live.pop(key, None)
+                if group is not None:
+                    self.closed.append(group)
+
+    def barrier(self):
+        """Close every group, e.g. before a statement that might write anything"""
+        self.closed.extend(self.live.values())
+        self.live.clear()
+        self.by_name.clear()
+
+    def finish(self):
+        """Choose the temporaries; the optimizer names them and asks for edits later"""
+        self.barrier()
+        self.temporaries = []
+        self.replaced = {}       # id of an occurrence -> its temporary
+        chosen = sorted((group for group in self.closed if len(group.occurrences) > 1),
+                        key=lambda group: -group.cost)
+        for group in chosen:
+            occurrences = [occurrence for occurrence in group.occurrences
+                           if not any(a in self.replaced for a in occurrence.ancestors)]
+            if len(occurrences) < 2:
+                continue
+            first = occurrences[0]
+            temporary = _Temporary(self.steps[first.step][2], group.type, first.node)
+            self.temporaries.append(temporary)
+            for occurrence in occurrences:
+                self.replaced[id(occurrence.node)] = temporary
+        self.optimizer.runs.append(self)
+
+    def edits(self, edits):
+        """Append the edits for every statement of the run to edits"""
+        optimizer = self.optimizer
+        for original, simplified, _ in self.steps:
+            final = (_substitute(simplified, self.replaced) if self.replaced
+                     else simplified)
+            optimizer.diff(original, final, 0, edits)
+        for temporary in self.temporaries:
+            optimizer.declare(temporary.statement, f'{temporary.type} {temporary.name} = '
+                                                   f'{optimizer.text(temporary.node)};', edits)
+
+
+class _Temporary:
+    __slots__ = ('statement', 'type', 'node', 'name')
+
+    def __init__(self, statement, type_name, node):
+        self.statement = statement
+        self.type = type_name
+        self.node = node
+        self.name = None
+
+
+def _substitute(node, replaced):
+    temporary = replaced.get(id(node))
+    if temporary is not None:
+        return Name(temporary.name)
+    return map_children(node, lambda child: _substitute(child, replaced))
+
+
+class _BodyOptimizer:
+    """Simplifies the expressions of function bodies in one token stream"""
+
+    def __init__(self, stream, uniforms, fold_only=False):
+        self.fold_only = fold_only
+        self.stream = stream
+        self.code = stream.code
+        self.source = stream.source
+        self.uniforms = dict(BUILTIN_INPUTS)
+        self.uniforms.update(uniforms)
+        self.nodes = {}
+        self.parser = _Parser(self.code, self.nodes)
+        self.runs = []
+
+    # Names and types
+
+    def is_safe_name(self, name, scope):
+        """Whether name is a local or a uniform, never a macro or a mutable global"""
+        return name in scope or name in self.uniforms
+
+    def types(self, scope):
+        if not scope:
+            return self.uniforms
+        types = dict(self.uniforms)
+        types.update(scope)
+        return types
+
+    def edits(self):
+        """Edits for every finished run, with temporaries numbered in source order"""
+        temporaries = sorted((temporary for run in self.runs for temporary in run.temporaries),
+                             key=lambda temporary: temporary.statement)
+        identifiers = self.stream.identifiers
+        number = 0
+        for temporary in temporaries:
+            while f'_cse{number}' in identifiers:
+                number += 1
+            temporary.name = f'_cse{number}'
+            number += 1
+        edits = []
+        for run in self.runs:
+            run.edits(edits)
+        return edits
+
+    # Expressions
+
+    def parse(self, first, stop):
+        if first >= stop:
+            return None
+        self.parser.nesting = 0
+        try:
+            return self.parser.parse(first, stop)
+        except _Unparsable:
+            return None
+
+    def simplify(self, node, scope):
+        node = fold_constants(node)
+        if self.fold_only:
+            return node
+        return reduce_strength(node, lambda name: self.is_safe_name(name, scope))
+
+    def pristine(self, node):
+        return node.first is not None and self.nodes.get((node.first, node.stop)) is node
+
+    def text(self, node, min_precedence=0):
+        if self.pristine(node):
+            text = self.source[self.code[node.first].start:self.code[node.stop - 1].end]
+        else:
+            text = self._compose(node)
+        return f'({text})' if precedence(node) < min_precedence else text
+
+    def _compose(self, node):
+        kind = type(node)
+        if kind is Literal:
+            return node.text
+        if kind is Name:
+            return node.name
+        if kind is Call:
+            return f'{node.name}({", ".join(self.text(arg, ASSIGNMENT) for arg in node.args)})'
+        limits = _child_precedences(node)
+        if kind is Binary:
+            return (f'{self.text(node.left, limits[0])} {node.op} '
+                    f'{self.text(node.right, limits[1])}')
+        if kind is Unary:
+            operand = self.text(node.operand, UNARY)
+            if operand.startswith(('-', '+')) and node.op in ('-', '+', '--', '++'):
+                operand = f'({operand})'
+            return node.op + operand
+        if kind is Postfix:
+            return self.text(node.operand, POSTFIX) + node.op
+        if kind is Member:
+            return f'{self.text(node.value, POSTFIX)}.{node.field}'
+        if kind is Index:
+            return f'{self.text(node.value, POSTFIX)}[{self.text(node.index)}]'
+        if kind is Conditional:
+            return (f'{self.text(node.condition, limits[0])} ? {self.text(node.then, limits[1])}'
+                    f' : {self.text(node.otherwise, limits[2])}')
+        return f'{self.text(node.target, limits[0])} {node.op} {self.text(node.value, limits[1])}'
+
+    def diff(self, old, new, min_precedence, edits):
+        """Append the edits turning the source of old into new"""
+        if new is old:
+            return
+        kind = type(old)
+        if (type(new) is kind and new.first == old.first and new.stop == old.stop
+                and all(getattr(new, field) == getattr(old, field)
+                        for field in old._fields[:-2] if field not in _CHILDREN[kind])):
+            limits = _child_precedences(old)
+            for field, limit in zip(_CHILDREN[kind], limits):
+                if field == 'args':
+                    for old_arg, new_arg in zip(old.args, new.args):
+                        self.diff(old_arg, new_arg, ASSIGNMENT, edits)
+                else:
+                    self.diff(getattr(old, field), getattr(new, field), limit, edits)
+            return
+        start = self.code[old.first].start
+        end = self.code[old.stop - 1].end
+        edits.append((start, end, self._fitted(start, end, self.text(new, min_precedence))))
+
+    def _fitted(self, start, end, text):
+        """text with spaces or parentheses so it cannot merge with its neighbours"""
+        before = self.source[start - 1] if start else ' '
+        after = self.source[end] if end < len(self.source) else ' '
+        if text[0] in '+-' and before in '+-':
+            text = f'({text})'
+        if (before.isalnum() or before == '_') and (text[0].isalnum() or text[0] == '_'):
+            text = ' ' + text
+        if (after.isalnum() or after == '_') and (text[-1].isalnum() or text[-1] == '_'):
+            text += ' '
+        return text
+
+    def declare(self, statement, declaration, edits):
+        """Insert declaration in front of the statement starting at code[statement]"""
+        start = self.code[statement].start
+        line_start = self.source.rfind('\n', 0, start) + 1
+        indent = self.source[line_start:start]
+        separator = '\n' + indent if not indent.strip() else ' '
+        edits.append((start, start, declaration + separator))
+
+    # Statements
+
+    def function(self, params_open, body_open):
+        """Simplify the body of the function whose parameters open at params_open"""
+        code = self.code
+        scope = {}
+        ranges, _ = split_arguments(code, params_open)
+        for first, stop in ranges or ():
+            while first < stop and code[first].text in QUALIFIERS:
+                first += 1
+            if stop - first >= 2 and code[first].kind == IDENT and code[first + 1].kind == IDENT:
+                array = stop - first > 2 and code[first + 2].text == '['
+                scope[code[first + 1].text] = code[first].text + ('[]' if array else '')
+        close = matching_bracket(code, body_open)
+        self.block(body_open + 1, len(code) if close is None else close, scope)
+
+    def block(self, first, stop, scope):
+        run = _Run(self)
+        i = first
+        while i < stop:
+            i = self.statement(i, stop, scope, run)
+        run.finish()
+
+    def _close(self, index, stop):
+        close = matching_bracket(self.code, index)
+        return stop if close is None or close >= stop else close
+
+    def _statement_end(self, i, stop):
+        """Index of the ';' ending the simple statement at i, or stop"""
+        code = self.code
+        while i < stop:
+            text = code[i].text
+            if text == ';':
+                return i
+            if text in ('(', '[', '{'):
+                i = self._close(i, stop)
+            elif code[i].kind == PREPROC:
+                return stop
+            i += 1
+        return stop
+
+    def _isolated(self, first, stop, scope):
+        """Simplify one expression evaluated apart from the statements around it"""
+        node = self.parse(first, stop)
+        if node is not None:
+            run = _Run(self, shared=False)
+            run.add(node, scope, first)
+            run.finish()
+
+    def _sub_statement(self, i, stop, scope):
+        """The body of an if, else or loop; returns the index after it"""
+        if i >= stop:
+            return stop
+        run = _Run(self, shared=False)
+        end = self.statement(i, stop, dict(scope), run)
+        run.finish()
+        return end
+
+    def statement(self, i, stop, scope, run):
+        """Process the statement at code[i]; returns the index after it"""
+        code = self.code
+        tok = code[i]
+        text = tok.text
+        following = code[i + 1].text if i + 1 < stop else ''
+        if tok.kind == PREPROC:
+            run.barrier()
+            line_end = directive_line_end(self.source, tok.start)
+            while i < stop and code[i].start < line_end:
+                i += 1
+            return i
+        if text == ';':
+            return i + 1
+        if text == '{':
+            close = self._close(i, stop)
+            run.barrier()
+            self.block(i + 1, close, dict(scope))
+            return close + 1
+        if text in ('if', 'while', 'switch', 'for') and following == '(':
+            close = self._close(i + 1, stop)
+            body_scope = scope
+            if text == 'if':
+                # The condition is part of the run; the branches are not
+                node = self.parse(i + 2, close)
+                if node is not None:
+                    run.add(node, scope, i)
+            elif text == 'for':
+                body_scope = dict(scope)
+                self._for_header(i + 2, close, body_scope)
+            else:
+                self._isolated(i + 2, close, scope)
+            run.barrier()
+            if text == 'switch':
+                # Case bodies are left as they are
+                if close + 1 < stop and code[close + 1].text == '{':
+                    return self._close(close + 1, stop) + 1
+                return self._statement_end(close + 1, stop) + 1
+            end = self._sub_statement(close + 1, stop, body_scope)
+            if text == 'if' and end < stop and code[end].text == 'else':
+                end = self._sub_statement(end + 1, stop, scope)
+            return end
+        if text == 'do':
+            run.barrier()
+            end = self._sub_statement(i + 1, stop, scope)
+            if end + 1 < stop and code[end].text == 'while' and code[end + 1].text == '(':
+                close = self._close(end + 1, stop)
+                self._isolated(end + 2, close, scope)
+                end = close + 1
+            return self._statement_end(end, stop) + 1
+        end = self._statement_end(i, stop)
+        if text == 'return':
+            node = self.parse(i + 1, end)
+            if node is not None:
+                run.add(node, scope, i)
+            run.barrier()
+        elif tok.kind != IDENT or (text in KEYWORDS and text not in QUALIFIERS):
+            run.barrier()
+        elif not self._declaration(i, end, scope, run):
+            node = self.parse(i, end)
+            if node is None:
+                run.barrier()
+            else:
+                run.add(node, scope, i)
+        return end + 1
+
+    def _for_header(self, first, stop, scope):
+        code = self.code
+        parts = []
+        i = first
+        while i < stop:
+            if code[i].text in ('(', '['):
+                i = self._close(i, stop)
+            elif code[i].text == ';':
+                parts.append((first, i))
+                first = i + 1
+            i += 1
+        parts.append((first, stop))
+        if len(parts) != 3:
+            return
+        (init_first, init_stop), condition, increment = parts
+        run = _Run(self, shared=False)
+        if init_first < init_stop and not self._declaration(init_first, init_stop, scope, run):
+            node = self.parse(init_first, init_stop)
+            if node is not None:
+                run.add(node, scope, init_first)
+        run.finish()
+        self._isolated(*condition, scope)
+        self._isolated(*increment, scope)
+
+    def _declaration(self, first, stop, scope, run):
+        """Process a variable declaration in code[first:stop]; False if it is not one"""
+        code = self.code
+        i = first
+        while i < stop and code[i].text in QUALIFIERS:
+            i += 1
+        if not (i + 1 < stop and code[i].kind == IDENT and code[i + 1].kind == IDENT
+                and code[i].text not in KEYWORDS and code[i + 1].text not in KEYWORDS):
+            return False
+        type_name = code[i].text
+        declared = []
+        start = j = i + 1
+        while True:
+            if j < stop and code[j].text in ('(', '[', '{'):
+                j = self._close(j, stop)
+                if j < stop:
+                    j += 1
+                continue
+            if j < stop and code[j].text != ',':
+                j += 1
+                continue
+            # code[start:j] is one declarator
+            if start >= j or code[start].kind != IDENT:
+                run.barrier()
+            else:
+                name = code[start].text
+                array = start + 1 < j and code[start + 1].text == '['
+                value = self._close(start + 1, j) + 1 if array else start + 1
+                if value < j and code[value].text == '=':
+                    node = self.parse(value + 1, j)
+                    if node is None:
+                        run.barrier()
+                    else:
+                        run.add(node, scope, first, declared)
+                elif value < j:
+                    run.barrier()
+                scope[name] = type_name + ('[]' if array else '')
+                run.write((name,))
+                declared.append(name)
+            if j >= stop:
+                return True
+            start = j = j + 1
+
+
+def function_bodies(code, source):
+    """(parameter list index, body index) of every function definition"""
+    i = 0
+    count = len(code)
+    while i < count:
+        tok = code[i]
+        if tok.kind == PREPROC:
+            line_end = directive_line_end(source, tok.start)
+            while i < count and code[i].start < line_end:
+                i += 1
+            continue
+        if (tok.kind == IDENT and i + 2 < count and code[i + 1].kind == IDENT
+                and code[i + 2].text == '('):
+            close = matching_bracket(code, i + 2)
+            if close is None:
+                return
+            if close + 1 < count and code[close + 1].text == '{':
+                yield i + 2, close + 1
+                body_close = matching_bracket(code, close + 1)
+                if body_close is None:
+                    return
+                i = body_close + 1
+            else:
+                i = close + 1
+            continue
+        if tok.text in ('(', '[', '{'):
+            close = matching_bracket(code, i)
+            if close is None:
+                return
+            i = close
+        i += 1
+
+
+def optimize_expressions(shader_code, uniforms=None):
+    """Fold constants, reduce strength and share repeated subexpressions in function bodies
+
+    uniforms maps the names of uniforms the code may read without declaring
+    them to their types.  Expressions are parsed into trees, simplified
+    with fold_constants() and reduce_strength(), and pure expressions that
+    a straight-line run of statements computes more than once (the same
+    texture fetch, say) are computed once into a temporary.  Only the text
+    of expressions that changed is rewritten; code this parser does not
+    understand is left alone.
+    """
+    stream = lex_glsl(shader_code)
+    optimizer = _BodyOptimizer(stream, uniforms or {})
+    for params_open, body_open in function_bodies(stream.code, stream.source):
+        optimizer.function(params_open, body_open)
+    buffer = RewriteBuffer(stream)
+    buffer.extend(optimizer.edits())
+    return buffer.apply_source()
+
+
+def fold_expressions(shader_code):
+    """Fold constants in function bodies, without the other optimizations
+
+    Like optimize_expressions(), but only fold_constants() is applied, for
+    code whose constants were just filled in.
+    """
+    stream = lex_glsl(shader_code)
+    optimizer = _BodyOptimizer(stream, {}, fold_only=True)
+    for params_open, body_open in function_bodies(stream.code, stream.source):
+        optimizer.function(params_open, body_open)
+    buffer = RewriteBuffer(stream)
+    buffer.extend(optimizer.edits())
+    return buffer.apply_source()
+
+
+def preprocessor_value(node):
+    """Integer value of a parsed #if condition made of numbers alone
+
+    Raises ValueError for anything else, including names.
+    """
+    kind = type(node)
+    if kind is Literal:
+        text = node.text.rstrip('uU')
+        if text in ('true', 'false'):
+            return int(text == 'true')
+        try:
+            return int(text, 0) if text.isalnum() else int(float(text.rstrip('fF')))
+        except ValueError:
+            raise ValueError(f'not a number: {node.text}') from None
+    if kind is Unary and node.op in ('-', '+', '!', '~'):
+        value = preprocessor_value(node.operand)
+        return {'-': -value, '+': value, '!': int(not value), '~': ~value}[node.op]
+    if kind is Conditional:
+        return preprocessor_value(node.then if preprocessor_value(node.condition)
+                                  else node.otherwise)
+    if kind is Binary and node.op in _PREPROCESSOR_OPERATORS:
+        left, right = preprocessor_value(node.left), preprocessor_value(node.right)
+        if node.op in ('/', '%') and right == 0:
+            raise ValueError('division by zero in a preprocessor condition')
+        return int(_PREPROCESSOR_OPERATORS[node.op](left, right))
+    raise ValueError('unsupported preprocessor condition')
+
+
+_PREPROCESSOR_OPERATORS = {
+    '+': lambda a, b: a + b, '-': lambda a, b: a - b, '*': lambda a, b: a * b,
+    '/': lambda a, b: int(a / b), '%': lambda a, b: int(math.fmod(a, b)),
+    '&&': lambda a, b: bool(a and b), '||': lambda a, b: bool(a or b),
+    '&': lambda a, b: a & b, '|': lambda a, b: a | b, '^': lambda a, b: a ^ b,
+    '<<': lambda a, b: a << b, '>>': lambda a, b: a >> b,
+}
+_PREPROCESSOR_OPERATORS.update(_COMPARISONS)
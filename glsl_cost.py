@@ -0,0 +1,492 @@
+import bisect
+import math
+import re
+from collections import OrderedDict, namedtuple
+
+from glsl_analysis import KEYWORDS, QUALIFIERS
+from glsl_ast import (BINARY_PRECEDENCE, PURE_FUNCTIONS, TEXTURE_FUNCTIONS, Assign, Binary, Call,
+                      Name, Postfix, Unary, constant_value, fold_constants, function_bodies,
+                      literal, map_children, parse_expression)
+from glsl_lexer import (IDENT, PREPROC, PUNCT, directive_line_end, lex_glsl, matching_bracket,
+                        split_arguments)
+
+
+# Built-in functions that run on the special function unit, or need a
+# square root, and so count as transcendental rather than ALU work
+TRANSCENDENTAL_FUNCTIONS = frozenset((
+    'sin', 'cos', 'tan', 'asin', 'acos', 'atan', 'sinh', 'cosh', 'tanh',
+    'asinh', 'acosh', 'atanh', 'pow', 'exp', 'log', 'exp2', 'log2',
+    'sqrt', 'inversesqrt', 'length', 'distance', 'normalize', 'refract',
+))
+
+# Operators that cost one ALU operation each
+_ALU_OPERATORS = frozenset(BINARY_PRECEDENCE) | frozenset((
+    '+=', '-=', '*=', '/=', '%=', '<<=', '>>=', '&=', '|=', '^=', '++', '--', '!', '~', '?',
+))
+
+_COMPARISONS = {'<': '>', '<=': '>=', '>': '<', '>=': '<=', '!=': '!='}
+
+_WRITES = frozenset(('=', '+=', '-=', '*=', '/=', '%=', '<<=', '>>=', '&=', '|=', '^=',
+                     '++', '--'))
+
+# Relative cost of each kind of work in Cost.weighted(), the same weights
+# glsl_ast uses to decide which expressions are worth sharing
+WEIGHTS = {'alu': 1, 'transcendental': 4, 'texture': 16}
+
+# Weighted cost of one iteration from which a loop is flagged as heavy
+HEAVY_ITERATION = 128
+
+# Loop flags
+DYNAMIC_BOUND = 'dynamic bound'
+HEAVY = 'heavy iteration'
+
+
+class Cost:
+    """Operations one run of some code performs
+
+    bounded is False when the code contains a loop whose trip count is not
+    a compile-time constant; such loops count one iteration, so the
+    numbers are then a lower bound.
+    """
+
+    __slots__ = ('alu', 'transcendental', 'texture', 'bounded')
+
+    def __init__(self, alu=0, transcendental=0, texture=0, bounded=True):
+        self.alu = alu
+        self.transcendental = transcendental
+        self.texture = texture
+        self.bounded = bounded
+
+    def add(self, other, times=1):
+        self.alu += other.alu * times
+        self.transcendental += other.transcendental * times
+        self.texture += other.texture * times
+        self.bounded = self.bounded and other.bounded
+        return self
+
+    def weighted(self):
+        return sum(getattr(self, kind) * weight for kind, weight in WEIGHTS.items())
+
+    def as_dict(self):
+        result = {kind: getattr(self, kind) for kind in WEIGHTS}
+        result['weighted'] = self.weighted()
+        result['bounded'] = self.bounded
+        return result
+
+    def __repr__(self):
+        return (f'<Cost {self.alu} ALU, {self.transcendental} transcendental, '
+                f'{self.texture} texture{"" if self.bounded else ", at least"}>')
+
+
+class LoopCost(namedtuple('LoopCost', 'function line kind trip_count iteration flags')):
+    """A loop in a function body: trip_count is None unless it is a constant"""
+
+    __slots__ = ()
+
+    def describe(self):
+        trips = '?' if self.trip_count is None else self.trip_count
+        line = (f'{self.kind} loop at line {self.line} in {self.function}: '
+                f'{trips} x {self.iteration.weighted()}')
+        return f'{line} ({", ".join(self.flags)})' if self.flags else line
+
+    def as_dict(self):
+        return {'function': self.function, 'line': self.line, 'kind': self.kind,
+                'trip_count': self.trip_count, 'iteration': self.iteration.as_dict(),
+                'flags': list(self.flags)}
+
+
+class CostReport:
+    """Static estimate of what a shader costs per fragment
+
+    total is one run of main(), counting every function at each call and
+    every loop times its trip count.  Both sides of a branch count, since
+    a GPU runs both when neighbouring fragments disagree.  functions holds
+    the cost of one call of each function, loops every loop found.
+    """
+
+    def __init__(self):
+        self.total = Cost()
+        self.functions = OrderedDict()
+        self.loops = []
+
+    @property
+    def bounded(self):
+        return self.total.bounded
+
+    def flagged(self):
+        return [loop for loop in self.loops if loop.flags]
+
+    def summary(self):
+        """One line for a status bar"""
+        total = self.total
+        line = (f'{"at least " if not total.bounded else ""}{total.weighted()} weighted ops '
+                f'per fragment ({total.alu} ALU, {total.transcendental} transcendental, '
+                f'{total.texture} texture)')
+        flagged = self.flagged()
+        if flagged:
+            line += f'; {len(flagged)} loop{"s" if len(flagged) > 1 else ""} flagged'
+        return line
+
+    def as_dict(self):
+        return {
+            'total': self.total.as_dict(),
+            'functions': {name: cost.as_dict() for name, cost in self.functions.items()},
+            'loops': [loop.as_dict() for loop in self.loops],
+        }
+
+
+def _evaluate(node, constants):
+    """(value, is_float) of node with named constants filled in, or None"""
+
+    def substitute(node):
+        kind = type(node)
+        if kind is Name and node.name in constants:
+            return literal(*constants[node.name]) or node
+        if kind is Call and node.name in ('int', 'float') and len(node.args) == 1:
+            value = constant_value(fold_constants(substitute(node.args[0])))
+            if value is not None:
+                is_float = node.name == 'float'
+                value = float(value[0]) if is_float else int(value[0])
+                return literal(value, is_float) or node
+        return map_children(node, substitute)
+
+    return constant_value(fold_constants(substitute(node)))
+
+
+def _declaration_end(code, i, stop):
+    """Index of the ',' or ';' ending the declarator whose value starts at i"""
+    while i < stop and code[i].text not in (',', ';'):
+        if code[i].text in ('(', '['):
+            i = min(matching_bracket(code, i) or stop, stop)
+        i += 1
+    return i
+
+
+def shader_constants(stream, constants=None):
+    """name -> (value, is_float) for #define and const names with constant values
+
+    Later definitions replace earlier ones; names whose value is not a
+    constant expression are left out.  constants are names defined before
+    stream, such as in other units of the same shader.
+    """
+    code = stream.code
+    count = len(code)
+    constants = dict(constants or {})
+    for i, tok in enumerate(code):
+        if tok.kind == PREPROC and tok.text[1:].strip() == 'define':
+            if i + 1 >= count or code[i + 1].kind != IDENT:
+                continue
+            line_end = directive_line_end(stream.source, tok.start)
+            first = i + 2
+            if first < count and code[first].text == '(' and code[first].start == code[i + 1].end:
+                continue  # function-like macro
+            stop = first
+            while stop < count and code[stop].start < line_end:
+                stop += 1
+            value = None
+            if stop > first:
+                node = parse_expression(code, first, stop)
+                value = node and _evaluate(node, constants)
+            if value is None:
+                constants.pop(code[i + 1].text, None)
+            else:
+                constants[code[i + 1].text] = value
+        elif tok.text == 'const':
+            j = i + 1
+            while j < count and code[j].text in QUALIFIERS:
+                j += 1
+            if j + 3 >= count or code[j + 1].kind != IDENT or code[j + 2].text != '=':
+                continue
+            stop = _declaration_end(code, j + 3, count)
+            node = parse_expression(code, j + 3, stop)
+            value = node and _evaluate(node, constants)
+            if value is not None:
+                constants[code[j + 1].text] = value
+    return constants
+
+
+def _comma_parts(code, first, stop):
+    """Ranges of the comma separated parts of code[first:stop]"""
+    parts = []
+    i = first
+    while i < stop:
+        if code[i].text == ',':
+            parts.append((first, i))
+            first = i + 1
+        elif code[i].text in ('(', '['):
+            i = min(matching_bracket(code, i) or stop, stop)
+        i += 1
+    parts.append((first, stop))
+    return parts
+
+
+def _start_value(code, first, stop, variable, constants):
+    """Value a for loop initializer like 'int i = 0, j = 1' gives variable, or None"""
+    while first < stop and code[first].text in QUALIFIERS:
+        first += 1
+    if (first + 1 < stop and code[first].kind == IDENT and code[first + 1].kind == IDENT
+            and code[first].text not in KEYWORDS):
+        first += 1  # the type of a declaration
+    for part_first, part_stop in _comma_parts(code, first, stop):
+        node = parse_expression(code, part_first, part_stop)
+        if (type(node) is Assign and node.op == '=' and type(node.target) is Name
+                and node.target.name == variable):
+            start = _evaluate(node.value, constants)
+            return None if start is None else start[0]
+    return None
+
+
+def _loop_step(node, variable, constants):
+    """How much a for loop's increment changes variable, or None"""
+    kind = type(node)
+    if kind in (Postfix, Unary) and node.op in ('++', '--'):
+        if type(node.operand) is Name and node.operand.name == variable:
+            return 1 if node.op == '++' else -1
+        return None
+    if kind is not Assign or type(node.target) is not Name or node.target.name != variable:
+        return None
+    if node.op in ('+=', '-='):
+        step = _evaluate(node.value, constants)
+        return step and (step[0] if node.op == '+=' else -step[0])
+    if node.op == '=' and type(node.value) is Binary and node.value.op in ('+', '-'):
+        left, right = node.value.left, node.value.right
+        if type(left) is Name and left.name == variable:
+            step = _evaluate(right, constants)
+            return step and (step[0] if node.value.op == '+' else -step[0])
+        if node.value.op == '+' and type(right) is Name and right.name == variable:
+            step = _evaluate(left, constants)
+            return step and step[0]
+    return None
+
+
+def _writes(code, first, stop, variable):
+    """Whether code[first:stop] may assign to variable"""
+    for i in range(first, stop):
+        if code[i].text != variable or code[i].kind != IDENT:
+            continue
+        if i + 1 < stop and code[i + 1].text in _WRITES:
+            return True
+        if i > first and code[i - 1].text in ('++', '--'):
+            return True
+    return False
+
+
+# A for loop counting variable from start by step, trip_count times
+LoopCounter = namedtuple('LoopCounter', 'variable start step trip_count')
+
+
+def loop_counter(code, header, body, constants=None):
+    """LoopCounter of a for loop whose trip count is a constant, or None
+
+    header is the (init, condition, increment) code ranges of the loop
+    and body the range of its body.  The loop must count one variable from
+    a constant towards a constant by a constant step, and the body must
+    not assign the variable.  A break or return can still end it sooner,
+    so the count is an upper bound.
+    """
+    constants = constants or {}
+    (init_first, init_stop), (cond_first, cond_stop), (step_first, step_stop) = header
+    condition = parse_expression(code, cond_first, cond_stop)
+    if type(condition) is not Binary or condition.op not in _COMPARISONS:
+        return None
+    if type(condition.left) is Name:
+        variable, op, bound = condition.left.name, condition.op, condition.right
+    elif type(condition.right) is Name:
+        variable, op, bound = condition.right.name, _COMPARISONS[condition.op], condition.left
+    else:
+        return None
+    bound = _evaluate(bound, constants)
+    start = _start_value(code, init_first, init_stop, variable, constants)
+    if bound is None or start is None or _writes(code, body[0], body[1], variable):
+        return None
+    bound = bound[0]
+
+    # Exactly one part of the increment may change the variable
+    steps = [_loop_step(parse_expression(code, first, stop), variable, constants)
+             for first, stop in _comma_parts(code, step_first, step_stop)
+             if _writes(code, first, stop, variable)]
+    if len(steps) != 1 or not steps[0]:
+        return None
+    step = steps[0]
+
+    span = (bound - start) / step
+    if op == '!=':
+        if span < 0 or span != int(span):
+            return None
+        trip_count = int(span)
+    elif not {'<': start < bound, '<=': start <= bound,
+              '>': start > bound, '>=': start >= bound}[op]:
+        trip_count = 0
+    elif (step > 0) != (op in ('<', '<=')):
+        return None  # counts away from the bound
+    else:
+        trip_count = math.ceil(span) if op in ('<', '>') else math.floor(span) + 1
+    return LoopCounter(variable, start, step, trip_count)
+
+
+def loop_trip_count(code, header, body, constants=None):
+    """Number of times a for loop runs its body, when that is a constant
+
+    See loop_counter(); returns None when the count is not a constant.
+    """
+    counter = loop_counter(code, header, body, constants)
+    return None if counter is None else counter.trip_count
+
+
+class _Estimator:
+    """Costs the function bodies of one token stream"""
+
+    def __init__(self, stream, heavy_iteration):
+        self.stream = stream
+        self.code = stream.code
+        self.heavy_iteration = heavy_iteration
+        self.constants = shader_constants(stream)
+        self.bodies = OrderedDict()
+        for params_open, body_open in function_bodies(self.code, stream.source):
+            self.bodies.setdefault(self.code[params_open - 1].text, []).append(body_open)
+        self.costs = OrderedDict()
+        self.loops = []
+        self._line_starts = None
+
+    def line(self, index):
+        if self._line_starts is None:
+            self._line_starts = [0] + [m.end() for m in re.finditer('\n', self.stream.source)]
+        return bisect.bisect_right(self._line_starts, self.code[index].start)
+
+    def function(self, name):
+        """Cost of one call; the dearest overload when there are several"""
+        cost = self.costs.get(name)
+        if cost is None:
+            # GLSL forbids recursion; a call back into name costs nothing
+            self.costs[name] = Cost()
+            # A body still being typed runs to the end of the code
+            costs = [self.block(body_open + 1,
+                                matching_bracket(self.code, body_open) or len(self.code), name)
+                     for body_open in self.bodies[name]]
+            cost = self.costs[name] = max(costs, key=Cost.weighted)
+        return cost
+
+    def call(self, name):
+        if name in self.bodies:
+            return self.function(name)
+        if name in TEXTURE_FUNCTIONS:
+            return Cost(texture=1)
+        if name in TRANSCENDENTAL_FUNCTIONS:
+            return Cost(transcendental=1)
+        if name in PURE_FUNCTIONS:
+            return Cost(alu=1)
+        # Constructors, and macros or functions not defined here
+        return Cost()
+
+    def block(self, first, stop, function):
+        code = self.code
+        cost = Cost()
+        i = first
+        while i < stop:
+            tok = code[i]
+            text = tok.text
+            if tok.kind == PREPROC:
+                line_end = directive_line_end(self.stream.source, tok.start)
+                while i < stop and code[i].start < line_end:
+                    i += 1
+                continue
+            if text in ('for', 'while', 'do'):
+                end = self.loop(i, stop, function, cost)
+                if end is not None:
+                    i = end
+                    continue
+            elif tok.kind == IDENT and i + 1 < stop and code[i + 1].text == '(':
+                if not i or code[i - 1].text != '.':
+                    cost.add(self.call(text))
+            elif tok.kind == PUNCT and text in _ALU_OPERATORS:
+                cost.alu += 1
+            i += 1
+        return cost
+
+    def statement(self, i, stop):
+        """(first, stop, next index) of the statement or block at code[i]"""
+        code = self.code
+        if i < stop and code[i].text == '{':
+            close = matching_bracket(code, i)
+            if close is not None and close < stop:
+                return i + 1, close, close + 1
+        first = i
+        while i < stop:
+            text = code[i].text
+            if text == ';':
+                return first, i + 1, i + 1
+            if text in ('(', '[', '{'):
+                close = matching_bracket(code, i)
+                if close is None or close >= stop:
+                    break
+                i = close
+                if text == '{' and (i + 1 >= stop or code[i + 1].text != 'else'):
+                    return first, i + 1, i + 1
+            i += 1
+        return first, stop, stop
+
+    def loop(self, i, stop, function, cost):
+        """Add the loop at code[i] to cost; returns the index after it, or None"""
+        code = self.code
+        kind = code[i].text
+        once = Cost()
+        iteration = Cost()
+        trip_count = None
+        if kind == 'do':
+            body_first, body_stop, end = self.statement(i + 1, stop)
+            if end + 1 >= stop or code[end].text != 'while' or code[end + 1].text != '(':
+                return None
+            close = matching_bracket(code, end + 1)
+            if close is None or close >= stop:
+                return None
+            iteration.add(self.block(end + 2, close, function))
+            end = close + 2 if close + 1 < stop and code[close + 1].text == ';' else close + 1
+        else:
+            if i + 1 >= stop or code[i + 1].text != '(':
+                return None
+            parts, close = split_arguments(code, i + 1, ';' if kind == 'for' else ',')
+            if parts is None or close >= stop or (kind == 'for' and len(parts) != 3):
+                return None
+            body_first, body_stop, end = self.statement(close + 1, stop)
+            if kind == 'for':
+                once.add(self.block(parts[0][0], parts[0][1], function))
+                for first, part_stop in parts[1:]:
+                    iteration.add(self.block(first, part_stop, function))
+                trip_count = loop_trip_count(code, parts, (body_first, body_stop),
+                                             self.constants)
+            else:
+                iteration.add(self.block(i + 2, close, function))
+        iteration.add(self.block(body_first, body_stop, function))
+
+        flags = []
+        if trip_count is None:
+            flags.append(DYNAMIC_BOUND)
+        if iteration.weighted() >= self.heavy_iteration:
+            flags.append(HEAVY)
+        self.loops.append(LoopCost(function, self.line(i), kind, trip_count, iteration,
+                                   tuple(flags)))
+        once.add(iteration, 1 if trip_count is None else trip_count)
+        if trip_count is None:
+            once.bounded = False
+        cost.add(once)
+        return end
+
+
+def estimate_cost(shader_code, heavy_iteration=HEAVY_ITERATION):
+    """CostReport for shader_code, from its text alone
+
+    Counts operators as ALU work and classifies calls to built-in
+    functions; calls to the shader's own functions add the cost of their
+    body.  Trip counts come from loop_trip_count(), with #define and const
+    names as constants.  Loops with other bounds are flagged with
+    DYNAMIC_BOUND, and loops whose iteration weighs heavy_iteration or
+    more with HEAVY.  Operations count once whatever their vector width.
+    """
+    estimator = _Estimator(lex_glsl(shader_code), heavy_iteration)
+    report = CostReport()
+    for name in estimator.bodies:
+        report.functions[name] = estimator.function(name)
+    if 'main' in report.functions:
+        report.total = report.functions['main']
+    report.loops = sorted(estimator.loops, key=lambda loop: loop.line)
+    return report
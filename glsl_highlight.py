@@ -0,0 +1,116 @@
+from difflib import SequenceMatcher
+
+from glsl_analysis import BUILTIN_TYPES, KEYWORDS
+from glsl_lexer import COMMENT, IDENT, NUMBER, PREPROC, scan_glsl
+
+
+# Highlight classes, used as tag names by the window
+KEYWORD = 'keyword'
+TYPE = 'type'
+BUILTIN = 'builtin'
+UNIFORM = 'uniform'
+HIGHLIGHT_NUMBER = 'number'
+HIGHLIGHT_COMMENT = 'comment'
+PREPROCESSOR = 'preprocessor'
+
+# Output lines with no counterpart in the input
+REWRITTEN = 'rewritten'
+ADDED = 'added'
+
+BUILTIN_FUNCTIONS = frozenset((
+    'radians', 'degrees', 'sin', 'cos', 'tan', 'asin', 'acos', 'atan', 'sinh', 'cosh',
+    'tanh', 'asinh', 'acosh', 'atanh', 'pow', 'exp', 'log', 'exp2', 'log2', 'sqrt',
+    'inversesqrt', 'abs', 'sign', 'floor', 'trunc', 'round', 'roundEven', 'ceil', 'fract',
+    'mod', 'modf', 'min', 'max', 'clamp', 'mix', 'step', 'smoothstep', 'isnan', 'isinf',
+    'floatBitsToInt', 'floatBitsToUint', 'intBitsToFloat', 'uintBitsToFloat', 'length',
+    'distance', 'dot', 'cross', 'normalize', 'faceforward', 'reflect', 'refract',
+    'matrixCompMult', 'outerProduct', 'transpose', 'determinant', 'inverse', 'lessThan',
+    'lessThanEqual', 'greaterThan', 'greaterThanEqual', 'equal', 'notEqual', 'any', 'all',
+    'not', 'texture', 'textureLod', 'textureGrad', 'textureSize', 'texelFetch',
+    'textureProj', 'texture2D', 'texture2DLod', 'textureCube', 'texture3D', 'dFdx', 'dFdy',
+    'fwidth', 'main', 'mainImage', 'gl_FragColor', 'gl_FragCoord',
+))
+
+_KINDS = {NUMBER: HIGHLIGHT_NUMBER, COMMENT: HIGHLIGHT_COMMENT, PREPROC: PREPROCESSOR}
+
+
+def highlight_tokens(code, uniforms=frozenset()):
+    """(class, start, end) of every token of code that gets highlighted;
+    identifiers in uniforms are highlighted as uniforms"""
+    spans = []
+    for tok in scan_glsl(code):
+        if tok.kind == IDENT:
+            text = tok.text
+            if text in BUILTIN_TYPES:
+                kind = TYPE
+            elif text in KEYWORDS:
+                kind = KEYWORD
+            elif text in BUILTIN_FUNCTIONS:
+                kind = BUILTIN
+            elif text in uniforms:
+                kind = UNIFORM
+            else:
+                continue
+        else:
+            kind = _KINDS.get(tok.kind)
+            if kind is None:
+                continue
+        spans.append((kind, tok.start, tok.end))
+    return spans
+
+
+def text_lines(text):
+    """text split after each newline; the last line may lack one.  Only
+    newlines break lines, as in a Tk text widget"""
+    lines = text.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def line_edits(old, new):
+    """(first, stop, text) edits turning old into new, last edit first
+
+    Lines first to stop of old (counted from 0, text_lines() style) are
+    replaced by text; applying the edits in order keeps the line numbers
+    of the ones still to come valid.  Lines both texts share stay out of
+    the edits, so a widget showing old only redraws what changed.
+    """
+    a = text_lines(old)
+    b = text_lines(new)
+    # Most updates touch a few lines: match the ends before diffing
+    start = 0
+    limit = min(len(a), len(b))
+    while start < limit and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < limit - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+    matcher = SequenceMatcher(None, a[start:len(a) - end], b[start:len(b) - end])
+    edits = [(start + i1, start + i2, ''.join(b[start + j1:start + j2]))
+             for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+    edits.reverse()
+    return edits
+
+
+def rewritten_lines(input_code, output_code):
+    """(class, first, stop) line ranges of output_code, counted from 1,
+    that do not come from input_code unchanged: REWRITTEN where input
+    lines were replaced, ADDED where lines were inserted.  Indentation is
+    ignored."""
+    a = [line.strip() for line in input_code.split('\n')]
+    b = [line.strip() for line in output_code.split('\n')]
+    ranges = []
+    for tag, _, _, j1, j2 in SequenceMatcher(None, a, b).get_opcodes():
+        if tag in ('replace', 'insert'):
+            kind = REWRITTEN if tag == 'replace' else ADDED
+            # Blank lines are no news
+            while j1 < j2 and not b[j1]:
+                j1 += 1
+            while j2 > j1 and not b[j2 - 1]:
+                j2 -= 1
+            if j1 < j2:
+                ranges.append((kind, j1 + 1, j2 + 1))
+    return ranges
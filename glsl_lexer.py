@@ -0,0 +1,510 @@
+import re
+import threading
+from collections import OrderedDict, namedtuple
+
+
+# Token kinds
+IDENT = 'ident'
+NUMBER = 'number'
+PUNCT = 'punct'
+STRING = 'string'
+PREPROC = 'preproc'
+COMMENT = 'comment'
+WHITESPACE = 'whitespace'
+
+# Kinds that carry no meaning for the conversion rules
+TRIVIA = frozenset((WHITESPACE, COMMENT))
+
+# Directives whose whole line is kept as a single opaque token.  Their
+# arguments are file names, messages or pragmas, never shader code.
+OPAQUE_DIRECTIVES = frozenset((
+    'include', 'error', 'warning', 'pragma', 'extension', 'version', 'line',
+))
+
+Token = namedtuple('Token', 'kind text start')
+Token.end = property(lambda tok: tok.start + len(tok.text))
+
+_CLOSING = {'(': ')', '[': ']', '{': '}'}
+
+_TOKEN_RE = re.compile(r'''
+    (?P<whitespace>(?:[ \t\r\n\f\v]|\\\r?\n)+)
+  | (?P<comment>//[^\n]*|/\*.*?(?:\*/|\Z))
+  | (?P<directive>\#[ \t]*(?P<name>[A-Za-z_]\w*)?)
+  | (?P<number>0[xX][0-9a-fA-F]+[uU]?
+      |(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?(?:[fF]|[lL][fF]|[uU])?)
+  | (?P<ident>[A-Za-z_]\w*)
+  | (?P<string>"[^"\n]*"?)
+  | (?P<punct><<=|>>=|\+\+|--|&&|\|\||\^\^|[-+*/%&|^!=<>]=|<<|>>|.)
+''', re.VERBOSE | re.DOTALL)
+
+_LINE_END_RE = re.compile(r'(?:[^\\\n]|\\\r?\n|\\(?!\r?\n))*')
+
+
+def _scan(source, pos=0, end=None, line_start=True):
+    """Tokenize source[pos:end] in a single left-to-right pass"""
+    if end is None:
+        end = len(source)
+    tokens = []
+    append = tokens.append
+    match_token = _TOKEN_RE.match
+    while pos < end:
+        m = match_token(source, pos, end)
+        kind = m.lastgroup
+        stop = m.end()
+        if kind == 'name':
+            kind = 'directive'
+        if kind == 'directive':
+            if not line_start:
+                kind = PUNCT
+                stop = pos + 1
+            else:
+                kind = PREPROC
+                if m.group('name') in OPAQUE_DIRECTIVES:
+                    stop = _LINE_END_RE.match(source, stop, end).end()
+        append(Token(kind, source[pos:stop], pos))
+        if kind == WHITESPACE:
+            line_start = line_start or '\n' in source[pos:stop]
+        elif kind != COMMENT:
+            line_start = False
+        pos = stop
+    return tokens
+
+
+class CodeTokens(list):
+    """Token list that remembers which brackets pair up
+
+    Every bracket pair found while looking for one is kept, and a search
+    jumps over groups it already knows, so matching_bracket() and
+    split_arguments() stay linear overall however deeply the code nests.
+    """
+
+    __slots__ = ('_pairs',)
+
+    def __init__(self, tokens=()):
+        super().__init__(tokens)
+        self._pairs = {}
+
+    def matching(self, index):
+        """Index of the bracket pairing with the opening one at index, or None"""
+        pairs = self._pairs
+        try:
+            return pairs[index]
+        except KeyError:
+            pass
+        opening = self[index].text
+        closing = _CLOSING[opening]
+        stack = []
+        i = index
+        count = len(self)
+        while i < count:
+            text = self[i].text
+            if text == opening:
+                if i != index and i in pairs:
+                    if pairs[i] is None:
+                        break  # an inner bracket never closes, so neither does this one
+                    i = pairs[i] + 1
+                    continue
+                stack.append(i)
+            elif text == closing:
+                opened = stack.pop()
+                pairs[opened] = i
+                pairs[i] = opened
+                if not stack:
+                    return i
+            i += 1
+        for opened in stack:
+            pairs[opened] = None
+        pairs[index] = None
+        return None
+
+
+class TokenStream:
+    """Lossless token list for one shader source
+
+    Joining the text of every token reproduces the source exactly, so the
+    stages can rewrite by offset while ignoring comments and whitespace.
+    Derived views are computed on first use and shared by every stage that
+    looks at the same source.
+    """
+
+    __slots__ = ('source', 'tokens', '_code', '_identifiers', '_derived')
+
+    def __init__(self, source, tokens):
+        self.source = source
+        self.tokens = tokens
+        self._code = None
+        self._identifiers = None
+        self._derived = {}
+
+    @property
+    def code(self):
+        """Tokens that are neither whitespace nor comments"""
+        if self._code is None:
+            self._code = CodeTokens([tok for tok in self.tokens if tok.kind not in TRIVIA])
+        return self._code
+
+    @property
+    def identifiers(self):
+        """Set of identifiers used outside comments"""
+        if self._identifiers is None:
+            self._identifiers = frozenset(
+                tok.text for tok in self.code if tok.kind == IDENT)
+        return self._identifiers
+
+    def derived(self, key, build):
+        """Return build(self), computed once per stream and key"""
+        try:
+            return self._derived[key]
+        except KeyError:
+            value = self._derived[key] = build(self)
+            return value
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def token_index_at(self, offset):
+        """Index of the token that contains the given source offset"""
+        lo, hi = 0, len(self.tokens)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.tokens[mid].end <= offset:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def splice(self, edits):
+        """Apply (start, end, replacement) edits and return the new stream
+
+        Only the tokens touched by an edit, plus one neighbour on each side
+        so that tokens merging across an edit boundary come out right, are
+        scanned again; every other token is reused with a shifted offset.
+        Edits must be sorted by offset and must not overlap.
+        """
+        if not edits:
+            return self
+        _edit_counter.count += len(edits)
+        tokens = self.tokens
+        source = self.source
+        count = len(tokens)
+
+        # Group edits into windows of whole tokens to re-scan
+        windows = []
+        prev_end = 0
+        for edit in edits:
+            start, end, _ = edit
+            if start < prev_end:
+                raise ValueError(f'overlapping edits at offset {start}')
+            prev_end = end
+            first = max(self.token_index_at(start) - 1, 0)
+            last = min(self.token_index_at(end) + 1, count)
+            if windows and first <= windows[-1][1]:
+                windows[-1][1] = max(last, windows[-1][1])
+                windows[-1][2].append(edit)
+            else:
+                windows.append([first, last, [edit]])
+
+        # Build the new source, remembering where each window landed
+        pieces = []
+        placed = []
+        src_pos = 0
+        shift = 0
+        for first, last, window_edits in windows:
+            win_start = tokens[first].start if first < count else len(source)
+            win_end = tokens[last - 1].end if last > first else win_start
+            pieces.append(source[src_pos:win_start])
+            pos = win_start
+            for start, end, replacement in window_edits:
+                pieces.append(source[pos:start])
+                pieces.append(replacement)
+                shift += len(replacement) - (end - start)
+                pos = end
+            pieces.append(source[pos:win_end])
+            new_start = win_start + placed[-1][4] if placed else win_start
+            placed.append((first, last, new_start, win_end + shift, shift))
+            src_pos = win_end
+        pieces.append(source[src_pos:])
+        new_source = ''.join(pieces)
+
+        new_tokens = []
+        tok_pos = 0
+        shift = 0
+        for first, last, new_start, new_end, next_shift in placed:
+            new_tokens.extend(_shifted(tokens[tok_pos:first], shift))
+            line_start = _line_start_after(new_tokens)
+            rescanned = _scan(new_source, new_start, new_end, line_start)
+            following = tokens[last] if last < count else None
+            if following is not None and rescanned and (
+                    _line_start_after(new_tokens, rescanned)
+                    != _line_start_before(tokens, last)
+                    or not _stable_boundary(
+                        rescanned[-1], following, new_source, next_shift,
+                        _line_start_after(new_tokens, rescanned[:-1]))):
+                # The edit opened a comment or directive that now runs past
+                # the window; scan everything that follows instead
+                new_tokens.extend(_scan(new_source, new_start, None, line_start))
+                return _remember(TokenStream(new_source, new_tokens))
+            new_tokens.extend(rescanned)
+            tok_pos = last
+            shift = next_shift
+        new_tokens.extend(_shifted(tokens[tok_pos:], shift))
+        return _remember(TokenStream(new_source, new_tokens))
+
+
+class _EditCounter(threading.local):
+    count = 0
+
+
+_edit_counter = _EditCounter()
+
+
+def edits_applied():
+    """Number of edits spliced into token streams on this thread so far"""
+    return _edit_counter.count
+
+
+def _stable_boundary(last_token, following, new_source, shift, line_start):
+    """True when re-scanning across the window end gives the same tokens"""
+    pair = _scan(new_source, last_token.start, following.end + shift, line_start)
+    return (len(pair) == 2 and pair[0] == last_token
+            and pair[1].kind == following.kind and pair[1].text == following.text)
+
+
+class RewriteConflict(ValueError):
+    """Raised when two edits recorded on a RewriteBuffer overlap"""
+
+    def __init__(self, first, second):
+        super().__init__(f'edit {second[:2]} -> {second[2]!r} overlaps '
+                         f'edit {first[:2]} -> {first[2]!r}')
+        self.edits = (first, second)
+
+
+class RewriteBuffer:
+    """Collects edits against one token stream and applies them in one go
+
+    Edits are (start, end, replacement) ranges of the original source, so
+    each one touches exactly the text it was matched on.  Overlapping edits
+    raise RewriteConflict when the buffer is applied; identical duplicates
+    are kept once.  Insertions at the same offset keep the order in which
+    they were recorded and go before a replacement starting there.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._edits = []
+
+    def replace(self, start, end, replacement):
+        if not 0 <= start <= end <= len(self.stream.source):
+            raise ValueError(f'edit range {start}:{end} outside the source')
+        self._edits.append((start, end, replacement))
+
+    def replace_token(self, tok, replacement):
+        self.replace(tok.start, tok.end, replacement)
+
+    def insert(self, offset, text):
+        self.replace(offset, offset, text)
+
+    def extend(self, edits):
+        for start, end, replacement in edits:
+            self.replace(start, end, replacement)
+
+    def __len__(self):
+        return len(self._edits)
+
+    def edits(self):
+        """The recorded edits sorted by offset, after checking for conflicts"""
+        order = sorted(range(len(self._edits)),
+                       key=lambda n: (self._edits[n][0], self._edits[n][1], n))
+        edits = []
+        reach = 0
+        for n in order:
+            edit = self._edits[n]
+            if edits and edit == edits[-1]:
+                continue
+            if edit[0] < reach:
+                raise RewriteConflict(edits[-1], edit)
+            edits.append(edit)
+            reach = max(reach, edit[1])
+        return edits
+
+    def apply(self):
+        """Return the rewritten token stream, built in a single pass"""
+        return self.stream.splice(self.edits())
+
+    def apply_source(self):
+        return self.apply().source
+
+
+def _shifted(tokens, shift):
+    if not shift:
+        return tokens
+    return [Token(tok.kind, tok.text, tok.start + shift) for tok in tokens]
+
+
+def _line_start_after(*token_lists):
+    """Whether a '#' following these tokens would start a directive"""
+    for tokens in reversed(token_lists):
+        for tok in reversed(tokens):
+            if tok.kind == WHITESPACE:
+                if '\n' in tok.text:
+                    return True
+            elif tok.kind != COMMENT:
+                return False
+    return True
+
+
+def _line_start_before(tokens, index):
+    """Same as _line_start_after(tokens[:index]) without the copy"""
+    for i in range(index - 1, -1, -1):
+        tok = tokens[i]
+        if tok.kind == WHITESPACE:
+            if '\n' in tok.text:
+                return True
+        elif tok.kind != COMMENT:
+            return False
+    return True
+
+
+_LEX_CACHE = OrderedDict()
+_LEX_CACHE_SIZE = 32
+
+
+def _remember(stream):
+    _LEX_CACHE[stream.source] = stream
+    _LEX_CACHE.move_to_end(stream.source)
+    while len(_LEX_CACHE) > _LEX_CACHE_SIZE:
+        _LEX_CACHE.popitem(last=False)
+    return stream
+
+
+def lex_glsl(source):
+    """Return the token stream for a GLSL source string
+
+    Streams are cached by source text, and streams produced by
+    TokenStream.splice() are cached too, so consecutive conversion stages
+    share one tokenization instead of re-scanning the text.
+    """
+    stream = _LEX_CACHE.get(source)
+    if stream is not None:
+        _LEX_CACHE.move_to_end(source)
+        return stream
+    return _remember(TokenStream(source, _scan(source)))
+
+
+def scan_glsl(source):
+    """Tokens of source, leaving the stream cache alone, for callers that
+    tokenize short-lived text off the conversion thread"""
+    return _scan(source)
+
+
+def clear_lex_cache():
+    """Forget every cached token stream, e.g. before timing a stage"""
+    _LEX_CACHE.clear()
+
+
+def directive_line_end(source, start):
+    """Offset of the newline ending the directive that starts at start"""
+    line_end = source.find('\n', start)
+    while line_end > 0 and source[line_end - 1] == '\\':
+        line_end = source.find('\n', line_end + 1)
+    return len(source) if line_end < 0 else line_end
+
+
+def matching_bracket(code, index):
+    """Index in code of the bracket closing the one at code[index], or None"""
+    if isinstance(code, CodeTokens):
+        return code.matching(index)
+    opening = code[index].text
+    closing = _CLOSING[opening]
+    depth = 0
+    for i in range(index, len(code)):
+        text = code[i].text
+        if text == opening:
+            depth += 1
+        elif text == closing:
+            depth -= 1
+            if depth == 0:
+                return i
+    return None
+
+
+def split_arguments(code, open_index, separator=','):
+    """Split a parenthesised argument list into code index ranges
+
+    Returns ([(first, stop), ...], close_index) where each argument spans
+    code[first:stop], or (None, None) when the parenthesis is unbalanced.
+    Commas nested in brackets do not split.  With separator ';' this
+    splits a for loop header into its three parts.
+    """
+    close = matching_bracket(code, open_index)
+    if close is None:
+        return None, None
+    args = []
+    first = open_index + 1
+    if isinstance(code, CodeTokens):
+        # Jump over nested brackets, so each comma is looked at only once
+        # per call and nested calls cost nothing extra here
+        i = first
+        while i < close:
+            text = code[i].text
+            if text == separator:
+                args.append((first, i))
+                first = i + 1
+            elif text in _CLOSING:
+                i = min(code.matching(i) or close, close)
+            i += 1
+    else:
+        depth = 0
+        for i in range(open_index + 1, close):
+            text = code[i].text
+            if text in '([{':
+                depth += 1
+            elif text in ')]}':
+                depth -= 1
+            elif text == separator and depth == 0:
+                args.append((first, i))
+                first = i + 1
+    if first < close or args:
+        args.append((first, close))
+    return args, close
+
+
+def source_span(stream, code, first, stop):
+    """Source text covered by code[first:stop], including inner comments"""
+    if first >= stop:
+        return ''
+    return stream.source[code[first].start:code[stop - 1].end]
+
+
+def statement_last(code, i):
+    """Index of the last token of the statement starting at code[i]"""
+    text = code[i].text
+    if text == '{':
+        return matching_bracket(code, i)
+    if text in ('if', 'while', 'for', 'switch') and i + 1 < len(code) and code[i + 1].text == '(':
+        close = matching_bracket(code, i + 1)
+        if close is None or close + 1 >= len(code):
+            return None
+        if text == 'switch':
+            return matching_bracket(code, close + 1)
+        last = statement_last(code, close + 1)
+        if text == 'if' and last is not None and last + 1 < len(code) \
+                and code[last + 1].text == 'else':
+            return statement_last(code, last + 2)
+        return last
+    if text == 'do':
+        last = statement_last(code, i + 1)
+        if last is None or last + 2 >= len(code) or code[last + 2].text != '(':
+            return None
+        close = matching_bracket(code, last + 2)
+        return None if close is None else close + 1
+    while i < len(code) and code[i].text != ';':
+        if code[i].text in ('(', '[', '{'):
+            i = matching_bracket(code, i)
+            if i is None:
+                return None
+        i += 1
+    return i if i < len(code) else None
@@ -0,0 +1,323 @@
+import bisect
+import re
+from collections import namedtuple
+
+from glsl_ast import function_bodies, literal
+from glsl_cost import loop_counter, shader_constants
+from glsl_lexer import (RewriteBuffer, lex_glsl, matching_bracket, source_span, split_arguments,
+                        statement_last)
+
+
+# Iterations a loop whose trip count cannot be proven is capped at by
+# bound_loops(); a loop that really needs more stops early
+LOOP_LIMIT = 1024
+
+# unroll_loops() unrolls loops of at most this many iterations whose body
+# times the trip count stays within this many tokens
+UNROLL_TRIP_COUNT = 8
+UNROLL_TOKENS = 512
+
+# Counters bound_loops() introduces are named _loopN
+_COUNTER_RE = re.compile(r'_loop\d+\Z')
+_COUNTER_TYPES = ('int', 'float')
+
+
+class LoopBound(namedtuple('LoopBound', 'function line kind trip_count capped')):
+    """A loop: trip_count is None unless it is a constant, and capped tells
+    the constant is the limit bound_loops() gave a loop it could not prove
+    bounded"""
+
+    __slots__ = ()
+
+    @property
+    def proven(self):
+        return self.trip_count is not None and not self.capped
+
+    def describe(self):
+        line = f'{self.kind} loop at line {self.line} in {self.function}: '
+        if self.capped:
+            return line + f'bound not proven, capped at {self.trip_count} iterations'
+        if self.trip_count is None:
+            return line + 'bound not proven'
+        return line + f'{self.trip_count} iterations'
+
+    def as_dict(self):
+        return {'function': self.function, 'line': self.line, 'kind': self.kind,
+                'trip_count': self.trip_count, 'capped': self.capped}
+
+
+# A loop statement in a token stream: kind is 'for', 'while' or 'do';
+# header the (init, condition, increment) ranges of a for loop, or the
+# condition range of the others; body the first and last token of the
+# body; last the last token of the whole loop
+_Loop = namedtuple('_Loop', 'index kind header body last')
+
+
+def _parse_loop(code, i):
+    """_Loop for the loop statement at code[i], or None"""
+    kind = code[i].text
+    if kind == 'do':
+        if i + 1 >= len(code):
+            return None
+        body_last = statement_last(code, i + 1)
+        if (body_last is None or body_last + 2 >= len(code)
+                or code[body_last + 1].text != 'while' or code[body_last + 2].text != '('):
+            return None
+        close = matching_bracket(code, body_last + 2)
+        if close is None or close + 1 >= len(code) or code[close + 1].text != ';':
+            return None
+        return _Loop(i, kind, (body_last + 3, close), (i + 1, body_last), close + 1)
+    if i + 2 >= len(code) or code[i + 1].text != '(':
+        return None
+    parts, close = split_arguments(code, i + 1, ';' if kind == 'for' else ',')
+    if parts is None or close + 1 >= len(code) or (kind == 'for' and len(parts) != 3):
+        return None
+    body_last = statement_last(code, close + 1)
+    if body_last is None:
+        return None
+    header = tuple(parts) if kind == 'for' else (i + 2, close)
+    return _Loop(i, kind, header, (close + 1, body_last), body_last)
+
+
+def _loops(code):
+    """Every loop statement in code, outer loops before the loops they contain"""
+    loops = []
+    for i, tok in enumerate(code):
+        if tok.text in ('for', 'while', 'do'):
+            # The while ending a do loop is not a loop of its own
+            if tok.text == 'while' and loops and loops[-1].kind == 'do' \
+                    and loops[-1].body[1] + 1 == i:
+                continue
+            loop = _parse_loop(code, i)
+            if loop is not None:
+                loops.append(loop)
+    return loops
+
+
+def _counter(code, loop, constants):
+    if loop.kind != 'for':
+        return None
+    return loop_counter(code, loop.header, (loop.body[0], loop.body[1] + 1), constants)
+
+
+def _capped(code, loop):
+    """Whether loop is a for loop over a counter bound_loops() introduced"""
+    init_first = loop.header[0][0] if loop.kind == 'for' else None
+    return (init_first is not None and init_first + 1 < len(code)
+            and _COUNTER_RE.match(code[init_first + 1].text) is not None)
+
+
+def analyze_loops(shader_code, constants=None):
+    """LoopBound for every loop in the function bodies of shader_code
+
+    Trip counts are worked out with glsl_cost.loop_counter(), with the
+    #define and const names of the shader as constants, plus constants.
+    """
+    stream = lex_glsl(shader_code)
+    code = stream.code
+    constants = shader_constants(stream, constants)
+    line_starts = [0] + [m.end() for m in re.finditer('\n', stream.source)]
+    functions = []
+    for params_open, body_open in function_bodies(code, stream.source):
+        # A body still being typed runs to the end of the code
+        functions.append((body_open, matching_bracket(code, body_open) or len(code),
+                          code[params_open - 1].text))
+    functions.sort()
+    bounds = []
+    for loop in _loops(code):
+        n = bisect.bisect_right(functions, (loop.index,)) - 1
+        if n < 0 or not functions[n][0] < loop.index < functions[n][1]:
+            continue
+        counter = _counter(code, loop, constants)
+        bounds.append(LoopBound(functions[n][2],
+                                bisect.bisect_right(line_starts, code[loop.index].start),
+                                loop.kind, counter and counter.trip_count,
+                                _capped(code, loop)))
+    return bounds
+
+
+def unbounded_loops(shader_code, constants=None):
+    """The loops of analyze_loops() whose trip count is not proven"""
+    return [loop for loop in analyze_loops(shader_code, constants) if not loop.proven]
+
+
+def _indentation(source, offset):
+    line_start = source.rfind('\n', 0, offset) + 1
+    line = source[line_start:offset]
+    return line[:len(line) - len(line.lstrip())]
+
+
+def _rewrite(shader_code, rewrite):
+    """Apply rewrite(stream, loop, buffer, names) to the outermost loops it
+    accepts, then to the loops inside them, until none is left
+
+    rewrite returns whether it rewrote the loop; names are the identifiers
+    taken so far, for naming new variables.
+    """
+    while True:
+        stream = lex_glsl(shader_code)
+        code = stream.code
+        buffer = RewriteBuffer(stream)
+        names = set(stream.identifiers)
+        # Loops come in order, so those inside a rewritten one start before
+        # its end
+        reach = -1
+        for loop in _loops(code):
+            if loop.index > reach and rewrite(stream, loop, buffer, names):
+                reach = loop.last
+        if reach < 0:
+            return shader_code
+        shader_code = buffer.apply_source()
+
+
+def _new_counter(names):
+    n = 0
+    while f'_loop{n}' in names:
+        n += 1
+    names.add(f'_loop{n}')
+    return f'_loop{n}'
+
+
+def _block_start(stream, first, last, statements):
+    """The '{' at code[first], opening a block that ends at code[last],
+    followed by statements laid out like the block's own"""
+    code = stream.code
+    source = stream.source
+    inner = code[first + 1]
+    if '\n' not in source[code[first].end:inner.start]:
+        return ' '.join(['{'] + statements)
+    indent = _indentation(source, inner.start)
+    if first + 1 == last:
+        indent = _indentation(source, code[first].start) + '    '
+    return '{' + ''.join(f'\n{indent}{statement}' for statement in statements)
+
+
+def _bound_loop(stream, loop, buffer, names, constants, limit):
+    code = stream.code
+    if loop.kind == 'for':
+        if _counter(code, loop, constants) is not None or _capped(code, loop):
+            return False
+        (init_first, init_stop), (cond_first, cond_stop), (step_first, step_stop) = loop.header
+        init = source_span(stream, code, init_first, init_stop)
+        condition = source_span(stream, code, cond_first, cond_stop)
+        increment = source_span(stream, code, step_first, step_stop)
+    else:
+        condition = source_span(stream, code, *loop.header)
+        init = increment = ''
+    if loop.kind == 'while' and condition == 'false':
+        return False
+    counter = _new_counter(names)
+    statements = []
+    if increment:
+        # At the top of the body, so that continue still runs it
+        statements.append(f'if({counter} > 0) {{ {increment}; }}')
+    if loop.kind == 'do':
+        statements.append(f'if({counter} > 0 && !({condition})) break;')
+    elif condition:
+        statements.append(f'if(!({condition})) break;')
+    head = f'for(int {counter} = 0; {counter} < {limit}; {counter}++) '
+    suffix = ''
+    if init:
+        # The braces keep what init declares local to the loop
+        head = f'{{ {init}; {head}'
+        suffix = ' }'
+    first, last = loop.body
+    if code[first].text == '{':
+        buffer.replace(code[loop.index].start, code[first].end,
+                       head + _block_start(stream, first, last, statements))
+    else:
+        buffer.replace(code[loop.index].start, code[first].start,
+                       head + '{ ' + ''.join(f'{statement} ' for statement in statements))
+        suffix = ' }' + suffix
+    if loop.kind == 'do':
+        # The condition moved to the top of the body
+        buffer.replace(code[last].end, code[loop.last].end, suffix)
+    elif suffix:
+        buffer.insert(code[last].end, suffix)
+    return True
+
+
+def bound_loops(shader_code, constants=None, limit=LOOP_LIMIT):
+    """shader_code with every loop whose trip count is not a constant
+    rewritten to count a new variable up to limit, breaking out when the
+    original condition fails
+
+    GLSL ES 1.0 drivers only have to accept for loops that count a
+    variable from a constant to a constant, so this is what lets such
+    loops run there.  While and do-while loops are rewritten too; for
+    loops with a constant trip count are left alone.  Loops that need more
+    than limit iterations end early, so unbounded_loops() lists every loop
+    that was rewritten.
+    """
+    stream = lex_glsl(shader_code)
+    constants = shader_constants(stream, constants)
+    return _rewrite(shader_code, lambda stream, loop, buffer, names: _bound_loop(
+        stream, loop, buffer, names, constants, limit))
+
+
+def _unrolled_iteration(stream, loop, declaration):
+    code = stream.code
+    source = stream.source
+    first, last = loop.body
+    if code[first].text != '{':
+        return f'{{ {declaration} {source[code[first].start:code[last].end]} }}'
+    return (_block_start(stream, first, last, [declaration])
+            + source[code[first].end:code[last].end])
+
+
+def _unroll_loop(stream, loop, buffer, constants, max_trip_count, max_tokens):
+    code = stream.code
+    counter = _counter(code, loop, constants)
+    if counter is None or not 0 < counter.trip_count <= max_trip_count:
+        return False
+    first, last = loop.body
+    if (last - first + 1) * counter.trip_count > max_tokens:
+        return False
+    # Only plain bodies: no jumps to the loop and no loops inside
+    if any(tok.text in ('break', 'continue', 'for', 'while', 'do', 'switch')
+           for tok in code[first:last + 1]):
+        return False
+    # The loop must declare the counter and nothing else
+    init_first, init_stop = loop.header[0]
+    if (init_stop - init_first < 4 or code[init_first].text not in _COUNTER_TYPES
+            or code[init_first + 1].text != counter.variable
+            or code[init_first + 2].text != '='
+            or any(tok.text == ',' for tok in code[init_first:init_stop])):
+        return False
+    type_name = code[init_first].text
+    iterations = []
+    for n in range(counter.trip_count):
+        value = counter.start + n * counter.step
+        value = literal(float(value) if type_name == 'float' else int(value),
+                        type_name == 'float')
+        if value is None:
+            return False
+        iterations.append(_unrolled_iteration(
+            stream, loop, f'const {type_name} {counter.variable} = {value.text};'))
+    start = code[loop.index].start
+    indent = _indentation(stream.source, start)
+    line_start = stream.source.rfind('\n', 0, start) + 1
+    # Minified code stays on one line
+    text = (f'\n{indent}' if line_start + len(indent) == start else ' ').join(iterations)
+    if loop.index and code[loop.index - 1].text in (')', 'else', 'do'):
+        # The loop is the body of another statement, which takes one
+        text = '{ ' + text + ' }'
+    buffer.replace(code[loop.index].start, code[loop.last].end, text)
+    return True
+
+
+def unroll_loops(shader_code, constants=None, max_trip_count=UNROLL_TRIP_COUNT,
+                 max_tokens=UNROLL_TOKENS):
+    """shader_code with small for loops of constant trip count unrolled
+
+    A loop is unrolled when it runs at most max_trip_count times, its body
+    repeated that often stays within max_tokens tokens, it declares its
+    int or float counter in its header and its body has no break,
+    continue, switch or loop.  Each copy of the body gets the counter as a
+    const, so the compiler can fold it and index arrays with it.  Inner
+    loops are unrolled first, so an outer loop can follow when the result
+    fits.
+    """
+    constants = shader_constants(lex_glsl(shader_code), constants)
+    return _rewrite(shader_code, lambda stream, loop, buffer, names: _unroll_loop(
+        stream, loop, buffer, constants, max_trip_count, max_tokens))
@@ -0,0 +1,675 @@
+import bisect
+import re
+from collections import namedtuple
+
+from glsl_analysis import KEYWORDS, MEMBER, PARAMETER, VARIABLE, build_usage_index
+from glsl_ast import (ASSIGN_OPERATORS, Assign, Binary, Call, Conditional, Index, Literal, Member,
+                      Name, Postfix, Unary, parse_expression, walk)
+from glsl_lexer import (IDENT, PREPROC, RewriteBuffer, lex_glsl, matching_bracket,
+                        split_arguments, statement_last)
+
+
+HIGHP = 'highp'
+MEDIUMP = 'mediump'
+PRECISIONS = frozenset(('lowp', MEDIUMP, HIGHP))
+
+# Values that outgrow mediump (a 10-bit mantissa, at least +-2^14): pixel
+# coordinates, and inputs that keep growing while the shader runs
+HIGHP_SOURCES = {
+    'gl_FragCoord': 'pixel coordinates',
+    'iTime': 'iTime grows without bound',
+    'iDate': 'iDate counts seconds of the day',
+    'iFrame': 'iFrame grows without bound',
+    'iChannelTime': 'iChannelTime grows without bound',
+    'iSampleRate': 'iSampleRate is above the mediump range',
+}
+
+# Built-ins whose result stays small whatever their arguments, so a highp
+# argument does not make the result highp (GLSL evaluates the call itself
+# at the precision of its arguments)
+_BOUNDED_CALLS = frozenset((
+    'sin', 'cos', 'fract', 'normalize', 'clamp', 'smoothstep', 'step', 'sign', 'tanh',
+    'texture', 'texture2D', 'textureLod', 'texture2DLod', 'textureCube', 'texelFetch',
+    'textureGrad', 'textureProj', 'texture2DProj',
+))
+
+# Dividing by the resolution turns pixel coordinates into UVs
+_RESOLUTION = 'iResolution'
+
+# Types that take a precision qualifier
+_QUALIFIABLE = frozenset(
+    ['float', 'int'] + [f'{prefix}vec{n}' for prefix in ('', 'i') for n in (2, 3, 4)]
+    + [f'mat{n}' for n in (2, 3, 4)] + [f'mat{c}x{r}' for c in (2, 3, 4) for r in (2, 3, 4)])
+
+# Defined ahead of the qualifiers: highp is optional in GLSL ES fragment
+# shaders, and desktop GLSL before 1.30 has no precision qualifiers at all
+PRECISION_GUARD = '''#if defined(GL_ES) && !defined(GL_FRAGMENT_PRECISION_HIGH)
+#define highp mediump
+#endif
+#if !defined(GL_ES) && __VERSION__ < 130
+#define lowp
+#define mediump
+#define highp
+#endif
+'''
+
+_LEADING_DIRECTIVE_RE = re.compile(r'#\s*(?:version|extension)\b')
+
+
+class VariablePrecision(namedtuple('VariablePrecision',
+                                   'function name line type precision reason')):
+    """Precision inferred for one declaration: function is None for globals
+    and struct members, name is 'return' for a function's return value and
+    'Struct.member' for a member; reason says what made it highp"""
+
+    __slots__ = ()
+
+    def as_dict(self):
+        return dict(self._asdict())
+
+
+class PrecisionDiagnostic(namedtuple('PrecisionDiagnostic', 'function name line message')):
+    """A declaration whose precision the inference could not settle"""
+
+    __slots__ = ()
+
+    def describe(self):
+        where = f'in {self.function}' if self.function else 'at global scope'
+        return f'line {self.line} {where}: {self.name} {self.message}'
+
+    def as_dict(self):
+        return dict(self._asdict())
+
+
+class PrecisionReport:
+    """Precision of every float and int declaration, with the ambiguous ones"""
+
+    def __init__(self):
+        self.variables = []
+        self.diagnostics = []
+
+    def highp(self):
+        return [variable for variable in self.variables if variable.precision == HIGHP]
+
+    def summary(self):
+        line = (f'{len(self.highp())} of {len(self.variables)} declarations need highp')
+        if self.diagnostics:
+            count = len(self.diagnostics)
+            line += f'; {count} ambiguous value{"s" if count > 1 else ""}'
+        return line
+
+    def as_dict(self):
+        return {
+            'variables': [variable.as_dict() for variable in self.variables],
+            'diagnostics': [diagnostic.as_dict() for diagnostic in self.diagnostics],
+        }
+
+
+# A function definition or prototype: the index of its return type, of the
+# '(' of its parameters and the parameter ranges
+_Function = namedtuple('_Function', 'name type_index params_open params body_open')
+
+
+def _functions(code, source):
+    """Every function definition and prototype at global scope"""
+    functions = []
+    depth = 0
+    i = 0
+    count = len(code)
+    while i < count:
+        tok = code[i]
+        text = tok.text
+        if tok.kind == PREPROC:
+            i += 1
+            continue
+        if text in ('{', '('):
+            depth += 1
+        elif text in ('}', ')'):
+            depth -= 1
+        elif (not depth and tok.kind == IDENT and i + 2 < count and code[i + 1].kind == IDENT
+              and code[i + 2].text == '('):
+            params, close = split_arguments(code, i + 2)
+            if params is None:
+                break
+            if len(params) == 1 and params[0][1] - params[0][0] == 1 \
+                    and code[params[0][0]].text == 'void':
+                params = []
+            body_open = close + 1 if close + 1 < count and code[close + 1].text == '{' else None
+            functions.append(_Function(code[i + 1].text, i, i + 2, params, body_open))
+            i = matching_bracket(code, body_open) if body_open is not None else close
+            if i is None:
+                break
+        i += 1
+    return functions
+
+
+def _value_end(code, i):
+    """Index of the ',', ';' or unmatched bracket ending the expression at i"""
+    while i < len(code) and code[i].text not in (',', ';', ')', ']', '}'):
+        if code[i].text in ('(', '[', '{'):
+            close = matching_bracket(code, i)
+            if close is None:
+                return len(code)
+            i = close
+        i += 1
+    return i
+
+
+def _loop_ranges(code):
+    """(first, last) token ranges of every loop body"""
+    ranges = []
+    for i, tok in enumerate(code):
+        if tok.text == 'do' and i + 1 < len(code):
+            last = statement_last(code, i + 1)
+            if last is not None:
+                ranges.append((i + 1, last))
+        elif tok.text in ('for', 'while') and i + 1 < len(code) and code[i + 1].text == '(':
+            close = matching_bracket(code, i + 1)
+            if close is not None and close + 1 < len(code):
+                last = statement_last(code, close + 1)
+                if last is not None:
+                    ranges.append((close + 1, last))
+    return ranges
+
+
+def _structs(code, declarations):
+    """Struct name -> {member name: member declaration}"""
+    members = sorted((decl.index, decl) for decl in declarations if decl.role == MEMBER)
+    starts = [index for index, _ in members]
+    structs = {}
+    for i, tok in enumerate(code):
+        if (tok.text == 'struct' and i + 2 < len(code) and code[i + 1].kind == IDENT
+                and code[i + 2].text == '{'):
+            close = matching_bracket(code, i + 2)
+            if close is None:
+                continue
+            structs[code[i + 1].text] = {
+                decl.name: decl
+                for _, decl in members[bisect.bisect_left(starts, i + 2):
+                                       bisect.bisect_left(starts, close)]}
+    return structs
+
+
+def _mentions(node, name):
+    return any(type(child) is Name and child.name == name for child in walk(node))
+
+
+class _Inference:
+    """Propagates highp through the assignments, calls and returns of one shader"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.code = code = stream.code
+        self.index = index = build_usage_index(stream)
+        self.uses = {use.index: use for uses in index.uses.values() for use in uses}
+        self.line_starts = [0] + [m.end() for m in re.finditer('\n', stream.source)]
+        self.functions = _functions(code, stream.source)
+        self.signatures = {(function.name, len(function.params)) for function in self.functions}
+        self.return_types = {(function.name, len(function.params)): code[function.type_index].text
+                             for function in self.functions}
+        self.structs = _structs(code, index.declarations)
+
+        # Parameters are keyed by their function and position, so that a
+        # prototype and its definition agree
+        self.positions = {}
+        for function in self.functions:
+            for position, (first, stop) in enumerate(function.params):
+                for i in range(first, stop):
+                    self.positions[i] = (function.name, len(function.params), position)
+
+        self.nodes = {}       # node key -> (function, name, line, type, declared precision)
+        self.declarations = {}
+        for decl in index.declarations:
+            if decl.type not in _QUALIFIABLE or decl.role not in (VARIABLE, PARAMETER):
+                continue
+            key = self.key(decl)
+            declared = next((q for q in decl.qualifiers if q in PRECISIONS), None)
+            if key not in self.nodes or self.nodes[key][4] is None:
+                self.nodes[key] = (decl.scope.function, decl.name, self.line(decl.index),
+                                   decl.type, declared)
+            self.declarations[decl] = key
+        # A member has one precision wherever its struct is used
+        for struct, members in self.structs.items():
+            for name, decl in members.items():
+                if decl.type in _QUALIFIABLE:
+                    key = ('member', struct, name)
+                    declared = next((q for q in decl.qualifiers if q in PRECISIONS), None)
+                    self.nodes[key] = (None, f'{struct}.{name}', self.line(decl.index),
+                                       decl.type, declared)
+                    self.declarations[decl] = key
+        for function in self.functions:
+            type_name = code[function.type_index].text
+            if type_name in _QUALIFIABLE:
+                key = ('return', function.name, len(function.params))
+                declared = code[function.type_index - 1].text if function.type_index else None
+                self.nodes.setdefault(key, (function.name, 'return',
+                                            self.line(function.type_index), type_name,
+                                            declared if declared in PRECISIONS else None))
+
+        self.state = {}
+        for key, (_, name, _, _, declared) in self.nodes.items():
+            if declared == HIGHP:
+                self.state[key] = f'declared {HIGHP}'
+        self.outputs = set()
+        for decl, key in self.declarations.items():
+            # Uniforms, whether declared alone or in a block
+            if decl.scope.function is None and decl.name in HIGHP_SOURCES:
+                self.state[key] = HIGHP_SOURCES[decl.name]
+            if decl.role == PARAMETER and {'out', 'inout'} & set(decl.qualifiers):
+                self.outputs.add(key)
+        self.flows = {key: [] for key in self.nodes}
+        self.call_sites = {}   # parameter key -> [(line, argument node)]
+        self.ray_reasons = set()
+        self.diagnostics = []
+        self._collect_flows()
+
+    def key(self, decl):
+        if decl.role == PARAMETER and decl.index in self.positions:
+            return ('param',) + self.positions[decl.index]
+        return decl
+
+    def line(self, index):
+        return bisect.bisect_right(self.line_starts, self.code[index].start)
+
+    def struct_type(self, node):
+        """The struct the value of node is an instance of, or None"""
+        kind = type(node)
+        if kind is Name:
+            use = self.uses.get(node.first)
+            decl = use.declaration if use is not None else None
+            type_name = decl.type if decl is not None else None
+        elif kind is Call:
+            type_name = self.return_types.get((node.name, len(node.args)), node.name)
+        elif kind is Member:
+            struct = self.struct_type(node.value)
+            member = self.structs[struct].get(node.field) if struct is not None else None
+            type_name = member.type if member is not None else None
+        elif kind in (Index, Assign):
+            return self.struct_type(node.value if kind is Index else node.target)
+        elif kind is Conditional:
+            return self.struct_type(node.then)
+        else:
+            return None
+        return type_name if type_name in self.structs else None
+
+    def _member_target(self, use, stop):
+        """Key of the member the access chain from use up to stop writes,
+        e.g. hit.dist in hit.dist = t, or None"""
+        code = self.code
+        struct = use.declaration.type
+        target = None
+        j = use.index + 1
+        while j < stop:
+            if code[j].text == '.':
+                member = self.structs[struct].get(code[j + 1].text) if struct in self.structs else None
+                if member is None:
+                    break  # a swizzle
+                if ('member', struct, member.name) in self.nodes:
+                    target = ('member', struct, member.name)
+                struct = member.type
+                j += 2
+            else:
+                j = (matching_bracket(code, j) or len(code)) + 1
+        return target
+
+    def parse(self, first, stop):
+        return parse_expression(self.code, first, stop) if first < stop else None
+
+    def _collect_flows(self):
+        code = self.code
+        # Values given to every declaration, qualifiable or not (a struct
+        # can carry a distance)
+        self.assigned = {}
+        for decl in self.index.declarations:
+            if decl.initialized:
+                value = self.parse(decl.index + 2, _value_end(code, decl.index + 2))
+                if value is not None:
+                    self.assigned.setdefault(decl, []).append(value)
+
+        # Assignments, including to components and elements
+        self.accumulations = []
+        for use in self.uses.values():
+            if use.declaration is None:
+                continue
+            j = use.index + 1
+            while j + 1 < len(code):
+                if code[j].text == '.' and code[j + 1].kind == IDENT:
+                    j += 2
+                elif code[j].text == '[':
+                    j = (matching_bracket(code, j) or len(code)) + 1
+                else:
+                    break
+            if j < len(code) and code[j].text in ASSIGN_OPERATORS:
+                value = self.parse(j + 1, _value_end(code, j + 1))
+                if value is not None:
+                    self.assigned.setdefault(use.declaration, []).append(value)
+                    member = self._member_target(use, j)
+                    if member is not None:
+                        self.flows[member].append(value)
+                    key = self.declarations.get(use.declaration)
+                    if key is not None and code[j].text == '+=' and j == use.index + 1:
+                        self.accumulations.append((use, key, value))
+        for decl, values in self.assigned.items():
+            key = self.declarations.get(decl)
+            if key is not None:
+                self.flows[key].extend(values)
+
+        # Arguments flow into parameters, out parameters back into
+        # arguments, and constructor arguments into struct members
+        for i, tok in enumerate(code):
+            if tok.kind != IDENT or i + 1 >= len(code) or code[i + 1].text != '(':
+                continue
+            if i and code[i - 1].kind == IDENT and code[i - 1].text not in KEYWORDS:
+                continue  # a definition or prototype
+            args, _ = split_arguments(code, i + 1)
+            if args is not None and tok.text in self.structs:
+                members = self.structs[tok.text]
+                if len(args) == len(members):
+                    for decl, (first, stop) in zip(sorted(members.values(),
+                                                          key=lambda decl: decl.index), args):
+                        value = self.parse(first, stop)
+                        if value is not None and ('member', tok.text, decl.name) in self.nodes:
+                            self.flows[('member', tok.text, decl.name)].append(value)
+                continue
+            if args is None or (tok.text, len(args)) not in self.signatures:
+                continue
+            for position, (first, stop) in enumerate(args):
+                param = ('param', tok.text, len(args), position)
+                if param not in self.nodes:
+                    continue
+                value = self.parse(first, stop)
+                if value is None:
+                    continue
+                self.flows[param].append(value)
+                self.call_sites.setdefault(param, []).append((self.line(i), value))
+                use = self.uses.get(first)
+                target = self.declarations.get(use.declaration) if use else None
+                if target is not None and param in self.outputs:
+                    self.flows[target].append(param)
+
+        # Returns flow into the function's return value
+        for function in self.functions:
+            if function.body_open is None:
+                continue
+            key = ('return', function.name, len(function.params))
+            if key not in self.nodes:
+                continue
+            close = matching_bracket(code, function.body_open)
+            for i in range(function.body_open + 1, close or function.body_open):
+                if code[i].text == 'return':
+                    value = self.parse(i + 1, _value_end(code, i + 1))
+                    if value is not None:
+                        self.flows[key].append(value)
+
+    def carries(self, node):
+        """Why the value of node needs highp, or None"""
+        kind = type(node)
+        if kind is Name:
+            use = self.uses.get(node.first)
+            decl = use.declaration if use is not None else None
+            if decl is None:
+                return HIGHP_SOURCES.get(node.name)
+            key = self.declarations.get(decl)
+            return self.state.get(key) if key is not None else None
+        if kind is Literal:
+            return None
+        if kind is Call:
+            if (node.name, len(node.args)) in self.signatures:
+                return self.state.get(('return', node.name, len(node.args)))
+            if node.name in _BOUNDED_CALLS:
+                return None
+            if node.name == 'mod' and len(node.args) == 2:
+                return self.carries(node.args[1])
+            return self._any(node.args)
+        if kind is Binary:
+            if node.op == '/' and _mentions(node.right, _RESOLUTION):
+                return self.carries(node.right)
+            return self._any((node.left, node.right))
+        if kind is Conditional:
+            return self._any((node.then, node.otherwise))
+        if kind is Assign:
+            return self.carries(node.value)
+        if kind is Member:
+            struct = self.struct_type(node.value)
+            if struct is not None:
+                return self.state.get(('member', struct, node.field))
+            return self.carries(node.value)
+        if kind is Index:
+            return self.carries(node.value)
+        if kind in (Unary, Postfix):
+            return self.carries(node.operand)
+        return None
+
+    def _any(self, nodes):
+        for node in nodes:
+            reason = self.carries(node)
+            if reason is not None:
+                return reason
+        return None
+
+    def _calls_function(self, node, depth=1):
+        """Whether node uses the result of one of the shader's functions,
+        directly or through a local assigned from one"""
+        for child in walk(node):
+            if type(child) is Call and (child.name, len(child.args)) in self.signatures:
+                return True
+            if depth and type(child) is Name:
+                use = self.uses.get(child.first)
+                if use is not None and any(self._calls_function(value, depth - 1)
+                                           for value in self.assigned.get(use.declaration, ())):
+                    return True
+        return False
+
+    def _find_distances(self):
+        """Seed scalars that a loop accumulates from a distance function"""
+        loops = _loop_ranges(self.code)
+        for use, key, value in self.accumulations:
+            function, name, _, type_name, _ = self.nodes[key]
+            if type_name != 'float' or key in self.state:
+                continue
+            if not any(first <= use.index <= last for first, last in loops):
+                continue
+            if self._calls_function(value):
+                self.state[key] = f'{name} is a ray distance'
+                self.ray_reasons.add(self.state[key])
+            else:
+                self.diagnostics.append(PrecisionDiagnostic(
+                    function, name, self.line(use.index),
+                    'is accumulated in a loop; mediump may lose precision as it grows'))
+
+    def _value_key(self, node):
+        """Key of the variable or struct member node reads, or None"""
+        if type(node) is Name:
+            use = self.uses.get(node.first)
+            return self.declarations.get(use.declaration) if use and use.declaration else None
+        if type(node) is Member:
+            struct = self.struct_type(node.value)
+            key = ('member', struct, node.field)
+            return key if struct is not None and key in self.nodes else None
+        return None
+
+    def _is_distance(self, node):
+        key = self._value_key(node)
+        return (key is not None and self.nodes[key][3] == 'float'
+                and self.state.get(key) in self.ray_reasons)
+
+    def _find_rays(self):
+        """Give highp to the vectors of ray equations ro + rd * t where t is
+        a ray distance: mediump would lose rd's error times t, and ro's
+        error, from the position.  Returns whether any changed."""
+        changed = False
+
+        def seed(node, reason):
+            nonlocal changed
+            key = self._value_key(node)
+            if key is not None and key not in self.state and self.nodes[key][3].startswith('vec'):
+                self.state[key] = f'{self.nodes[key][1]} {reason}'
+                changed = True
+
+        for flows in self.flows.values():
+            for flow in flows:
+                if type(flow) is tuple:
+                    continue
+                for node in walk(flow):
+                    if type(node) is not Binary:
+                        continue
+                    if node.op == '*':
+                        for vector, distance in ((node.left, node.right),
+                                                 (node.right, node.left)):
+                            if self._is_distance(distance):
+                                seed(vector, 'is a ray direction')
+                    elif node.op in ('+', '-'):
+                        for origin, step in ((node.left, node.right), (node.right, node.left)):
+                            if type(step) is Binary and step.op == '*' and (
+                                    self._is_distance(step.left)
+                                    or self._is_distance(step.right)):
+                                seed(origin, 'is a ray origin')
+        return changed
+
+    def _push_arguments(self):
+        """Give highp to the variables passed to a parameter that needs it for
+        what its function does rather than for what a call passes in: a
+        mediump argument would be rounded before the call.  Returns whether
+        any changed."""
+        changed = False
+        for param, sites in self.call_sites.items():
+            if param not in self.state or any(self.carries(value) is not None
+                                              for _, value in sites):
+                continue
+            function, name = self.nodes[param][:2]
+            for _, value in sites:
+                # A swizzle of a vector passes that vector's components
+                while type(value) is Member and self.struct_type(value.value) is None:
+                    value = value.value
+                key = self._value_key(value)
+                if key is not None and key not in self.state:
+                    self.state[key] = (f'{self.nodes[key][1]} is passed as {name} '
+                                       f'to {function}()')
+                    changed = True
+        return changed
+
+    def _propagate(self):
+        changed = True
+        while changed:
+            changed = False
+            for key, flows in self.flows.items():
+                if key in self.state:
+                    continue
+                for flow in flows:
+                    reason = self.state.get(flow) if type(flow) is tuple else self.carries(flow)
+                    if reason is not None:
+                        self.state[key] = reason
+                        changed = True
+                        break
+
+    def run(self):
+        self._find_distances()
+        self._propagate()
+        while self._find_rays() | self._push_arguments():
+            self._propagate()
+        for param, sites in self.call_sites.items():
+            if param in self.state:
+                mediump = sorted({line for line, value in sites if self.carries(value) is None})
+                if mediump:
+                    function, name, line, _, _ = self.nodes[param]
+                    calls = (f'the calls at lines {", ".join(map(str, mediump))} pass mediump '
+                             f'values' if len(mediump) > 1
+                             else f'the call at line {mediump[0]} passes a mediump value')
+                    self.diagnostics.append(PrecisionDiagnostic(
+                        function, name, line, f'is highp but {calls}'))
+        for key, (function, name, line, _, declared) in self.nodes.items():
+            if declared in ('lowp', MEDIUMP) and key in self.state:
+                self.diagnostics.append(PrecisionDiagnostic(
+                    function, name, line,
+                    f'is declared {declared} but may need highp: {self.state[key]}'))
+
+    def precision(self, key):
+        declared = self.nodes[key][4]
+        if declared is not None:
+            return declared
+        return HIGHP if key in self.state else MEDIUMP
+
+
+def _inference(stream):
+    inference = _Inference(stream)
+    inference.run()
+    return inference
+
+
+def infer_precision(shader_code):
+    """PrecisionReport for the float and int declarations of shader_code
+
+    A value needs highp when it depends on gl_FragCoord, a uniform that
+    grows without bound (iTime, iFrame, ...), or a ray distance: a scalar
+    a loop accumulates from one of the shader's functions.  The origin
+    and direction vectors of a ray equation ro + rd * t with such a
+    distance need it too, and so do the variables passed to a parameter
+    that needs it for what its function does with it.  Dependence follows
+    assignments, calls into parameters and returns, struct members and
+    constructors; bounded built-ins (sin, fract, normalize, texture, ...)
+    and division by iResolution stop it, so colors and UVs stay mediump.
+    Other loop accumulators, highp parameters passed mediump values and
+    declarations whose written precision disagrees are reported as
+    diagnostics.
+    """
+    inference = _inference(lex_glsl(shader_code))
+    report = PrecisionReport()
+    for key, (function, name, line, type_name, _) in inference.nodes.items():
+        report.variables.append(VariablePrecision(
+            function, name, line, type_name, inference.precision(key), inference.state.get(key)))
+    report.variables.sort(key=lambda variable: variable.line)
+    report.diagnostics = sorted(inference.diagnostics, key=lambda diagnostic: diagnostic.line)
+    return report
+
+
+def _guard_offset(stream):
+    """Offset after the leading #version and #extension lines"""
+    offset = 0
+    for tok in stream.code:
+        if tok.kind != PREPROC or not _LEADING_DIRECTIVE_RE.match(tok.text):
+            break
+        line_end = stream.source.find('\n', tok.start)
+        offset = len(stream.source) if line_end < 0 else line_end + 1
+    return offset
+
+
+def qualify_precision(shader_code):
+    """shader_code with a precision qualifier on every float and int declaration
+
+    Precisions come from infer_precision(); declarations that already have
+    one keep it.  A declaration of several names gets highp if any of them
+    needs it.  PRECISION_GUARD goes after the #version and #extension lines,
+    so the output still compiles where highp or qualifiers are missing.
+    """
+    stream = lex_glsl(shader_code)
+    code = stream.code
+    inference = _inference(stream)
+
+    # Declarations of several names share the qualifier before their type
+    groups = {}
+    last_group = {}
+    for decl, key in sorted(inference.declarations.items(), key=lambda item: item[0].index):
+        if decl.index and code[decl.index - 1].text == decl.type:
+            type_index = decl.index - 1
+            last_group[decl.scope, decl.type] = type_index
+        else:
+            type_index = last_group.get((decl.scope, decl.type))
+            if type_index is None:
+                continue
+        groups.setdefault(type_index, []).append(key)
+    for function in inference.functions:
+        key = ('return', function.name, len(function.params))
+        if key in inference.nodes:
+            groups[function.type_index] = [key]
+
+    buffer = RewriteBuffer(stream)
+    for type_index, keys in groups.items():
+        if type_index and code[type_index - 1].text in PRECISIONS:
+            continue
+        precisions = {inference.precision(key) for key in keys}
+        precision = HIGHP if HIGHP in precisions else MEDIUMP
+        buffer.insert(code[type_index].start, f'{precision} ')
+    if not len(buffer):
+        return shader_code
+    buffer.insert(_guard_offset(stream), PRECISION_GUARD)
+    return buffer.apply_source()
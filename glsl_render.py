@@ -0,0 +1,1330 @@
+import math
+import struct
+import zlib
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError:
+    # Only rendering needs NumPy; converting shaders does not
+    np = None
+
+from glsl_analysis import BUILTIN_TYPES, QUALIFIERS
+from glsl_ast import (Assign, Binary, Call, Conditional, Index, Literal, Member, Name, Postfix,
+                      Unary, parse_expression, preprocessor_value)
+from glsl_lexer import (IDENT, PREPROC, directive_line_end, lex_glsl, matching_bracket,
+                        source_span, split_arguments)
+
+
+class RenderError(ValueError):
+    """The shader uses something the reference renderer cannot run"""
+
+
+# Uniforms Shadertoy provides without a declaration, so shaders can be
+# rendered before they are converted; declarations in the shader win
+SHADERTOY_UNIFORMS = {
+    'iResolution': ('vec3', None), 'iTime': ('float', None), 'iGlobalTime': ('float', None),
+    'iTimeDelta': ('float', None), 'iFrameRate': ('float', None), 'iFrame': ('int', None),
+    'iMouse': ('vec4', None), 'iDate': ('vec4', None), 'iSampleRate': ('float', None),
+    'iChannelTime': ('float', 4), 'iChannelResolution': ('vec3', 4),
+    'iChannel0': ('sampler2D', None), 'iChannel1': ('sampler2D', None),
+    'iChannel2': ('sampler2D', None), 'iChannel3': ('sampler2D', None),
+}
+
+# Loops running longer than this are taken to never end
+MAX_ITERATIONS = 10000
+
+# Calls nested deeper than this mean recursion, which GLSL forbids
+_MAX_CALL_DEPTH = 64
+
+# type name -> (NumPy dtype, shape of one value)
+_TYPES = {'float': ('float32', ()), 'int': ('int32', ()), 'uint': ('uint32', ()),
+          'bool': ('bool', ())}
+for _n in (2, 3, 4):
+    _TYPES[f'vec{_n}'] = ('float32', (_n,))
+    _TYPES[f'ivec{_n}'] = ('int32', (_n,))
+    _TYPES[f'uvec{_n}'] = ('uint32', (_n,))
+    _TYPES[f'bvec{_n}'] = ('bool', (_n,))
+    _TYPES[f'mat{_n}'] = ('float32', (_n, _n))
+    for _rows in (2, 3, 4):
+        _TYPES[f'mat{_n}x{_rows}'] = ('float32', (_n, _rows))
+
+_SWIZZLE_SETS = ('xyzw', 'rgba', 'stpq')
+
+_TEXTURE_FUNCTIONS = frozenset((
+    'texture', 'texture2D', 'texture2DLod', 'textureLod', 'texture2DProj', 'textureProj',
+    'textureGrad', 'texelFetch', 'textureCube', 'textureCubeLod', 'texture3D',
+))
+
+
+def _identifier(text):
+    return text[:1].isalpha() or text[:1] == '_'
+
+
+# Preprocessing.  Macros are (parameters or None, body tokens).
+
+def _expand(tokens, macros, hidden=frozenset()):
+    """tokens with every macro replaced by its expansion"""
+    out = []
+    i = 0
+    count = len(tokens)
+    while i < count:
+        text = tokens[i]
+        macro = macros.get(text) if text not in hidden else None
+        if macro is None:
+            out.append(text)
+            i += 1
+            continue
+        params, body = macro
+        if params is None:
+            out.extend(_expand(body, macros, hidden | {text}))
+            i += 1
+            continue
+        if i + 1 >= count or tokens[i + 1] != '(':
+            out.append(text)
+            i += 1
+            continue
+        args = [[]]
+        depth = 0
+        i += 2
+        while i < count:
+            arg = tokens[i]
+            i += 1
+            if arg in ('(', '[', '{'):
+                depth += 1
+            elif arg in (')', ']', '}'):
+                if depth == 0:
+                    break
+                depth -= 1
+            elif arg == ',' and depth == 0:
+                args.append([])
+                continue
+            args[-1].append(arg)
+        else:
+            raise RenderError(f'unterminated call of macro {text}')
+        if args == [[]]:
+            args = []
+        if len(args) != len(params):
+            raise RenderError(f'macro {text} takes {len(params)} arguments, not {len(args)}')
+        values = {param: _expand(arg, macros, hidden) for param, arg in zip(params, args)}
+        body = [item for token in body for item in values.get(token, (token,))]
+        out.extend(_expand(body, macros, hidden | {text}))
+    return out
+
+
+def _condition(tokens, macros):
+    resolved = []
+    i = 0
+    while i < len(tokens):
+        if tokens[i] == 'defined':
+            if i + 3 < len(tokens) and tokens[i + 1] == '(':
+                name, i = tokens[i + 2], i + 4
+            elif i + 1 < len(tokens):
+                name, i = tokens[i + 1], i + 2
+            else:
+                raise RenderError('defined without a name')
+            resolved.append('1' if name in macros else '0')
+            continue
+        resolved.append(tokens[i])
+        i += 1
+    # Names left after expansion are not macros and count as 0
+    resolved = ['1' if text == 'true' else '0' if _identifier(text) else text
+                for text in _expand(resolved, macros)]
+    stream = lex_glsl(' '.join(resolved))
+    node = parse_expression(stream.code, 0, len(stream.code))
+    try:
+        if node is None:
+            raise ValueError('not an expression')
+        return bool(preprocessor_value(node))
+    except ValueError as e:
+        raise RenderError(f'cannot evaluate #if {" ".join(tokens)}: {e}') from None
+
+
+def preprocess(shader_code):
+    """Code tokens of shader_code after the preprocessor, as text
+
+    Conditionals are evaluated as a desktop compiler would (GL_ES is not
+    defined) and macros are expanded; #version, #extension and #pragma
+    lines are dropped.  Token pasting is not supported.
+    """
+    stream = lex_glsl(shader_code)
+    code = stream.code
+    count = len(code)
+    macros = {}
+    out = []
+    pending = []
+    conditions = []  # [enclosing block active, a branch was taken]
+    active = True
+    i = 0
+    while i < count:
+        tok = code[i]
+        if tok.kind != PREPROC:
+            if active:
+                pending.append(tok.text)
+            i += 1
+            continue
+        line_end = directive_line_end(stream.source, tok.start)
+        j = i + 1
+        while j < count and code[j].start < line_end:
+            j += 1
+        words = tok.text[1:].split()
+        directive = words[0] if words else ''
+        args = [item.text for item in code[i + 1:j]]
+        if directive in ('if', 'ifdef', 'ifndef'):
+            taken = active and (
+                _condition(args, macros) if directive == 'if'
+                else (args[:1] and args[0] in macros) == (directive == 'ifdef'))
+            conditions.append([active, bool(taken) or not active])
+            active = bool(taken)
+        elif directive in ('elif', 'else'):
+            if not conditions:
+                raise RenderError(f'#{directive} without #if')
+            enclosing, taken = conditions[-1]
+            active = not taken and (directive == 'else' or _condition(args, macros))
+            conditions[-1][1] = taken or active
+        elif directive == 'endif':
+            if not conditions:
+                raise RenderError('#endif without #if')
+            active = conditions.pop()[0]
+        elif not active:
+            pass
+        elif directive in ('define', 'undef'):
+            out.extend(_expand(pending, macros))
+            pending = []
+            if not args or not _identifier(args[0]):
+                raise RenderError(f'#{directive} without a name')
+            if directive == 'undef':
+                macros.pop(args[0], None)
+            elif i + 2 < j and args[1] == '(' and code[i + 2].start == code[i + 1].end:
+                close = args.index(')')
+                params = [text for text in args[2:close] if text != ',']
+                macros[args[0]] = (params, args[close + 1:])
+            else:
+                macros[args[0]] = (None, args[1:])
+            if args[0] in macros and '#' in macros[args[0]][1]:
+                raise RenderError(f'macro {args[0]} pastes tokens, which is not supported')
+        elif directive == 'error':
+            raise RenderError(f'#error {" ".join(args)}')
+        i = j
+    out.extend(_expand(pending, macros))
+    return out
+
+
+# Values.  Scalars are arrays of shape (lanes,), vectors (lanes, n) and
+# matrices (lanes, columns, rows); lanes is 1 for values every pixel shares.
+
+class _Array:
+    __slots__ = ('elements',)
+
+    def __init__(self, elements):
+        self.elements = elements
+
+
+class _Struct:
+    __slots__ = ('name', 'fields')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+
+class _Sampler:
+    __slots__ = ('image',)
+
+    def __init__(self, image):
+        self.image = image
+
+
+def _select(mask, new, old):
+    """new where mask is set and old elsewhere"""
+    if isinstance(new, np.ndarray):
+        shape = mask.shape + (1,) * (max(new.ndim, old.ndim) - 1)
+        return np.where(mask.reshape(shape), new, old)
+    if isinstance(new, _Array):
+        return _Array([_select(mask, a, b) for a, b in zip(new.elements, old.elements)])
+    if isinstance(new, _Struct):
+        return _Struct(new.name, {name: _select(mask, value, old.fields[name])
+                                  for name, value in new.fields.items()})
+    return new
+
+
+def _lanes(*values):
+    return max(value.shape[0] for value in values)
+
+
+def _widen(value, lanes):
+    if value.shape[0] == lanes:
+        return value
+    return np.broadcast_to(value, (lanes,) + value.shape[1:])
+
+
+def _aligned(*values):
+    """values with scalars given trailing axes to combine with vectors"""
+    ndim = max(value.ndim for value in values)
+    return [value.reshape(value.shape + (1,) * (ndim - value.ndim))
+            if 1 == value.ndim < ndim else value for value in values]
+
+
+def _floats(*values):
+    return _aligned(*(value if value.dtype == np.float32 else value.astype(np.float32)
+                      for value in values))
+
+
+def _promoted(left, right):
+    if left.dtype == right.dtype:
+        return left, right
+    if np.float32 in (left.dtype, right.dtype):
+        return left.astype(np.float32), right.astype(np.float32)
+    if np.uint32 in (left.dtype, right.dtype):
+        return left.astype(np.uint32), right.astype(np.uint32)
+    return left.astype(np.int32), right.astype(np.int32)
+
+
+def _scalar(value):
+    """First component of value, as GLSL's scalar constructors take it"""
+    return value if value.ndim == 1 else value.reshape(value.shape[0], -1)[:, 0]
+
+
+def _convert(value, type_name):
+    info = _TYPES.get(type_name)
+    if info is None or not isinstance(value, np.ndarray):
+        return value
+    dtype, shape = info
+    if value.shape[1:] != shape:
+        if value.ndim != 1 or not shape:
+            raise RenderError(f'cannot use a value of shape {value.shape[1:]} as {type_name}')
+        value = np.broadcast_to(value.reshape(value.shape + (1,) * len(shape)),
+                                value.shape + shape)
+    return value.astype(dtype, copy=False)
+
+
+def _construct(type_name, args):
+    dtype, shape = _TYPES[type_name]
+    if not args:
+        raise RenderError(f'{type_name}() needs arguments')
+    if not shape:
+        return _scalar(args[0]).astype(dtype)
+    lanes = _lanes(*args)
+    if len(shape) == 2 and len(args) == 1 and args[0].ndim != 2:
+        columns, rows = shape
+        result = np.zeros((lanes,) + shape, np.float32)
+        source = args[0]
+        if source.ndim == 1:
+            for k in range(min(columns, rows)):
+                result[:, k, k] = source
+        else:
+            for k in range(min(columns, rows)):
+                result[:, k, k] = 1
+            c = min(columns, source.shape[1])
+            r = min(rows, source.shape[2])
+            result[:, :c, :r] = source[:, :c, :r]
+        return result
+    size = math.prod(shape)
+    if len(args) == 1 and args[0].ndim == 1:
+        components = np.repeat(args[0][:, None], size, axis=1)
+    else:
+        components = np.concatenate(
+            [_widen(arg, lanes).reshape(lanes, -1).astype(dtype) for arg in args], axis=1)
+        if components.shape[1] < size:
+            raise RenderError(f'too few components for {type_name}')
+    return components[:, :size].reshape((lanes,) + shape).astype(dtype)
+
+
+def _length(value):
+    value, = _floats(value)
+    return np.abs(value) if value.ndim == 1 else np.sqrt(np.sum(value * value, axis=-1))
+
+
+def _dot(left, right):
+    left, right = _floats(left, right)
+    return left * right if left.ndim == 1 else np.sum(left * right, axis=-1)
+
+
+def _normalize(value):
+    value, = _floats(value)
+    if value.ndim == 1:
+        return np.sign(value)
+    return value / np.sqrt(np.sum(value * value, axis=-1))[:, None]
+
+
+def _per_vector(scalar, like):
+    return scalar if like.ndim == 1 else scalar[:, None]
+
+
+def _refract(incident, normal, eta):
+    incident, normal, eta = _floats(incident, normal, eta)
+    cosine = _per_vector(_dot(normal, incident), incident)
+    k = 1 - eta * eta * (1 - cosine * cosine)
+    return np.where(k < 0, 0, eta * incident - (eta * cosine + np.sqrt(np.maximum(k, 0))) * normal)
+
+
+def _smoothstep(edge0, edge1, x):
+    edge0, edge1, x = _floats(edge0, edge1, x)
+    t = np.clip((x - edge0) / (edge1 - edge0), 0, 1)
+    return t * t * (3 - 2 * t)
+
+
+def _mix(x, y, a):
+    if a.dtype == np.bool_:
+        x, y, a = _aligned(x, y, a)
+        return np.where(a, y, x)
+    x, y, a = _floats(x, y, a)
+    return x * (1 - a) + y * a
+
+
+def _float_function(function):
+    return lambda *args: function(*_floats(*args))
+
+
+_BUILTINS = {
+    'radians': _float_function(lambda x: x * np.float32(math.pi / 180)),
+    'degrees': _float_function(lambda x: x * np.float32(180 / math.pi)),
+    'sin': _float_function(np.sin), 'cos': _float_function(np.cos),
+    'tan': _float_function(np.tan), 'asin': _float_function(np.arcsin),
+    'acos': _float_function(np.arccos),
+    'atan': _float_function(lambda y, x=None: np.arctan(y) if x is None else np.arctan2(y, x)),
+    'sinh': _float_function(np.sinh), 'cosh': _float_function(np.cosh),
+    'tanh': _float_function(np.tanh), 'asinh': _float_function(np.arcsinh),
+    'acosh': _float_function(np.arccosh), 'atanh': _float_function(np.arctanh),
+    'pow': _float_function(np.power), 'exp': _float_function(np.exp),
+    'log': _float_function(np.log), 'exp2': _float_function(np.exp2),
+    'log2': _float_function(np.log2), 'sqrt': _float_function(np.sqrt),
+    'inversesqrt': _float_function(lambda x: 1 / np.sqrt(x)),
+    'abs': np.abs, 'sign': np.sign,
+    'floor': _float_function(np.floor), 'ceil': _float_function(np.ceil),
+    'trunc': _float_function(np.trunc), 'round': _float_function(lambda x: np.floor(x + 0.5)),
+    'roundEven': _float_function(np.rint),
+    'fract': _float_function(lambda x: x - np.floor(x)),
+    'mod': _float_function(lambda x, y: x - y * np.floor(x / y)),
+    'min': lambda x, y: np.minimum(*_aligned(*_promoted(x, y))),
+    'max': lambda x, y: np.maximum(*_aligned(*_promoted(x, y))),
+    'clamp': lambda x, low, high: np.minimum(np.maximum(*_aligned(x, low)), _aligned(x, high)[1]),
+    'mix': _mix,
+    'step': _float_function(lambda edge, x: np.where(x < edge, 0, 1).astype(np.float32)),
+    'smoothstep': _smoothstep,
+    'length': _length,
+    'distance': lambda x, y: _length(np.subtract(*_floats(x, y))),
+    'dot': _dot,
+    'cross': _float_function(lambda x, y: np.cross(x, y)),
+    'normalize': _normalize,
+    'faceforward': lambda n, i, ref: np.where(_per_vector(_dot(ref, i) < 0, n), n, -n),
+    'reflect': lambda i, n: np.subtract(*_floats(i, 2 * _per_vector(_dot(n, i), n) * n)),
+    'refract': _refract,
+    'matrixCompMult': lambda x, y: x * y,
+    'transpose': lambda m: np.swapaxes(m, 1, 2),
+    'determinant': lambda m: np.linalg.det(np.swapaxes(m, 1, 2)).astype(np.float32),
+    'inverse': lambda m: np.swapaxes(np.linalg.inv(np.swapaxes(m, 1, 2)), 1, 2).astype(np.float32),
+    'lessThan': lambda x, y: x < y, 'lessThanEqual': lambda x, y: x <= y,
+    'greaterThan': lambda x, y: x > y, 'greaterThanEqual': lambda x, y: x >= y,
+    'equal': lambda x, y: x == y, 'notEqual': lambda x, y: x != y,
+    'any': lambda x: np.any(x, axis=-1), 'all': lambda x: np.all(x, axis=-1),
+    'not': lambda x: ~x,
+}
+
+
+def _binary(op, left, right):
+    left, right = _promoted(left, right)
+    if op == '*' and 3 in (left.ndim, right.ndim) and 1 not in (left.ndim, right.ndim):
+        if left.ndim == 3 and right.ndim == 3:
+            return np.einsum('...kr,...ck->...cr', left, right)
+        if left.ndim == 3:
+            return np.einsum('...cr,...c->...r', left, right)
+        return np.einsum('...r,...cr->...c', left, right)
+    left, right = _aligned(left, right)
+    if op == '+':
+        return left + right
+    if op == '-':
+        return left - right
+    if op == '*':
+        return left * right
+    if op == '/':
+        if left.dtype == np.float32:
+            return left / right
+        safe = np.where(right == 0, 1, right)
+        return np.where(right == 0, 0, np.trunc(left / safe)).astype(left.dtype)
+    if op == '%':
+        return np.where(right == 0, 0, np.fmod(left, np.where(right == 0, 1, right)))
+    if op in ('==', '!='):
+        equal = left == right
+        if equal.ndim > 1:
+            equal = np.all(equal.reshape(equal.shape[0], -1), axis=1)
+        return equal if op == '==' else ~equal
+    if op in ('&&', '&'):
+        return left & right
+    if op in ('||', '|'):
+        return left | right
+    if op in ('^^', '^'):
+        return left ^ right
+    return {'<': np.less, '>': np.greater, '<=': np.less_equal, '>=': np.greater_equal,
+            '<<': np.left_shift, '>>': np.right_shift}[op](left, right)
+
+
+@lru_cache(maxsize=4096)
+def _literal(text):
+    if text in ('true', 'false'):
+        value = np.array([text == 'true'])
+    else:
+        body = text.rstrip('fFuU')
+        if body.isalnum() and not ('e' in body.lower() and not body.lower().startswith('0x')):
+            value = np.array([int(body, 8 if body[:1] == '0' and body.isdigit() and len(body) > 1
+                                  else 0)], np.uint32 if text[-1] in 'uU' else np.int32)
+        else:
+            value = np.array([float(body)], np.float32)
+    # Shared between evaluations, so it must never be written to
+    value.flags.writeable = False
+    return value
+
+
+def _swizzle(field):
+    for letters in _SWIZZLE_SETS:
+        if all(letter in letters for letter in field):
+            return [letters.index(letter) for letter in field]
+    raise RenderError(f'unknown field .{field}')
+
+
+def _quad_difference(grid, axis):
+    """Difference across the 2x2 pixel quads a GPU computes derivatives on"""
+    size = grid.shape[axis]
+    first = np.arange(size) & ~1
+    second = np.minimum(first + 1, size - 1)
+    return np.take(grid, second, axis) - np.take(grid, first, axis)
+
+
+# Statements are tuples: ('expr', nodes), ('decl', type, declarators),
+# ('block', statements), ('if', condition, then, otherwise),
+# ('loop', init, condition, steps, body, test after body),
+# ('switch', selector, items), ('return', node), ('break',), ('continue',),
+# ('discard',); switch items also include ('case', node) and ('default',)
+
+
+class ShaderProgram:
+    """A fragment shader parsed once, to render on the CPU any number of times
+
+    Runs the GLSL the converter emits, and Shadertoy shaders with a
+    mainImage() entry point.  Every statement runs on all pixels at once
+    as NumPy arrays, with branches, loops and early returns handled by
+    masking the pixels that took another path.
+    """
+
+    def __init__(self, shader_code, max_iterations=MAX_ITERATIONS):
+        if np is None:
+            raise ImportError('rendering shaders needs NumPy (pip install numpy)')
+        self.max_iterations = max_iterations
+        self.stream = lex_glsl(' '.join(preprocess(shader_code)))
+        self.code = self.stream.code
+        self.structs = {}
+        self.functions = {}
+        self.uniforms = {}
+        self.globals = []
+        # The variable the color ends up in: a GLSL ES 3.00 out variable
+        self.output = 'gl_FragColor'
+        self._parse()
+        if 'main' not in self.functions and 'mainImage' not in self.functions:
+            raise RenderError('the shader has neither main() nor mainImage()')
+
+    # Parsing
+
+    def _error(self, message, first, stop=None):
+        span = source_span(self.stream, self.code, first, stop or first + 1)
+        return RenderError(f'{message}: {span[:60]}')
+
+    def _expression(self, first, stop):
+        node = parse_expression(self.code, first, stop)
+        if node is None:
+            raise self._error('cannot parse expression', first, stop)
+        return node
+
+    def _end(self, i, stops=(';',)):
+        """Index of the first of stops at bracket depth 0 from code[i]"""
+        code = self.code
+        while i < len(code):
+            text = code[i].text
+            if text in stops:
+                return i
+            if text in ('(', '[', '{'):
+                close = matching_bracket(code, i)
+                if close is None:
+                    break
+                i = close
+            i += 1
+        raise self._error(f'missing {stops[0]}', i - 1)
+
+    def _is_type(self, text):
+        return text in BUILTIN_TYPES or text in self.structs
+
+    def _skip_qualifiers(self, i):
+        code = self.code
+        qualifiers = []
+        while i < len(code) and (code[i].text in QUALIFIERS or code[i].text == 'layout'):
+            qualifiers.append(code[i].text)
+            if code[i].text == 'layout' and i + 1 < len(code) and code[i + 1].text == '(':
+                i = matching_bracket(code, i + 1)
+            i += 1
+        return qualifiers, i
+
+    def _parse(self):
+        code = self.code
+        i = 0
+        while i < len(code):
+            text = code[i].text
+            if text == ';':
+                i += 1
+            elif text == 'precision':
+                i = self._end(i) + 1
+            elif text == 'struct':
+                i = self._struct(i)
+            else:
+                qualifiers, i = self._skip_qualifiers(i)
+                if 'uniform' in qualifiers and i + 1 < len(code) and code[i + 1].text == '{':
+                    i = self._uniform_block(i)
+                    continue
+                if i + 2 < len(code) and code[i + 1].kind == IDENT and code[i + 2].text == '(':
+                    i = self._function(i)
+                    continue
+                statement, i = self._declaration(i)
+                self._global(qualifiers, statement)
+
+    def _global(self, qualifiers, statement):
+        if 'uniform' in qualifiers:
+            for name, size, _ in statement[2]:
+                self.uniforms[name] = (statement[1], size)
+        else:
+            if 'out' in qualifiers:
+                self.output = statement[2][0][0]
+            self.globals.append(statement)
+
+    def _uniform_block(self, i):
+        """Register the members of the uniform block at code[i] as uniforms"""
+        code = self.code
+        close = matching_bracket(code, i + 1)
+        if close is None:
+            raise self._error('unterminated uniform block', i)
+        j = i + 2
+        while j < close:
+            statement, j = self._declaration(j)
+            for name, size, _ in statement[2]:
+                self.uniforms[name] = (statement[1], size)
+        if close + 1 >= len(code) or code[close + 1].text != ';':
+            raise self._error('unsupported uniform block instance', i, close + 2)
+        return close + 2
+
+    def _struct(self, i):
+        code = self.code
+        if i + 2 >= len(code) or code[i + 1].kind != IDENT or code[i + 2].text != '{':
+            raise self._error('unsupported struct', i)
+        name = code[i + 1].text
+        close = matching_bracket(code, i + 2)
+        if close is None:
+            raise self._error('unterminated struct', i)
+        members = []
+        j = i + 3
+        while j < close:
+            _, j = self._skip_qualifiers(j)
+            statement, j = self._declaration(j)
+            members.extend((statement[1], member, size) for member, size, _ in statement[2])
+        self.structs[name] = members
+        if close + 1 < len(code) and code[close + 1].text != ';':
+            # Variables declared along with the struct
+            statement, end = self._declarators(name, close + 1)
+            self.globals.append(statement)
+            return end
+        return close + 2
+
+    def _function(self, i):
+        code = self.code
+        return_type, name = code[i].text, code[i + 1].text
+        parts, close = split_arguments(code, i + 2)
+        if parts is None:
+            raise self._error('unterminated parameter list', i)
+        if close + 1 < len(code) and code[close + 1].text == ';':
+            return close + 2  # a prototype
+        if close + 1 >= len(code) or code[close + 1].text != '{':
+            raise self._error('expected a function body', i)
+        params = []
+        for first, stop in parts:
+            qualifiers, first = self._skip_qualifiers(first)
+            if stop - first == 1 and code[first].text == 'void':
+                continue
+            if stop - first < 2:
+                raise self._error('unsupported parameter', first, stop)
+            qualifier = 'inout' if 'inout' in qualifiers else 'out' if 'out' in qualifiers else 'in'
+            size = None
+            if stop - first > 2 and code[first + 2].text == '[':
+                size = self._expression(first + 3, stop - 1)
+            params.append((qualifier, code[first].text, code[first + 1].text, size))
+        body_close = matching_bracket(code, close + 1)
+        if body_close is None:
+            raise self._error('unterminated function body', i)
+        body = self._statements(close + 2, body_close)
+        self.functions.setdefault(name, []).append((return_type, params, body))
+        return body_close + 1
+
+    def _declaration(self, i):
+        """('decl', type, declarators) for the declaration at code[i], and the index after it"""
+        code = self.code
+        qualifiers, i = self._skip_qualifiers(i)
+        if i >= len(code):
+            raise self._error('expected a declaration', i - 1)
+        return self._declarators(code[i].text, i + 1)
+
+    def _declarators(self, type_name, i):
+        code = self.code
+        declarators = []
+        while True:
+            if i >= len(code) or code[i].kind != IDENT:
+                raise self._error('expected a name', min(i, len(code) - 1))
+            name = code[i].text
+            i += 1
+            size = init = None
+            if i < len(code) and code[i].text == '[':
+                close = matching_bracket(code, i)
+                size = self._expression(i + 1, close) if close > i + 1 else 'unsized'
+                i = close + 1
+            if i < len(code) and code[i].text == '=':
+                end = self._end(i + 1, (',', ';'))
+                init = self._expression(i + 1, end)
+                i = end
+            declarators.append((name, size, init))
+            if i >= len(code) or code[i].text not in (',', ';'):
+                raise self._error('expected , or ;', min(i, len(code) - 1))
+            i += 1
+            if code[i - 1].text == ';':
+                return ('decl', type_name, declarators), i
+
+    def _statements(self, first, stop):
+        statements = []
+        i = first
+        while i < stop:
+            statement, i = self._statement(i)
+            statements.append(statement)
+        return statements
+
+    def _comma_expressions(self, first, stop):
+        parts = []
+        i = first
+        while i < stop:
+            end = self._end(i, (',', ';')) if i < stop else stop
+            end = min(end, stop)
+            parts.append(self._expression(i, end))
+            i = end + 1
+        return parts
+
+    def _is_declaration(self, i):
+        code = self.code
+        text = code[i].text
+        if text in QUALIFIERS or text == 'layout':
+            return True
+        return (self._is_type(text) and i + 1 < len(code)
+                and code[i + 1].kind == IDENT and code[i + 1].text not in ('(',))
+
+    def _statement(self, i):
+        code = self.code
+        text = code[i].text
+        if text == '{':
+            close = matching_bracket(code, i)
+            if close is None:
+                raise self._error('unterminated block', i)
+            return ('block', self._statements(i + 1, close)), close + 1
+        if text == ';':
+            return ('block', []), i + 1
+        if text == 'if':
+            close = matching_bracket(code, i + 1)
+            condition = self._expression(i + 2, close)
+            then, j = self._statement(close + 1)
+            otherwise = None
+            if j < len(code) and code[j].text == 'else':
+                otherwise, j = self._statement(j + 1)
+            return ('if', condition, then, otherwise), j
+        if text == 'for':
+            parts, close = split_arguments(self.code, i + 1, ';')
+            if parts is None or len(parts) != 3:
+                raise self._error('unsupported for loop', i)
+            (init_first, init_stop), (cond_first, cond_stop), (step_first, step_stop) = parts
+            init = None
+            if init_stop > init_first:
+                if self._is_declaration(init_first):
+                    init, _ = self._declarators_until(init_first, init_stop)
+                else:
+                    init = ('expr', self._comma_expressions(init_first, init_stop))
+            condition = (self._expression(cond_first, cond_stop)
+                         if cond_stop > cond_first else None)
+            steps = self._comma_expressions(step_first, step_stop)
+            body, j = self._statement(close + 1)
+            return ('loop', init, condition, steps, body, False), j
+        if text == 'while':
+            close = matching_bracket(code, i + 1)
+            condition = self._expression(i + 2, close)
+            body, j = self._statement(close + 1)
+            return ('loop', None, condition, [], body, False), j
+        if text == 'do':
+            body, j = self._statement(i + 1)
+            if j + 1 >= len(code) or code[j].text != 'while':
+                raise self._error('expected while after do', i)
+            close = matching_bracket(code, j + 1)
+            condition = self._expression(j + 2, close)
+            return ('loop', None, condition, [], body, True), self._end(close) + 1
+        if text == 'switch':
+            close = matching_bracket(code, i + 1)
+            selector = self._expression(i + 2, close)
+            body_close = matching_bracket(code, close + 1)
+            items = []
+            j = close + 2
+            while j < body_close:
+                if code[j].text == 'case':
+                    end = self._end(j + 1, (':',))
+                    items.append(('case', self._expression(j + 1, end)))
+                    j = end + 1
+                elif code[j].text == 'default':
+                    items.append(('default',))
+                    j += 2
+                else:
+                    statement, j = self._statement(j)
+                    items.append(statement)
+            return ('switch', selector, items), body_close + 1
+        if text == 'return':
+            end = self._end(i)
+            return ('return', self._expression(i + 1, end) if end > i + 1 else None), end + 1
+        if text in ('break', 'continue', 'discard'):
+            return (text,), self._end(i) + 1
+        if self._is_declaration(i):
+            return self._declaration(i)
+        end = self._end(i)
+        return ('expr', self._comma_expressions(i, end)), end + 1
+
+    def _declarators_until(self, first, stop):
+        statement, end = self._declaration(first)
+        if end != stop + 1:
+            raise self._error('unsupported for loop initializer', first, stop)
+        return statement, end
+
+    # Rendering
+
+    def render(self, width, height, uniforms=None, channels=None):
+        """RGBA image of gl_FragColor as a (height, width, 4) float32 array
+
+        uniforms maps uniform names to values (numbers, sequences, or
+        arrays for uniform arrays); Shadertoy's are set to sensible
+        defaults, with iResolution matching the image.  channels maps
+        sampler names (iChannel0...) to images as (height, width, 3 or 4)
+        arrays of floats in 0-1 or of uint8.  Images, like the result,
+        have their top row first.  Discarded pixels are transparent black.
+        """
+        machine = _Machine(self, width, height, uniforms or {}, channels or {})
+        with np.errstate(all='ignore'):
+            color = machine.run()
+        color = np.where(machine.discarded[:, None], 0, color)
+        return color.reshape(height, width, 4)[::-1].astype(np.float32)
+
+
+class _Target:
+    """Where break (and, for loops, continue) takes pixels"""
+
+    __slots__ = ('loop', 'broken', 'continued')
+
+    def __init__(self, loop, lanes):
+        self.loop = loop
+        self.broken = np.zeros(lanes, bool)
+        self.continued = np.zeros(lanes, bool)
+
+
+class _Frame:
+    __slots__ = ('result_type', 'result', 'targets')
+
+    def __init__(self, result_type, result):
+        self.result_type = result_type
+        self.result = result
+        self.targets = []
+
+
+class _Scope:
+    __slots__ = ('names', 'parent')
+
+    def __init__(self, parent=None):
+        self.names = {}
+        self.parent = parent
+
+    def find(self, name):
+        scope = self
+        while scope is not None:
+            entry = scope.names.get(name)
+            if entry is not None:
+                return entry
+            scope = scope.parent
+        return None
+
+
+class _Machine:
+    """One render of a ShaderProgram: every pixel is a lane of each array"""
+
+    def __init__(self, program, width, height, uniforms, channels):
+        self.program = program
+        self.width = width
+        self.height = height
+        self.lanes = width * height
+        self.discarded = np.zeros(self.lanes, bool)
+        self.depth = 0
+        self.globals = _Scope()
+        rows, columns = np.divmod(np.arange(self.lanes), width)
+        coord = np.empty((self.lanes, 4), np.float32)
+        coord[:, 0] = columns + 0.5
+        coord[:, 1] = rows + 0.5
+        coord[:, 2] = 0.5
+        coord[:, 3] = 1
+        self.globals.names['gl_FragCoord'] = [('vec4', None), coord]
+        self.globals.names['gl_FragColor'] = [('vec4', None), np.zeros((1, 4), np.float32)]
+        self._set_uniforms(uniforms, channels)
+
+    def _set_uniforms(self, uniforms, channels):
+        images = {name: _channel_image(image) for name, image in channels.items()}
+        resolutions = [(0.0, 0.0, 0.0)] * 4
+        for k in range(4):
+            image = images.get(f'iChannel{k}')
+            if image is not None:
+                resolutions[k] = (image.shape[1], image.shape[0], 1.0)
+        defaults = {'iResolution': (self.width, self.height, 1.0), 'iTimeDelta': 1 / 60,
+                    'iFrameRate': 60.0, 'iSampleRate': 44100.0,
+                    'iChannelResolution': resolutions}
+        declared = dict(SHADERTOY_UNIFORMS)
+        declared.update(self.program.uniforms)
+        for name, (type_name, size) in declared.items():
+            if type_name.startswith('sampler'):
+                value = _Sampler(images.get(name))
+            elif name in uniforms or name in defaults:
+                value = self._uniform(uniforms.get(name, defaults.get(name)), type_name, size)
+            else:
+                value = self.zero(type_name, size)
+            self.globals.names[name] = [(type_name, size), value]
+
+    def _uniform(self, value, type_name, size):
+        if size is not None:
+            return _Array([self._uniform(item, type_name, None) for item in value][:size])
+        dtype, shape = _TYPES[type_name]
+        flat = np.zeros(math.prod(shape), dtype)
+        given = np.asarray(value, dtype).reshape(-1)[:flat.size]
+        flat[:given.size] = given
+        return flat.reshape((1,) + shape)
+
+    def zero(self, type_name, size=None):
+        if size is not None:
+            return _Array([self.zero(type_name) for _ in range(size)])
+        if type_name in _TYPES:
+            dtype, shape = _TYPES[type_name]
+            return np.zeros((1,) + shape, dtype)
+        members = self.program.structs.get(type_name)
+        if members is not None:
+            return _Struct(type_name, {name: self.zero(member_type, self.size(member_size))
+                                       for member_type, name, member_size in members})
+        if type_name.startswith('sampler'):
+            return _Sampler(None)
+        raise RenderError(f'unknown type {type_name}')
+
+    def size(self, node):
+        if node is None or node == 'unsized':
+            return None
+        value = self.evaluate(node, self.globals, np.ones(1, bool), None)
+        return int(value[0])
+
+    def run(self):
+        everywhere = np.ones(self.lanes, bool)
+        for statement in self.program.globals:
+            self.declare(statement, self.globals, everywhere, None)
+        if 'main' in self.program.functions:
+            self.call(Call('main', ()), self.globals, everywhere, None)
+        else:
+            coord = Member(Name('gl_FragCoord'), 'xy')
+            self.call(Call('mainImage', (Name('gl_FragColor'), coord)),
+                      self.globals, everywhere, None)
+        return _widen(self.globals.find(self.program.output)[1], self.lanes)
+
+    # Statements: each returns the pixels that carry on after it
+
+    def block(self, statements, scope, mask, frame):
+        for statement in statements:
+            if not mask.any():
+                break
+            mask = self.execute(statement, scope, mask, frame)
+        return mask
+
+    def execute(self, statement, scope, mask, frame):
+        kind = statement[0]
+        if kind == 'expr':
+            for node in statement[1]:
+                self.evaluate(node, scope, mask, frame)
+            return mask
+        if kind == 'decl':
+            self.declare(statement, scope, mask, frame)
+            return mask
+        if kind == 'block':
+            return self.block(statement[1], _Scope(scope), mask, frame)
+        if kind == 'if':
+            condition = self.condition(statement[1], scope, mask, frame)
+            then, otherwise = mask & condition, mask & ~condition
+            if then.any():
+                then = self.execute(statement[2], _Scope(scope), then, frame)
+            if statement[3] is not None and otherwise.any():
+                otherwise = self.execute(statement[3], _Scope(scope), otherwise, frame)
+            return then | otherwise
+        if kind == 'loop':
+            return self.loop(statement, scope, mask, frame)
+        if kind == 'switch':
+            return self.switch(statement, scope, mask, frame)
+        if kind == 'return':
+            if statement[1] is not None:
+                value = self.evaluate(statement[1], scope, mask, frame)
+                frame.result = _select(mask, _convert(value, frame.result_type), frame.result)
+            return np.zeros_like(mask)
+        if kind == 'break':
+            frame.targets[-1].broken |= mask
+            return np.zeros_like(mask)
+        if kind == 'continue':
+            next(target for target in reversed(frame.targets) if target.loop).continued |= mask
+            return np.zeros_like(mask)
+        if kind == 'discard':
+            self.discarded |= mask
+            return np.zeros_like(mask)
+        raise RenderError(f'unsupported statement {kind}')
+
+    def condition(self, node, scope, mask, frame):
+        value = self.evaluate(node, scope, mask, frame)
+        return _widen(_scalar(value).astype(bool), mask.shape[0])
+
+    def declare(self, statement, scope, mask, frame):
+        _, type_name, declarators = statement
+        for name, size, init in declarators:
+            size = self.size(size)
+            if init is None:
+                value = self.zero(type_name, size)
+            else:
+                value = _convert(self.evaluate(init, scope, mask, frame), type_name)
+            scope.names[name] = [(type_name, size), value]
+
+    def loop(self, statement, scope, mask, frame):
+        _, init, condition, steps, body, test_after = statement
+        scope = _Scope(scope)
+        if init is not None:
+            self.execute(init, scope, mask, frame)
+        target = _Target(True, self.lanes)
+        frame.targets.append(target)
+        running = mask
+        finished = np.zeros_like(mask)
+        iterations = 0
+        while True:
+            if condition is not None and not (test_after and iterations == 0):
+                holds = self.condition(condition, scope, running, frame)
+                finished |= running & ~holds
+                running = running & holds
+            if not running.any():
+                break
+            iterations += 1
+            if iterations > self.program.max_iterations:
+                raise RenderError(f'a loop ran more than {self.program.max_iterations} times')
+            target.continued = np.zeros_like(mask)
+            running = self.execute(body, scope, running, frame) | target.continued
+            for node in steps:
+                self.evaluate(node, scope, running, frame)
+        frame.targets.pop()
+        return finished | target.broken
+
+    def switch(self, statement, scope, mask, frame):
+        _, selector, items = statement
+        value = _scalar(self.evaluate(selector, scope, mask, frame))
+        cases = [_binary('==', value, self.evaluate(item[1], scope, mask, frame))
+                 for item in items if item[0] == 'case']
+        matched = np.zeros_like(mask)
+        for case in cases:
+            matched = matched | case
+        has_default = any(item[0] == 'default' for item in items)
+        target = _Target(False, self.lanes)
+        frame.targets.append(target)
+        scope = _Scope(scope)
+        flowing = np.zeros_like(mask)
+        cases = iter(cases)
+        for item in items:
+            if item[0] == 'case':
+                flowing = flowing | (mask & next(cases))
+            elif item[0] == 'default':
+                flowing = flowing | (mask & ~matched)
+            elif flowing.any():
+                flowing = self.execute(item, scope, flowing, frame)
+        frame.targets.pop()
+        skipped = mask & ~matched if not has_default else np.zeros_like(mask)
+        return flowing | target.broken | skipped
+
+    # Expressions
+
+    def evaluate(self, node, scope, mask, frame):
+        kind = type(node)
+        if kind is Literal:
+            return _literal(node.text)
+        if kind is Name:
+            entry = scope.find(node.name)
+            if entry is None:
+                raise RenderError(f'unknown name {node.name}')
+            return entry[1]
+        if kind is Binary:
+            left = self.evaluate(node.left, scope, mask, frame)
+            right = self.evaluate(node.right, scope, mask, frame)
+            if node.op in ('&&', '||', '^^'):
+                left, right = _scalar(left).astype(bool), _scalar(right).astype(bool)
+            return _binary(node.op, left, right)
+        if kind is Unary:
+            if node.op in ('++', '--'):
+                value = self.evaluate(node.operand, scope, mask, frame)
+                value = _binary(node.op[0], value, np.ones(1, value.dtype))
+                self.assign(node.operand, value, scope, mask, frame)
+                return value
+            value = self.evaluate(node.operand, scope, mask, frame)
+            if node.op == '-':
+                return -value
+            if node.op == '!' or node.op == '~':
+                return ~value
+            return value
+        if kind is Postfix:
+            value = self.evaluate(node.operand, scope, mask, frame)
+            self.assign(node.operand, _binary(node.op[0], value, np.ones(1, value.dtype)),
+                        scope, mask, frame)
+            return value
+        if kind is Conditional:
+            condition = self.condition(node.condition, scope, mask, frame)
+            then = mask & condition
+            otherwise = mask & ~condition
+            if not otherwise.any():
+                return self.evaluate(node.then, scope, mask, frame)
+            if not then.any():
+                return self.evaluate(node.otherwise, scope, mask, frame)
+            return _select(condition, self.evaluate(node.then, scope, then, frame),
+                           self.evaluate(node.otherwise, scope, otherwise, frame))
+        if kind is Assign:
+            value = self.evaluate(node.value, scope, mask, frame)
+            if node.op != '=':
+                current = self.evaluate(node.target, scope, mask, frame)
+                value = _binary(node.op[:-1], current, value).astype(current.dtype)
+            return self.assign(node.target, value, scope, mask, frame)
+        if kind is Member:
+            value = self.evaluate(node.value, scope, mask, frame)
+            if isinstance(value, _Struct):
+                return value.fields[node.field]
+            indexes = _swizzle(node.field)
+            if value.ndim == 1:
+                value = value[:, None]
+            return value[:, indexes[0]] if len(indexes) == 1 else value[:, indexes]
+        if kind is Index:
+            return self.index(self.evaluate(node.value, scope, mask, frame),
+                              self.evaluate(node.index, scope, mask, frame))
+        if kind is Call:
+            return self.call(node, scope, mask, frame)
+        raise RenderError(f'unsupported expression {kind.__name__}')
+
+    def index(self, value, index):
+        index = _scalar(index).astype(np.int64)
+        uniform = index.shape[0] == 1 or bool(np.all(index == index[0]))
+        if isinstance(value, _Array):
+            elements = value.elements
+            if uniform:
+                return elements[min(max(int(index[0]), 0), len(elements) - 1)]
+            result = elements[0]
+            for k in range(1, len(elements)):
+                result = _select(index == k, elements[k], result)
+            return result
+        limit = value.shape[1] - 1
+        if uniform:
+            return value[:, min(max(int(index[0]), 0), limit)]
+        lanes = _lanes(value, index)
+        index = np.clip(index, 0, limit)
+        value = _widen(value, lanes)
+        return value[np.arange(lanes), _widen(index, lanes)]
+
+    def assign(self, node, value, scope, mask, frame):
+        """Store value in the variable, field or element node names; returns value"""
+        kind = type(node)
+        if kind is Name:
+            entry = scope.find(node.name)
+            if entry is None:
+                raise RenderError(f'unknown name {node.name}')
+            (type_name, _), old = entry
+            value = _convert(value, type_name)
+            entry[1] = value if mask.all() else _select(mask, value, _widen(old, self.lanes)
+                                                        if isinstance(old, np.ndarray) else old)
+            return value
+        base = self.evaluate(node.value, scope, mask, frame)
+        if kind is Member and isinstance(base, _Struct):
+            fields = dict(base.fields)
+            members = {name: member_type for member_type, name, _ in
+                       self.program.structs[base.name]}
+            fields[node.field] = _convert(value, members[node.field])
+            updated = _Struct(base.name, fields)
+        elif kind is Member:
+            indexes = _swizzle(node.field)
+            lanes = _lanes(base, value)
+            updated = np.array(_widen(base, lanes))
+            updated[:, indexes[0] if len(indexes) == 1 else indexes] = \
+                _widen(value, lanes).astype(base.dtype)
+        elif kind is Index:
+            index = _scalar(self.evaluate(node.index, scope, mask, frame)).astype(np.int64)
+            if isinstance(base, _Array):
+                elements = list(base.elements)
+                for k in range(len(elements)):
+                    if index.shape[0] == 1:
+                        if int(index[0]) == k:
+                            elements[k] = value
+                    else:
+                        elements[k] = _select(index == k, value, elements[k])
+                updated = _Array(elements)
+            else:
+                lanes = _lanes(base, value, index)
+                updated = np.array(_widen(base, lanes))
+                value = _widen(value, lanes).astype(base.dtype)
+                for k in range(base.shape[1]):
+                    hits = _widen(index == k, lanes)
+                    updated[hits, k] = value[hits]
+        else:
+            raise RenderError(f'cannot assign to {kind.__name__}')
+        self.assign(node.value, updated, scope, mask, frame)
+        return value
+
+    def call(self, node, scope, mask, frame):
+        name = node.name
+        if name in self.program.functions:
+            return self.call_function(node, scope, mask, frame)
+        args = [self.evaluate(arg, scope, mask, frame) for arg in node.args]
+        if name in _TYPES:
+            return _construct(name, args)
+        if name in self.program.structs:
+            members = self.program.structs[name]
+            return _Struct(name, {member: _convert(arg, member_type)
+                                  for (member_type, member, _), arg in zip(members, args)})
+        if name in _TEXTURE_FUNCTIONS:
+            return self.texture(name, args)
+        if name in ('dFdx', 'dFdy', 'fwidth'):
+            return self.derivative(name, args[0])
+        function = _BUILTINS.get(name)
+        if function is None:
+            raise RenderError(f'unknown function {name}()')
+        try:
+            return function(*args)
+        except TypeError:
+            raise RenderError(f'wrong arguments for {name}()') from None
+
+    def overload(self, name, args):
+        candidates = [function for function in self.program.functions[name]
+                      if len(function[1]) == len(args)]
+        for function in candidates:
+            if all(self.fits(param[1], arg) for param, arg in zip(function[1], args)):
+                return function
+        if not candidates:
+            raise RenderError(f'no {name}() takes {len(args)} arguments')
+        return candidates[0]
+
+    def fits(self, type_name, value):
+        if isinstance(value, np.ndarray):
+            info = _TYPES.get(type_name)
+            return (info is not None and value.shape[1:] == info[1]
+                    and np.dtype(info[0]).kind == value.dtype.kind)
+        if isinstance(value, _Struct):
+            return value.name == type_name
+        return True
+
+    def call_function(self, node, scope, mask, frame):
+        args = [self.evaluate(arg, scope, mask, frame) for arg in node.args]
+        return_type, params, body = self.overload(node.name, args)
+        self.depth += 1
+        if self.depth > _MAX_CALL_DEPTH:
+            raise RenderError(f'{node.name}() calls itself')
+        local = _Scope(self.globals)
+        for (qualifier, type_name, name, size), arg in zip(params, args):
+            size = self.size(size)
+            value = self.zero(type_name, size) if qualifier == 'out' else _convert(arg, type_name)
+            local.names[name] = [(type_name, size), value]
+        inner = _Frame(return_type, None if return_type == 'void' else self.zero(return_type))
+        self.block(body, local, mask, inner)
+        self.depth -= 1
+        for (qualifier, _, name, _), arg in zip(params, node.args):
+            if qualifier != 'in':
+                self.assign(arg, local.names[name][1], scope, mask, frame)
+        return inner.result
+
+    def texture(self, name, args):
+        sampler, coords = args[0], args[1]
+        if not isinstance(sampler, _Sampler):
+            raise RenderError(f'{name}() needs a sampler')
+        lanes = coords.shape[0]
+        image = sampler.image
+        if image is None or coords.ndim != 2 or coords.shape[1] != 2:
+            # Cube maps and 3D textures are not supported and read as black
+            return np.zeros((lanes, 4), np.float32)
+        height, width = image.shape[:2]
+        if name == 'texelFetch':
+            x = np.clip(coords[:, 0].astype(np.int64), 0, width - 1)
+            y = np.clip(coords[:, 1].astype(np.int64), 0, height - 1)
+            return image[height - 1 - y, x]
+        coords = coords.astype(np.float32)
+        # Bilinear filtering with repeat wrapping, as Shadertoy's defaults
+        x = coords[:, 0] * width - 0.5
+        y = coords[:, 1] * height - 0.5
+        x0, y0 = np.floor(x), np.floor(y)
+        fx, fy = (x - x0)[:, None], (y - y0)[:, None]
+        x0 = x0.astype(np.int64) % width
+        y0 = y0.astype(np.int64) % height
+        x1, y1 = (x0 + 1) % width, (y0 + 1) % height
+        rows0, rows1 = height - 1 - y0, height - 1 - y1
+        top = image[rows0, x0] * (1 - fx) + image[rows0, x1] * fx
+        bottom = image[rows1, x0] * (1 - fx) + image[rows1, x1] * fx
+        return (top * (1 - fy) + bottom * fy).astype(np.float32)
+
+    def derivative(self, name, value):
+        if value.shape[0] != self.lanes:
+            return np.zeros_like(value)
+        grid = value.reshape((self.height, self.width) + value.shape[1:])
+        dx = _quad_difference(grid, 1).reshape(value.shape)
+        dy = _quad_difference(grid, 0).reshape(value.shape)
+        if name == 'dFdx':
+            return dx
+        if name == 'dFdy':
+            return dy
+        return np.abs(dx) + np.abs(dy)
+
+
+def _channel_image(image):
+    image = np.asarray(image)
+    if image.dtype == np.uint8:
+        image = image / np.float32(255)
+    image = image.astype(np.float32)
+    if image.ndim == 2:
+        image = image[:, :, None].repeat(3, axis=2)
+    if image.shape[2] == 3:
+        image = np.concatenate([image, np.ones(image.shape[:2] + (1,), np.float32)], axis=2)
+    return image
+
+
+def render(shader_code, width, height, uniforms=None, channels=None):
+    """Render shader_code on the CPU; see ShaderProgram.render()"""
+    return ShaderProgram(shader_code).render(width, height, uniforms, channels)
+
+
+def render_difference(first_code, second_code, width=64, height=36, uniforms=None,
+                      channels=None):
+    """Largest difference in any channel of any pixel between two shaders' renders
+
+    Pass the Shadertoy original and its conversion to check that the
+    conversion leaves the image unchanged, to within float rounding.
+    """
+    first = render(first_code, width, height, uniforms, channels)
+    second = render(second_code, width, height, uniforms, channels)
+    return float(np.max(np.abs(np.nan_to_num(first) - np.nan_to_num(second))))
+
+
+def write_png(path, image):
+    """Save a render (or any (height, width, 4) array of floats in 0-1) as a PNG"""
+    pixels = (np.clip(np.nan_to_num(image), 0, 1) * 255 + 0.5).astype(np.uint8)
+    height, width = pixels.shape[:2]
+    rows = b''.join(b'\0' + pixels[y].tobytes() for y in range(height))
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(rows, 6)))
+        f.write(chunk(b'IEND', b''))
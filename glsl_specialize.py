@@ -0,0 +1,525 @@
+import re
+from collections import namedtuple
+
+from glsl_ast import fold_expressions, literal, parse_expression, preprocessor_value
+from glsl_lexer import (IDENT, NUMBER, PREPROC, RewriteBuffer, directive_line_end, lex_glsl,
+                        matching_bracket, statement_last)
+from glsl_uniform_block import block_declaration, packed_order, std140_layout
+from shadertoy_to_opengl import convert_shadertoy_to_opengl, remove_unused_code, shader_facts
+
+
+# One specialized shader: name identifies the configuration of values
+Variant = namedtuple('Variant', 'name values code')
+
+_IDENTIFIER_RE = re.compile(r'[A-Za-z_]\w*\Z')
+_PRECISIONS = frozenset(('lowp', 'mediump', 'highp'))
+_VECTOR_PREFIXES = {'float': 'vec', 'int': 'ivec', 'uint': 'uvec', 'bool': 'bvec'}
+_SWIZZLE_SETS = ('xyzw', 'rgba', 'stpq')
+
+# A uniform declaration: the tokens from its first to the ';' ending it,
+# and (name, array size or None, first token, stop token) per declarator.
+# Block members are declarations whose block is (first token, last token,
+# name) of the whole block.
+_Declaration = namedtuple('_Declaration', 'first last type declarators block')
+
+
+def _shape(type_name):
+    """(component type, component count) of a scalar or vector type, else None"""
+    if type_name in _VECTOR_PREFIXES:
+        return type_name, 1
+    for scalar, prefix in _VECTOR_PREFIXES.items():
+        if type_name[:-1] == prefix and type_name[-1:] in ('2', '3', '4'):
+            return scalar, int(type_name[-1])
+    return None
+
+
+def _scalar_text(scalar, value):
+    if scalar == 'bool':
+        return 'true' if value else 'false'
+    if scalar == 'float':
+        node = literal(float(value))
+        if node is None:
+            raise ValueError(f'{value!r} cannot be written as a GLSL float')
+        return node.text
+    return f'{int(value)}u' if scalar == 'uint' else str(int(value))
+
+
+def _uniform_constant(name, type_name, count, value):
+    """(component type, components) for a scalar or vector uniform, a list of them for arrays"""
+    shape = _shape(type_name)
+    if shape is None:
+        raise ValueError(f'cannot specialize {name}: {type_name} uniforms are not supported')
+    if count is not None:
+        if isinstance(value, (int, float)) or len(value) != count:
+            raise ValueError(f'{name} is an array of {count}; give a list of {count} values')
+        return [_uniform_constant(f'{name}[{i}]', type_name, None, item)
+                for i, item in enumerate(value)]
+    scalar, size = shape
+    components = [value] if isinstance(value, (int, float)) else list(value)
+    if len(components) != size:
+        raise ValueError(f'{name} is a {type_name}, which takes {size} value'
+                         f'{"s" if size > 1 else ""}, not {len(components)}')
+    return scalar, tuple(components)
+
+
+def _constant_text(constant, field=None):
+    """GLSL for a (component type, components) constant, or the components field swizzles"""
+    scalar, components = constant
+    if field is not None:
+        for letters in _SWIZZLE_SETS:
+            if all(letter in letters[:len(components)] for letter in field):
+                components = tuple(components[letters.index(letter)] for letter in field)
+                break
+        else:
+            return None
+    texts = [_scalar_text(scalar, component) for component in components]
+    if len(texts) == 1:
+        return f'({texts[0]})' if texts[0].startswith('-') else texts[0]
+    return f'{_VECTOR_PREFIXES[scalar]}{len(texts)}({", ".join(texts)})'
+
+
+def _macro_text(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        return _scalar_text('float', value)
+    return str(value)
+
+
+def _directive_stop(stream, code, i):
+    """Index of the first token after the directive at code[i]"""
+    line_end = directive_line_end(stream.source, code[i].start)
+    i += 1
+    while i < len(code) and code[i].start < line_end:
+        i += 1
+    return i
+
+
+def _declarators(code, first, stop):
+    """(name, array size, first, stop) of each declarator in code[first:stop]"""
+    declarators = []
+    i = first
+    while i < stop:
+        if code[i].kind != IDENT:
+            return None
+        start = i
+        count = None
+        i += 1
+        if i < stop and code[i].text == '[':
+            close = matching_bracket(code, i)
+            if close is None or close != i + 2 or code[i + 1].kind != NUMBER:
+                return None
+            count = int(code[i + 1].text.rstrip('uU'), 0)
+            i = close + 1
+        declarators.append((code[start].text, count, start, i))
+        if i < stop and code[i].text != ',':
+            return None
+        i += 1
+    return declarators
+
+
+def _uniform_declarations(stream):
+    """Every uniform declaration the shader makes, block members included"""
+    code = stream.code
+    declarations = []
+    i = 0
+    while i < len(code):
+        tok = code[i]
+        if tok.kind == PREPROC:
+            i = _directive_stop(stream, code, i)
+            continue
+        if tok.text != 'uniform' or (i and code[i - 1].text == '.'):
+            i += 1
+            continue
+        first = i
+        if i >= 4 and code[i - 1].text == ')':
+            # layout(...) in front of the declaration
+            opening = next((j for j in range(i - 1, -1, -1) if code[j].text == '('), None)
+            if opening and code[opening - 1].text == 'layout':
+                first = opening - 1
+        i += 1
+        while i < len(code) and code[i].text in _PRECISIONS:
+            i += 1
+        if i + 1 < len(code) and code[i + 1].text == '{':
+            close = matching_bracket(code, i + 1)
+            if close is None:
+                break
+            last = close + 1 if close + 1 < len(code) and code[close + 1].text == ';' else close
+            block = (first, last, code[i].text)
+            j = i + 2
+            while j < close:
+                end = j
+                while end < close and code[end].text != ';':
+                    end += 1
+                member_first = j
+                while j < end and code[j].text in _PRECISIONS:
+                    j += 1
+                declarators = _declarators(code, j + 1, end)
+                if declarators is not None:
+                    declarations.append(_Declaration(member_first, end, code[j].text,
+                                                     declarators, block))
+                j = end + 1
+            i = last + 1
+            continue
+        end = i
+        while end < len(code) and code[end].text != ';':
+            end += 1
+        declarators = _declarators(code, i + 1, end) if end < len(code) else None
+        if declarators is not None:
+            declarations.append(_Declaration(first, end, code[i].text, declarators, None))
+        i = end + 1
+    return declarations
+
+
+def _line_span(source, start, end):
+    """start and end widened to whole lines when nothing else is on them"""
+    line_start = source.rfind('\n', 0, start) + 1
+    line_end = source.find('\n', end)
+    line_end = len(source) if line_end < 0 else line_end
+    if source[line_start:start].strip() or source[end:line_end].strip():
+        return start, end
+    return line_start, min(line_end + 1, len(source))
+
+
+def _set_macros(shader_code, macros):
+    """shader_code with a #define giving each macro its value"""
+    stream = lex_glsl(shader_code)
+    code = stream.code
+    buffer = RewriteBuffer(stream)
+    defined = set()
+    for i, tok in enumerate(code):
+        if (tok.kind == PREPROC and tok.text.replace(' ', '') == '#define'
+                and i + 1 < len(code) and code[i + 1].text in macros):
+            name = code[i + 1].text
+            defined.add(name)
+            buffer.replace(tok.start, directive_line_end(stream.source, tok.start),
+                           f'#define {name} {macros[name]}')
+    missing = [name for name in macros
+               if name not in defined and name in stream.identifiers]
+    if missing:
+        # After #version and #extension, which must come first
+        insert_at = 0
+        for tok in code:
+            if tok.kind != PREPROC or not tok.text[1:].lstrip().startswith(
+                    ('version', 'extension')):
+                break
+            insert_at = min(directive_line_end(stream.source, tok.start) + 1,
+                            len(stream.source))
+        buffer.insert(insert_at, ''.join(f'#define {name} {macros[name]}\n'
+                                         for name in missing))
+    return buffer.apply_source()
+
+
+def _condition(code, first, stop, macros):
+    """True or False when the #if condition in code[first:stop] only reads macros, else None"""
+    texts = []
+    i = first
+    while i < stop:
+        text = code[i].text
+        if text == 'defined':
+            if i + 3 < stop and code[i + 1].text == '(':
+                name, i = code[i + 2].text, i + 4
+            elif i + 1 < stop:
+                name, i = code[i + 1].text, i + 2
+            else:
+                return None
+            if name not in macros:
+                return None
+            texts.append('1')
+            continue
+        if code[i].kind == IDENT:
+            if text not in macros:
+                return None
+            text = macros[text]
+        texts.append(text)
+        i += 1
+    stream = lex_glsl(' '.join(texts))
+    node = parse_expression(stream.code, 0, len(stream.code))
+    if node is None:
+        return None
+    try:
+        return bool(preprocessor_value(node))
+    except ValueError:
+        return None
+
+
+def _conditional_groups(stream):
+    """[(directive token index, stop index), ...] per branch of every #if group, with
+    #endif last, and the index of the enclosing group or None"""
+    code = stream.code
+    groups = []
+    open_groups = []
+    i = 0
+    while i < len(code):
+        tok = code[i]
+        if tok.kind != PREPROC:
+            i += 1
+            continue
+        stop = _directive_stop(stream, code, i)
+        directive = tok.text[1:].strip()
+        if directive in ('if', 'ifdef', 'ifndef'):
+            groups.append(([(i, stop)], open_groups[-1] if open_groups else None))
+            open_groups.append(len(groups) - 1)
+        elif directive in ('elif', 'else', 'endif') and open_groups:
+            groups[open_groups[-1]][0].append((i, stop))
+            if directive == 'endif':
+                open_groups.pop()
+        i = stop
+    return [group for group in groups if code[group[0][-1][0]].text[1:].strip() == 'endif']
+
+
+def _fold_conditionals(shader_code, macros):
+    """shader_code without the #if branches the fixed macros rule out"""
+    while True:
+        stream = lex_glsl(shader_code)
+        code = stream.code
+        source = stream.source
+        buffer = RewriteBuffer(stream)
+        groups = _conditional_groups(stream)
+        folded = set()
+        for number, (branches, parent) in enumerate(groups):
+            ancestor = parent
+            while ancestor is not None and ancestor not in folded:
+                ancestor = groups[ancestor][1]
+            if ancestor is not None:
+                continue
+            chosen = None
+            for index, (i, stop) in enumerate(branches[:-1]):
+                directive = code[i].text[1:].strip()
+                if directive == 'else':
+                    holds = True
+                elif directive in ('ifdef', 'ifndef'):
+                    name = code[i + 1].text if i + 1 < stop else None
+                    holds = None if name not in macros else directive == 'ifdef'
+                else:
+                    holds = _condition(code, i + 1, stop, macros)
+                if holds is None:
+                    break
+                if holds:
+                    chosen = index
+                    break
+            else:
+                chosen = -1
+            if holds is None and chosen is None:
+                continue
+            folded.add(number)
+            group_start = source.rfind('\n', 0, code[branches[0][0]].start) + 1
+            end_line = directive_line_end(source, code[branches[-1][0]].start)
+            group_end = min(end_line + 1, len(source))
+            if chosen == -1:
+                buffer.replace(group_start, group_end, '')
+                continue
+            body_start = min(directive_line_end(source, code[branches[chosen][0]].start) + 1,
+                             len(source))
+            body_end = source.rfind('\n', 0, code[branches[chosen + 1][0]].start) + 1
+            buffer.replace(group_start, body_start, '')
+            buffer.replace(max(body_end, body_start), group_end, '')
+        if not folded:
+            return shader_code
+        shader_code = buffer.apply_source()
+
+
+def _substitute(shader_code, uniforms, macros):
+    """shader_code with fixed uniforms and numeric macros replaced by their values
+
+    Declarations of uniforms that no longer appear are dropped; a uniform
+    read in a way a constant cannot replace (an array indexed by a
+    variable) keeps its declaration.
+    """
+    stream = lex_glsl(shader_code)
+    code = stream.code
+    source = stream.source
+    declarations = _uniform_declarations(stream)
+    declared = set()
+    for declaration in declarations:
+        declared.update(range(declaration.first, declaration.last + 1))
+    numbers = {name: text for name, text in macros.items()
+               if re.fullmatch(r'-?[\d.]+(?:[eE][+-]?\d+)?[fFuU]?', text)}
+    buffer = RewriteBuffer(stream)
+    kept = set()
+    i = 0
+    while i < len(code):
+        tok = code[i]
+        if tok.kind == PREPROC:
+            i = _directive_stop(stream, code, i)
+            continue
+        text = tok.text
+        if tok.kind != IDENT or i in declared or (i and code[i - 1].text == '.'):
+            i += 1
+            continue
+        if text in numbers and not (i + 1 < len(code) and code[i + 1].text == '('):
+            value = numbers[text]
+            buffer.replace_token(tok, f'({value})' if value.startswith('-') else value)
+        elif text in uniforms:
+            value = uniforms[text]
+            j = i + 1
+            if isinstance(value, list):
+                if (j + 2 < len(code) and code[j].text == '[' and code[j + 2].text == ']'
+                        and code[j + 1].kind == NUMBER
+                        and code[j + 1].text.rstrip('uU').isdigit()
+                        and int(code[j + 1].text.rstrip('uU')) < len(value)):
+                    value = value[int(code[j + 1].text.rstrip('uU'))]
+                    j += 3
+                else:
+                    kept.add(text)
+                    i += 1
+                    continue
+            field = None
+            if j + 1 < len(code) and code[j].text == '.' and code[j + 1].kind == IDENT:
+                field = code[j + 1].text
+            replacement = _constant_text(value, field)
+            if replacement is None:
+                replacement = _constant_text(value)
+            else:
+                j += 2 if field is not None else 0
+            buffer.replace(tok.start, code[j - 1].end, replacement)
+            i = j
+            continue
+        i += 1
+
+    # Drop the declarations of uniforms that are gone
+    blocks = {}
+    for declaration in declarations:
+        remaining = [d for d in declaration.declarators if d[0] not in uniforms or d[0] in kept]
+        if declaration.block is not None:
+            blocks.setdefault(declaration.block, []).append((declaration, remaining))
+            continue
+        if len(remaining) == len(declaration.declarators):
+            continue
+        _rewrite_declaration(buffer, stream, declaration, remaining)
+    for (first, last, name), members in blocks.items():
+        if all(len(remaining) == len(declaration.declarators)
+               for declaration, remaining in members):
+            continue
+        remaining = [(declaration.type, member, count) for declaration, kept_members in members
+                     for member, count, _, _ in kept_members]
+        start, end = _line_span(source, code[first].start, code[last].end)
+        if not remaining:
+            buffer.replace(start, end, '')
+            continue
+        # The offsets change, so the block is laid out again
+        layout, _ = std140_layout(packed_order(remaining))
+        buffer.replace(code[first].start, code[last].end, block_declaration(layout, name))
+    return buffer.apply_source()
+
+
+def _rewrite_declaration(buffer, stream, declaration, remaining):
+    code = stream.code
+    source = stream.source
+    if not remaining:
+        start, end = _line_span(source, code[declaration.first].start,
+                                code[declaration.last].end)
+        buffer.replace(start, end, '')
+        return
+    # Keep everything up to the first declarator, then the remaining ones
+    head = source[code[declaration.first].start:code[declaration.declarators[0][2]].start]
+    kept = ', '.join(source[code[first].start:code[stop - 1].end]
+                     for _, _, first, stop in remaining)
+    buffer.replace(code[declaration.first].start, code[declaration.last].end,
+                   f'{head}{kept};')
+
+
+def _fold_branches(shader_code):
+    """shader_code with if (true), if (false) and while (false) resolved"""
+    while True:
+        stream = lex_glsl(shader_code)
+        code = stream.code
+        source = stream.source
+        buffer = RewriteBuffer(stream)
+        i = 0
+        while i < len(code):
+            tok = code[i]
+            if (tok.text not in ('if', 'while') or i + 4 >= len(code) or code[i + 1].text != '('
+                    or code[i + 2].text not in ('true', 'false') or code[i + 3].text != ')'):
+                i += 1
+                continue
+            holds = code[i + 2].text == 'true'
+            if tok.text == 'while' and holds:
+                i += 1
+                continue
+            body_last = statement_last(code, i + 4)
+            if body_last is None:
+                break
+            last = body_last
+            otherwise = None
+            if tok.text == 'if' and last + 1 < len(code) and code[last + 1].text == 'else':
+                last = statement_last(code, last + 2)
+                if last is None:
+                    break
+                otherwise = (body_last + 2, last)
+            if holds:
+                kept = (i + 4, body_last)
+            else:
+                kept = otherwise
+            if kept is not None:
+                replacement = source[code[kept[0]].start:code[kept[1]].end]
+                buffer.replace(tok.start, code[last].end, replacement)
+            elif i and code[i - 1].text in (')', 'else', 'do'):
+                # The statement is itself the body of another one
+                buffer.replace(tok.start, code[last].end, ';')
+            else:
+                start, end = _line_span(source, tok.start, code[last].end)
+                buffer.replace(start, end, '')
+            i = last + 1
+        if not len(buffer):
+            return shader_code
+        shader_code = buffer.apply_source()
+
+
+def specialize(shader_code, values):
+    """shader_code with the uniforms and macros named in values fixed
+
+    Uniforms the shader declares (Shadertoy's or its own, scalars, vectors
+    and arrays of them) are replaced by constants and their declarations
+    dropped.  Any other name is a macro whose #define gets the value,
+    such as HW_PERFORMANCE.  Values are numbers, or sequences for vectors
+    and arrays.  The #if branches, if statements and ?: the values decide
+    are then folded away, along with the code only they used.
+    """
+    for name in values:
+        if not _IDENTIFIER_RE.match(name):
+            raise ValueError(f'cannot specialize {name!r}: not a GLSL name')
+    stream = lex_glsl(shader_code)
+    declared = {}
+    for declaration in _uniform_declarations(stream):
+        for name, count, _, _ in declaration.declarators:
+            declared[name] = (declaration.type, count)
+    uniforms = {name: _uniform_constant(name, *declared[name], value)
+                for name, value in values.items() if name in declared}
+    macros = {name: _macro_text(value) for name, value in values.items()
+              if name not in declared}
+    code = _set_macros(shader_code, macros) if macros else shader_code
+    code = _fold_conditionals(code, macros) if macros else code
+    code = _substitute(code, uniforms, macros)
+    code = _fold_branches(fold_expressions(code))
+    return remove_unused_code(code)
+
+
+def specialize_variants(shader_code, configurations, **options):
+    """A Variant per name -> values in configurations, from one conversion of shader_code
+
+    Keyword options are conversion options, as for
+    convert_shadertoy_to_opengl().
+    """
+    converted = convert_shadertoy_to_opengl(shader_code, **options)
+    return [Variant(name, dict(values), specialize(converted, values))
+            for name, values in configurations.items()]
+
+
+def variant_manifest(variants, files=None):
+    """JSON-ready description of variants
+
+    Lists each variant with the values it was specialized for and the
+    uniforms the host must still set; files maps variant names to the
+    files they were written to.
+    """
+    files = files or {}
+    return {'variants': [{
+        'name': variant.name,
+        'file': files.get(variant.name),
+        'values': variant.values,
+        'uniforms': sorted(shader_facts(lex_glsl(variant.code)).uniforms),
+        'bytes': len(variant.code.encode('utf-8')),
+    } for variant in variants]}
@@ -0,0 +1,218 @@
+import re
+from collections import namedtuple
+
+from glsl_lexer import IDENT, PREPROC, lex_glsl, matching_bracket
+
+
+# Name of the block converted shaders declare their uniforms in
+BLOCK_NAME = 'ShadertoyUniforms'
+
+# The first desktop GLSL version with uniform blocks and std140 that still
+# has gl_FragColor and texture2D()
+BLOCK_VERSION = '#version 140'
+
+# The same for GLES 3 and WebGL2.  GLSL ES 3.00 has neither gl_FragColor nor
+# texture2D(), so they are defined onto what replaced them
+ES_BLOCK_VERSION = '#version 300 es'
+ES_FRAG_COLOR = 'shadertoy_FragColor'
+_ES_RENAMES = {
+    'texture2D': 'texture', 'texture2DLod': 'textureLod', 'texture2DProj': 'textureProj',
+    'textureCube': 'texture', 'texture3D': 'texture',
+}
+# Core in GLSL ES 3.00
+_ES_CORE_EXTENSIONS_RE = re.compile(
+    r'#[ \t]*extension[ \t]+(?:GL_OES_standard_derivatives|GL_EXT_shader_texture_lod)\b[^\n]*\n')
+# Sampler types GLSL ES 3.00 gives no default precision
+_ES_SAMPLERS = ('sampler3D', 'sampler2DArray')
+
+# type -> (base alignment, size, C++ scalar type, C++ shape) under std140;
+# matrices are arrays of columns padded to a vec4 each
+_STD140 = {}
+for _scalar, _prefix, _cpp in (('float', '', 'float'), ('int', 'i', 'std::int32_t'),
+                               ('uint', 'u', 'std::uint32_t'), ('bool', 'b', 'std::uint32_t')):
+    _STD140[_scalar] = (4, 4, _cpp, ())
+    _STD140[f'{_prefix}vec2'] = (8, 8, _cpp, (2,))
+    _STD140[f'{_prefix}vec3'] = (16, 12, _cpp, (3,))
+    _STD140[f'{_prefix}vec4'] = (16, 16, _cpp, (4,))
+for _columns in (2, 3, 4):
+    _STD140[f'mat{_columns}'] = (16, 16 * _columns, 'float', (_columns, 4))
+    for _rows in (2, 3, 4):
+        _STD140[f'mat{_columns}x{_rows}'] = (16, 16 * _columns, 'float', (_columns, 4))
+
+
+class Std140Member(namedtuple('Std140Member', 'type name count offset stride')):
+    """Where one block member lives: count is None for non-arrays, and
+    stride is the distance between array elements"""
+
+    __slots__ = ()
+
+    @property
+    def size(self):
+        return self.stride * self.count if self.count else _STD140[self.type][1]
+
+
+def _round_up(offset, alignment):
+    return -(-offset // alignment) * alignment
+
+
+def _std140(type_name):
+    try:
+        return _STD140[type_name]
+    except KeyError:
+        raise ValueError(f'{type_name} cannot be a uniform block member') from None
+
+
+def packed_order(members):
+    """(type, name, count) members reordered to waste little space
+
+    Arrays and 16-byte aligned members go first, then vec2s and scalars,
+    and each vec3 is followed by a scalar to fill its fourth component.
+    """
+    def alignment(member):
+        return 16 if member[2] else _std140(member[0])[0]
+
+    ordered = sorted(members, key=lambda member: -alignment(member))
+    scalars = [member for member in ordered if not member[2] and alignment(member) == 4]
+    result = []
+    for member in ordered:
+        if member in result:
+            continue
+        result.append(member)
+        if not member[2] and member[0].endswith('vec3') and scalars:
+            result.append(scalars.pop(0))
+    return result
+
+
+def std140_layout(members):
+    """Std140Member for each (type, name, count) in order, and the block size"""
+    layout = []
+    offset = 0
+    for type_name, name, count in members:
+        alignment, size, _, _ = _std140(type_name)
+        stride = size
+        if count:
+            # Array elements are padded to a vec4 each
+            alignment = stride = _round_up(size, 16)
+        offset = _round_up(offset, alignment)
+        member = Std140Member(type_name, name, count, offset, stride)
+        layout.append(member)
+        offset += member.size
+    return layout, _round_up(offset, 16)
+
+
+def block_declaration(layout, name=BLOCK_NAME):
+    """GLSL declaration of a std140 block with the members of layout, unnamed
+    so its members keep their plain names"""
+    lines = [f'layout(std140) uniform {name}', '{']
+    for member in layout:
+        suffix = f'[{member.count}]' if member.count else ''
+        lines.append(f'    {member.type} {member.name}{suffix};  // offset {member.offset}')
+    lines.append('};')
+    return '\n'.join(lines)
+
+
+def target_glsl_es(shader_code):
+    """shader_code with its leading BLOCK_VERSION turned into ES_BLOCK_VERSION
+
+    The output is then written to ES_FRAG_COLOR, texture functions map to
+    their GLSL ES 3.00 names, extensions that became core are dropped and
+    samplers without a default precision get one.  Shaders that do not
+    start with BLOCK_VERSION are returned unchanged.
+    """
+    if not shader_code.startswith(BLOCK_VERSION + '\n'):
+        return shader_code
+    body = _ES_CORE_EXTENSIONS_RE.sub('', shader_code[len(BLOCK_VERSION) + 1:])
+    stream = lex_glsl(body)
+    identifiers = {tok.text for tok in stream.code if tok.kind == IDENT}
+    # After the remaining #extension lines, which must come first
+    offset = 0
+    for tok in stream.code:
+        if tok.kind != PREPROC or not re.match(r'#\s*extension\b', tok.text):
+            break
+        offset = tok.end + 1
+    lines = [f'precision mediump {sampler};' for sampler in _ES_SAMPLERS
+             if sampler in identifiers]
+    lines.append(f'out mediump vec4 {ES_FRAG_COLOR};')
+    lines.append(f'#define gl_FragColor {ES_FRAG_COLOR}')
+    lines.extend(f'#define {name} {replacement}' for name, replacement in _ES_RENAMES.items()
+                 if name in identifiers)
+    return (ES_BLOCK_VERSION + '\n' + body[:offset] + '\n'.join(lines) + '\n'
+            + body[offset:])
+
+
+def uniform_block_members(shader_code, name=BLOCK_NAME):
+    """(type, name, count) of each member of the std140 block name, or None"""
+    stream = lex_glsl(shader_code)
+    code = stream.code
+    for i, tok in enumerate(code):
+        if (tok.text != 'uniform' or i + 2 >= len(code) or code[i + 1].text != name
+                or code[i + 2].text != '{'):
+            continue
+        if i < 4 or code[i - 1].text != ')' or 'std140' not in (t.text for t in code[i - 4:i]):
+            raise ValueError(f'uniform block {name} does not use the std140 layout')
+        close = matching_bracket(code, i + 2)
+        if close is None:
+            raise ValueError(f'uniform block {name} is not closed')
+        members = []
+        j = i + 3
+        while j < close:
+            type_name = code[j].text
+            j += 1
+            while j < close and code[j].text != ';':
+                if code[j].kind != IDENT:
+                    raise ValueError(f'unsupported declaration in uniform block {name}')
+                member, count = code[j].text, None
+                j += 1
+                if code[j].text == '[':
+                    count = int(code[j + 1].text.rstrip('uU'), 0)
+                    j += 3
+                members.append((type_name, member, count))
+                if code[j].text == ',':
+                    j += 1
+            j += 1
+        return members
+    return None
+
+
+def _cpp_member(member):
+    _, _, scalar, shape = _std140(member.type)
+    if member.count:
+        # Pad each element out to its std140 stride
+        shape = (member.count,) + (shape if len(shape) == 2 else (member.stride // 4,))
+    return scalar, ''.join(f'[{n}]' for n in shape)
+
+
+def cpp_uniform_struct(shader_code, name=BLOCK_NAME):
+    """C++ struct with the memory layout of the std140 block name in shader_code
+
+    Fill one per frame and upload it with a single glBufferSubData() into
+    the buffer bound to the block.  Padding is explicit and the offsets
+    are checked with static_assert, so a mismatch fails to compile.
+    """
+    members = uniform_block_members(shader_code, name)
+    if members is None:
+        raise ValueError(f'the shader has no uniform block {name}')
+    layout, size = std140_layout(members)
+    lines = [f'// std140 layout of the {name} uniform block',
+             '#pragma once', '#include <cstddef>', '#include <cstdint>', '',
+             f'struct {name}', '{']
+    offset = 0
+    padding = 0
+    for member in layout + [Std140Member('float', None, None, size, 0)]:
+        if member.offset > offset:
+            lines.append(f'    float _pad{padding}[{(member.offset - offset) // 4}];')
+            padding += 1
+        if member.name is None:
+            break
+        scalar, dimensions = _cpp_member(member)
+        suffix = f'[{member.count}]' if member.count else ''
+        lines.append(f'    {scalar} {member.name}{dimensions};  '
+                     f'// {member.type}{suffix} at offset {member.offset}')
+        offset = member.offset + member.size
+    lines.append('};')
+    lines.append('')
+    for member in layout:
+        lines.append(f'static_assert (offsetof ({name}, {member.name}) == {member.offset}, '
+                     f'"std140 offset of {member.name}");')
+    lines.append(f'static_assert (sizeof ({name}) == {size}, "std140 size of {name}");')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,330 @@
+import hashlib
+import json
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from conversion_cache import atomic_write
+from shadertoy_to_opengl import (convert_shadertoy_to_opengl, converter_fingerprint,
+                                 detected_uniforms, resolve_options)
+
+
+# Format of the manifest kept beside a bundle; a manifest of another
+# version is ignored and everything is converted again
+MANIFEST_VERSION = 1
+
+# MSVC refuses string literals longer than this after concatenation;
+# longer shaders are written as char arrays instead
+MAX_STRING_LITERAL = 65535
+
+_IDENTIFIER_RE = re.compile(r'[A-Za-z_]\w*\Z')
+_SYMBOL_CHARS_RE = re.compile(r'\W')
+
+_CPP_KEYWORDS = frozenset('''
+    alignas alignof and and_eq asm auto bitand bitor bool break case catch char char8_t
+    char16_t char32_t class compl concept const consteval constexpr constinit const_cast
+    continue co_await co_return co_yield decltype default delete do double dynamic_cast
+    else enum explicit export extern false float for friend goto if inline int long
+    mutable namespace new noexcept not not_eq nullptr operator or or_eq private protected
+    public register reinterpret_cast requires return short signed sizeof static
+    static_assert static_cast struct switch template this thread_local throw true try
+    typedef typeid typename union unsigned using virtual void volatile wchar_t while xor
+    xor_eq
+'''.split())
+
+# Names the bundle itself declares in its namespace
+_RESERVED = frozenset(('Shader', 'Uniform', 'shaders', 'numShaders', 'getShader'))
+
+_ESCAPES = {'\\': '\\\\', '"': '\\"', '\n': '\\n', '\t': '\\t'}
+
+
+class BundleEntry(namedtuple('BundleEntry', 'name source digest code uniforms symbol')):
+    """One shader of a bundle: name is its path relative to the input root
+    without the extension, uniforms the (type, name, count) of the
+    Shadertoy uniforms it uses and symbol the C++ variable holding its
+    code, once the bundle is laid out"""
+
+    __slots__ = ()
+
+    def as_dict(self):
+        return {'name': self.name, 'source': self.source, 'sha256': self.digest,
+                'uniforms': [list(uniform) for uniform in self.uniforms], 'code': self.code}
+
+
+class BundleReport:
+    """What build_bundle() converted, reused and wrote"""
+
+    def __init__(self, entries, converted, reused, errors, written):
+        self.entries = entries
+        self.converted = converted
+        self.reused = reused
+        # (source, message) of each shader that failed to convert
+        self.errors = errors
+        # Paths of the bundle files whose content changed
+        self.written = written
+
+    def summary(self):
+        text = (f'{len(self.entries)} shaders bundled ({len(self.converted)} converted, '
+                f'{len(self.reused)} unchanged, {len(self.errors)} failed); ')
+        if not self.written:
+            return text + 'bundle unchanged'
+        return text + 'wrote ' + ', '.join(self.written)
+
+    def as_dict(self):
+        return {
+            'shaders': [entry.name for entry in self.entries],
+            'converted': list(self.converted),
+            'reused': list(self.reused),
+            'errors': [{'source': source, 'error': error} for source, error in self.errors],
+            'written': list(self.written),
+        }
+
+
+def source_digest(data):
+    """Hash of a shader's bytes, as kept in the manifest"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def _symbol(name, taken):
+    """A C++ identifier for name that neither it nor its Data and Uniforms
+    arrays share with the symbols taken"""
+    symbol = _SYMBOL_CHARS_RE.sub('_', name)
+    if not symbol or symbol[0].isdigit() or symbol in _CPP_KEYWORDS:
+        symbol = '_' + symbol
+    # Leading underscores followed by a capital, and double underscores,
+    # are reserved to the implementation
+    symbol = re.sub('__+', '_', symbol)
+    if re.match('_[A-Z]', symbol):
+        symbol = 'shader' + symbol
+    unique = symbol
+    n = 2
+    while {unique, unique + 'Data', unique + 'Uniforms'} & taken:
+        unique = f'{symbol}_{n}'
+        n += 1
+    taken.update((unique, unique + 'Data', unique + 'Uniforms'))
+    return unique
+
+
+def _cpp_string(code, indent):
+    """code as adjacent C++ string literals, one per line of code"""
+    pieces = []
+    for line in code.splitlines(keepends=True):
+        escaped = []
+        previous = None
+        for char in line:
+            if char in _ESCAPES:
+                escaped.append(_ESCAPES[char])
+            elif char == '?' and previous == '?':
+                # Keep ?? from starting a trigraph in older compilers
+                escaped.append('\\?')
+            elif ' ' <= char <= '~':
+                escaped.append(char)
+            else:
+                escaped.extend(f'\\{byte:03o}' for byte in char.encode('utf-8'))
+            previous = char
+        pieces.append(f'{indent}"{"".join(escaped)}"')
+    return '\n'.join(pieces) or f'{indent}""'
+
+
+def _cpp_bytes(data, indent):
+    rows = []
+    for start in range(0, len(data), 24):
+        rows.append(indent + ','.join(str(byte) for byte in data[start:start + 24]) + ',')
+    rows.append(indent + '0')
+    return '\n'.join(rows)
+
+
+def bundle_header(entries, namespace):
+    """Declarations of the bundle in namespace
+
+    Only the set of shaders shows here, not their code or sizes, so editing
+    a shader leaves the header as it was and files including it do not
+    have to recompile.
+    """
+    lines = ['// Shaders converted by shadertoy_to_opengl; generated, do not edit',
+             '#pragma once', '', f'namespace {namespace}', '{',
+             '    struct Uniform',
+             '    {',
+             '        const char* name;',
+             '        const char* type;',
+             '        int count;                      // array size, 0 if not an array',
+             '    };', '',
+             '    struct Shader',
+             '    {',
+             '        const char* name;               // source path without extension',
+             '        const char* code;               // converted fragment shader',
+             '        int size;                       // bytes in code, without the null',
+             '        const Uniform* uniforms;        // uniforms the code uses',
+             '        int numUniforms;',
+             '    };', '']
+    for entry in entries:
+        lines.append(f'    extern const char* const {entry.symbol};')
+    if entries:
+        lines.append('')
+    lines.extend([f'    const int numShaders = {len(entries)};',
+                  '    extern const Shader shaders[];', '',
+                  '    // The shader with this name, or nullptr',
+                  '    const Shader* getShader (const char* name) noexcept;',
+                  '}', ''])
+    return '\n'.join(lines)
+
+
+def bundle_source(entries, namespace, header_name):
+    """Definitions matching bundle_header(), to compile into the project"""
+    lines = ['// Shaders converted by shadertoy_to_opengl; generated, do not edit',
+             f'#include "{header_name}"', '#include <cstring>', '',
+             f'namespace {namespace}', '{']
+    for entry in entries:
+        data = entry.code.encode('utf-8')
+        lines.append(f'    // {entry.source}')
+        if len(data) > MAX_STRING_LITERAL:
+            lines.append(f'    static const char {entry.symbol}Data[] =')
+            lines.append('    {')
+            lines.append(_cpp_bytes(data, '        '))
+            lines.append('    };')
+            lines.append(f'    const char* const {entry.symbol} = {entry.symbol}Data;')
+        else:
+            lines.append(f'    const char* const {entry.symbol} =')
+            lines.append(_cpp_string(entry.code, '        ') + ';')
+        if entry.uniforms:
+            lines.append(f'    static const Uniform {entry.symbol}Uniforms[] =')
+            lines.append('    {')
+            for type_name, name, count in entry.uniforms:
+                lines.append(f'        {{ "{name}", "{type_name}", {count or 0} }},')
+            lines.append('    };')
+        lines.append('')
+    lines.extend(['    const Shader shaders[] =', '    {'])
+    for entry in entries:
+        uniforms = f'{entry.symbol}Uniforms' if entry.uniforms else 'nullptr'
+        lines.append(f'        {{ {_cpp_string(entry.name, "")}, {entry.symbol}, '
+                     f'{len(entry.code.encode("utf-8"))}, {uniforms}, {len(entry.uniforms)} }},')
+    if not entries:
+        # An array cannot be empty
+        lines.append('        { nullptr, nullptr, 0, nullptr, 0 }')
+    lines.extend(['    };', '',
+                  '    const Shader* getShader (const char* name) noexcept',
+                  '    {',
+                  '        for (int i = 0; i < numShaders; ++i)',
+                  '            if (std::strcmp (shaders[i].name, name) == 0)',
+                  '                return shaders + i;',
+                  '',
+                  '        return nullptr;',
+                  '    }',
+                  '}', ''])
+    return '\n'.join(lines)
+
+
+def load_manifest(path, options):
+    """name -> BundleEntry from the manifest at path, or {} when there is
+    none or it was made by other conversion rules or options"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if (not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION
+            or manifest.get('fingerprint') != converter_fingerprint()
+            or manifest.get('options') != options):
+        return {}
+    try:
+        return {shader['name']: BundleEntry(shader['name'], shader['source'],
+                                            shader['sha256'], shader['code'],
+                                            [tuple(uniform) for uniform in shader['uniforms']],
+                                            None)
+                for shader in manifest['shaders']}
+    except (KeyError, TypeError):
+        return {}
+
+
+def _convert_entry(job):
+    name, source, digest, data, options = job
+    try:
+        output = convert_shadertoy_to_opengl(data.decode('utf-8'), **options)
+        return BundleEntry(name, source, digest, output, detected_uniforms(output), None), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+
+def _write_if_changed(path, text):
+    data = text.encode('utf-8')
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    except OSError:
+        pass
+    atomic_write(path, data)
+    return True
+
+
+def build_bundle(shaders, base_path, namespace=None, options=None, workers=None):
+    """Convert shaders into the C++ bundle base_path.h / base_path.cpp
+
+    shaders are (name, source path) pairs; names must be unique.  The
+    manifest base_path.manifest.json keeps each shader's input hash and
+    conversion, so only shaders whose bytes changed since the last build
+    are converted again, and the bundle files are only rewritten when
+    their content changes.  Changing the options or the conversion rules
+    converts everything again.  Shaders that fail to convert are left
+    out and listed in the report.  namespace defaults to the file name of
+    base_path.
+    """
+    namespace = namespace or os.path.basename(base_path)
+    if not _IDENTIFIER_RE.match(namespace) or namespace in _CPP_KEYWORDS:
+        raise ValueError(f'{namespace!r} cannot be used as a C++ namespace')
+    options = resolve_options(options)
+    manifest_path = base_path + '.manifest.json'
+    previous = load_manifest(manifest_path, options)
+
+    seen = set()
+    entries = {}
+    jobs = []
+    for name, source in shaders:
+        if name in seen:
+            raise ValueError(f'two shaders are called {name!r}')
+        seen.add(name)
+        with open(source, 'rb') as f:
+            data = f.read()
+        digest = source_digest(data)
+        entry = previous.get(name)
+        if entry is not None and entry.digest == digest:
+            entries[name] = entry._replace(source=source)
+        else:
+            jobs.append((name, source, digest, data, options))
+
+    reused = list(entries)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(jobs) <= 1:
+        results = list(map(_convert_entry, jobs))
+    else:
+        with ProcessPoolExecutor(min(workers, len(jobs))) as pool:
+            results = list(pool.map(_convert_entry, jobs))
+    errors = []
+    converted = []
+    for job, (entry, error) in zip(jobs, results):
+        if error is not None:
+            errors.append((job[1], error))
+        else:
+            entries[entry.name] = entry
+            converted.append(entry.name)
+
+    # Shaders keep their order in the input, and so their symbols
+    ordered = []
+    taken = set(_RESERVED)
+    for name, _ in shaders:
+        entry = entries.get(name)
+        if entry is not None:
+            ordered.append(entry._replace(symbol=_symbol(name, taken)))
+
+    header_path = base_path + '.h'
+    written = []
+    if _write_if_changed(header_path, bundle_header(ordered, namespace)):
+        written.append(header_path)
+    source_text = bundle_source(ordered, namespace, os.path.basename(header_path))
+    if _write_if_changed(base_path + '.cpp', source_text):
+        written.append(base_path + '.cpp')
+    manifest = {'version': MANIFEST_VERSION, 'fingerprint': converter_fingerprint(),
+                'options': options, 'shaders': [entry.as_dict() for entry in ordered]}
+    _write_if_changed(manifest_path, json.dumps(manifest, indent=1) + '\n')
+    return BundleReport(ordered, converted, reused, errors, written)
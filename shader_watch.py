@@ -0,0 +1,314 @@
+import ctypes
+import ctypes.util
+import fnmatch
+import hashlib
+import os
+import select
+import struct
+import time
+
+from batch_convert import (DEFAULT_SUFFIX, SHADER_PATTERNS, collect_jobs, is_output,
+                           output_path, run_batch)
+
+
+# A burst of events ends once none has come for DEBOUNCE seconds; a steady
+# stream of them is still handled every MAX_DELAY seconds
+DEBOUNCE = 0.01
+MAX_DELAY = 0.1
+
+# Seconds between scans when polling
+POLL_INTERVAL = 0.25
+
+# From <sys/inotify.h>
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ONLYDIR = 0x1000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+_EVENT = struct.Struct('iIII')
+
+# A file is done once it is closed after writing or renamed into place,
+# so the writes of one save make one event; new directories are watched
+_WATCH_MASK = (_IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_MOVED_FROM | _IN_CREATE | _IN_DELETE
+               | _IN_ONLYDIR)
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+except (OSError, AttributeError):
+    _libc = None
+
+
+def inotify_available():
+    return _libc is not None
+
+
+class InotifyWatcher:
+    """Changed files under some directories, as Linux inotify reports them
+
+    directories are (path, recursive) pairs; directories created inside a
+    recursive one are watched as they appear.
+    """
+
+    def __init__(self, directories):
+        if _libc is None:
+            raise OSError('inotify is not available on this system')
+        self._fd = _inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._directories = {}  # watch descriptor -> (path, recursive)
+        try:
+            for directory, recursive in directories:
+                self._watch(directory, recursive)
+        except OSError:
+            self.close()
+            raise
+
+    def _watch(self, directory, recursive):
+        """Watch directory; returns the files already in it, for directories
+        that turn up after the watch started"""
+        wd = _inotify_add_watch(self._fd, os.fsencode(directory), _WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), directory)
+        self._directories[wd] = (directory, recursive)
+        files = []
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return files
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    files.extend(self._watch(entry.path, True))
+            else:
+                files.append(entry.path)
+        return files
+
+    def wait(self, timeout=None):
+        """Paths that changed, waiting up to timeout seconds for the first;
+        None when events were lost and anything may have changed"""
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return set()
+        changed = set()
+        lost = False
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + _EVENT.size:offset + _EVENT.size + length]
+                                   .rstrip(b'\0'))
+                offset += _EVENT.size + length
+                if mask & _IN_Q_OVERFLOW:
+                    lost = True
+                    continue
+                if mask & _IN_IGNORED:
+                    # The directory is gone
+                    self._directories.pop(wd, None)
+                    continue
+                directory, recursive = self._directories.get(wd, (None, False))
+                if directory is None:
+                    continue
+                path = os.path.join(directory, name)
+                if not mask & _IN_ISDIR:
+                    if mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_MOVED_FROM | _IN_DELETE):
+                        changed.add(path)
+                elif recursive and mask & (_IN_CREATE | _IN_MOVED_TO):
+                    try:
+                        changed.update(self._watch(path, True))
+                    except OSError:
+                        lost = True
+        return None if lost else changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    """Changed files under some directories, found by comparing the size
+    and modification time of every file accept() takes at each scan"""
+
+    def __init__(self, directories, accept=lambda path: True, interval=POLL_INTERVAL):
+        self.directories = list(directories)
+        self.accept = accept
+        self.interval = interval
+        self._files = self._scan()
+        self._next_scan = time.monotonic() + interval
+
+    def _scan(self):
+        files = {}
+        pending = list(self.directories)
+        while pending:
+            directory, recursive = pending.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            pending.append((entry.path, True))
+                    elif self.accept(entry.path):
+                        st = entry.stat()
+                        files[entry.path] = (st.st_mtime_ns, st.st_size)
+                except OSError:
+                    continue  # removed meanwhile
+        return files
+
+    def wait(self, timeout=None):
+        """Paths that changed, waiting up to timeout seconds for the first"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            if deadline is not None and deadline < self._next_scan:
+                time.sleep(max(0.0, deadline - now))
+                return set()
+            time.sleep(max(0.0, self._next_scan - now))
+            self._next_scan = time.monotonic() + self.interval
+            files = self._scan()
+            changed = {path for path in files.keys() | self._files.keys()
+                       if files.get(path) != self._files.get(path)}
+            self._files = files
+            if changed:
+                return changed
+
+    def close(self):
+        pass
+
+
+class ShaderWatch:
+    """Keeps the outputs of some inputs converted as the inputs change
+
+    inputs, output_dir, suffix, cache_dir, options and variants mean what
+    they do for batch_convert.  Directories are watched for new shaders
+    too; files and glob patterns stand for the files they name at the
+    start.  Every file is converted once to start with; after that only
+    files whose content hash changed are, and outputs are written
+    atomically, so a reader never sees half a file.  inotify is used when
+    the system has it, unless poll is set.
+    """
+
+    def __init__(self, inputs, output_dir=None, suffix=DEFAULT_SUFFIX, cache_dir=None,
+                 options=None, variants=None, poll=False):
+        self.output_dir = output_dir
+        self.suffix = suffix
+        self.cache_dir = cache_dir
+        self.options = options
+        self.variants = variants
+        self._roots = []   # watched input directories
+        self._files = {}   # file input -> destination
+        self._digests = {}
+        watched = {}
+        for item in inputs:
+            if os.path.isdir(item):
+                root = os.path.normpath(item)
+                self._roots.append(root)
+                watched[root] = True
+            else:
+                for source, destination in collect_jobs([item], output_dir, suffix):
+                    self._files[source] = destination
+                    watched.setdefault(os.path.dirname(source) or os.curdir, False)
+        self.polling = poll or not inotify_available()
+        if not self.polling:
+            self.watcher = InotifyWatcher(watched.items())
+        else:
+            self.watcher = PollingWatcher(watched.items(),
+                                          lambda path: self.destination(path) is not None)
+
+    def destination(self, path):
+        """Output path for the input at path, or None if it is not watched"""
+        path = os.path.normpath(path)
+        if path in self._files:
+            return self._files[path]
+        name = os.path.basename(path)
+        if (name.startswith('.') or self._written_here(path)
+                or not any(fnmatch.fnmatch(name, pattern) for pattern in SHADER_PATTERNS)):
+            return None
+        for root in self._roots:
+            if not os.path.relpath(path, root).startswith(os.pardir):
+                return output_path(path, root, self.output_dir, self.suffix)
+        return None
+
+    def _written_here(self, path):
+        """Whether path may be an output of this watch, which must not be
+        converted again when it is written"""
+        if self.output_dir is None:
+            return is_output(path, self.suffix)
+        return not os.path.relpath(path, self.output_dir).startswith(os.pardir)
+
+    def jobs(self):
+        """(source, destination) of every input there is now"""
+        inputs = self._roots + list(self._files)
+        return collect_jobs(inputs, self.output_dir, self.suffix) if inputs else []
+
+    def start(self, workers=None):
+        """Convert every input, yielding convert_file() results"""
+        jobs = self.jobs()
+        # Hash first: a change made during the conversion is then seen again
+        jobs = [job for job in jobs if self._changed(job[0]) is not False]
+        yield from run_batch(jobs, workers, self.cache_dir, False, self.options, self.variants)
+
+    def _changed(self, path):
+        """Whether path's content differs from the last conversion, or None
+        if it cannot be read; the new hash is remembered"""
+        try:
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            self._digests.pop(path, None)
+            return None
+        if self._digests.get(path) == digest:
+            return False
+        self._digests[path] = digest
+        return True
+
+    def wait(self, timeout=None):
+        """The paths changed in the next burst of events, waiting up to
+        timeout seconds for it to start; None when anything may have
+        changed"""
+        changed = self.watcher.wait(timeout)
+        if not changed:
+            return changed
+        deadline = time.monotonic() + MAX_DELAY
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return changed
+            more = self.watcher.wait(min(DEBOUNCE, remaining))
+            if more is None:
+                return None
+            if not more:
+                return changed
+            changed |= more
+
+    def update(self, paths):
+        """Convert the inputs among paths whose content changed, yielding
+        convert_file() results; None for paths rescans every input"""
+        if paths is None:
+            paths = [source for source, _ in self.jobs()]
+        jobs = []
+        for path in sorted(paths):
+            destination = self.destination(path)
+            if destination is not None and self._changed(os.path.normpath(path)):
+                jobs.append((os.path.normpath(path), destination))
+        # In this process: a pool would cost more than a few conversions
+        yield from run_batch(jobs, 1, self.cache_dir, False, self.options, self.variants)
+
+    def close(self):
+        self.watcher.close()
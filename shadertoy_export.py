@@ -0,0 +1,422 @@
+import collections
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from conversion_cache import atomic_write
+from shadertoy_to_opengl import (convert_shadertoy_to_opengl, converter_fingerprint,
+                                 resolve_options)
+
+
+# Characters read from an export at a time
+CHUNK_SIZE = 1 << 20
+
+# Conversions in flight per worker; what bounds memory besides the shader
+# being read
+PENDING_PER_WORKER = 4
+
+# A checkpoint is written after this many shaders or seconds, whichever
+# comes first
+CHECKPOINT_SHADERS = 200
+CHECKPOINT_SECONDS = 5.0
+
+_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+_STRUCTURE_RE = re.compile(r'[{}\[\]"]')
+_STRING_BODY_RE = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+_SCALAR_END_RE = re.compile(r'[,\]}: \t\n\r]')
+
+
+class _Reader:
+    """JSON values read one at a time from a text file, keeping only the
+    value being read in memory"""
+
+    def __init__(self, f):
+        self._file = f
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        # Characters dropped from the front of the buffer, for messages
+        self._dropped = 0
+
+    def _fill(self):
+        if self._eof:
+            return False
+        data = self._file.read(CHUNK_SIZE)
+        if not data:
+            self._eof = True
+            return False
+        self._buffer += data
+        return True
+
+    def error(self, message):
+        return ValueError(f'{message} at character {self._dropped + self._pos}')
+
+    def peek(self):
+        """The next character that is not whitespace, or '' at the end"""
+        while True:
+            self._pos = _WHITESPACE_RE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            # Only whitespace is left; drop it before reading on
+            self._dropped += len(self._buffer)
+            self._buffer = ''
+            self._pos = 0
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise self.error(f'expected {char!r}')
+        self._pos += 1
+
+    def _string_end(self, start):
+        while True:
+            m = _STRING_BODY_RE.match(self._buffer, start + 1)
+            if m is not None:
+                return m.end()
+            if not self._fill():
+                raise self.error('unterminated string')
+
+    def _value_end(self):
+        char = self.peek()
+        if char == '':
+            raise self.error('unexpected end of JSON')
+        if char == '"':
+            return self._string_end(self._pos)
+        if char not in '{[':
+            while True:
+                m = _SCALAR_END_RE.search(self._buffer, self._pos)
+                if m is not None:
+                    return m.start()
+                if not self._fill():
+                    return len(self._buffer)
+        depth = 0
+        i = self._pos
+        while True:
+            m = _STRUCTURE_RE.search(self._buffer, i)
+            if m is None:
+                i = len(self._buffer)
+                if not self._fill():
+                    raise self.error('unexpected end of JSON')
+                continue
+            if m.group() == '"':
+                i = self._string_end(m.start())
+                continue
+            i = m.end()
+            depth += 1 if m.group() in '{[' else -1
+            if depth == 0:
+                return i
+
+    def _take(self):
+        end = self._value_end()
+        text = self._buffer[self._pos:end]
+        self._pos = end
+        # Let go of what has been read, so the buffer holds one value at most
+        if self._pos > CHUNK_SIZE:
+            self._dropped += self._pos
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        return text
+
+    def value(self):
+        """Decode the next value"""
+        start = self._dropped + self._pos
+        text = self._take()
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            raise ValueError(f'invalid JSON at character {start}: {e}') from None
+
+    def skip(self):
+        """Pass over the next value without decoding it"""
+        self._take()
+
+    def separator(self, close):
+        """Consume the ',' between items; True once close ends the container"""
+        char = self.peek()
+        if char == close:
+            self._pos += 1
+            return True
+        self.expect(',')
+        return False
+
+
+def _array_items(reader, skip):
+    """Items of the array at the reader, skipping the first skip[0] of them"""
+    reader.expect('[')
+    if reader.peek() == ']':
+        reader.expect(']')
+        return
+    while True:
+        if skip[0]:
+            skip[0] -= 1
+            reader.skip()
+        else:
+            yield reader.value()
+        if reader.separator(']'):
+            return
+
+
+def _object_shaders(reader, skip):
+    # A query result keeps its shaders in a Results array, a single shader
+    # lookup in Shader; any other object is taken to be a shader itself
+    reader.expect('{')
+    fields = {}
+    if reader.peek() == '}':
+        reader.expect('}')
+    else:
+        while True:
+            key = reader.value()
+            if not isinstance(key, str):
+                raise reader.error('expected an object key')
+            reader.expect(':')
+            if key == 'Results' and reader.peek() == '[':
+                yield from _array_items(reader, skip)
+            elif key == 'Shader':
+                if skip[0]:
+                    skip[0] -= 1
+                    reader.skip()
+                else:
+                    yield reader.value()
+            else:
+                fields[key] = reader.value()
+            if reader.separator('}'):
+                break
+    if 'renderpass' in fields:
+        if skip[0]:
+            skip[0] -= 1
+        else:
+            yield fields
+
+
+def iter_export(f, skip=0):
+    """The shaders of a Shadertoy JSON export read from the text file f,
+    one at a time, without loading the whole file
+
+    Understands a list of shaders (the site's export), an API response
+    (an object with the shaders under Results, or one under Shader) and
+    any number of such values one after another, as in JSON Lines.  List
+    items are yielded as they are, so they may be {'Shader': ...}
+    wrappers or no shader at all; see export_shader().  The first skip
+    items are passed over without being decoded.
+    """
+    reader = _Reader(f)
+    skip = [skip]
+    while True:
+        char = reader.peek()
+        if char == '':
+            return
+        if char == '[':
+            yield from _array_items(reader, skip)
+        elif char == '{':
+            yield from _object_shaders(reader, skip)
+        else:
+            raise reader.error('expected a JSON array or object')
+
+
+def export_shader(item):
+    """The shader in an item of iter_export(), or None"""
+    if isinstance(item, dict) and isinstance(item.get('Shader'), dict):
+        item = item['Shader']
+    if isinstance(item, dict) and isinstance(item.get('renderpass'), list):
+        return item
+    return None
+
+
+def _pass_type(renderpass):
+    # Old exports only name the passes
+    kind = renderpass.get('type') or renderpass.get('name', '')
+    return kind.lower()
+
+
+def image_pass_code(shader):
+    """Code of the shader's Image pass, after its Common pass as Shadertoy
+    compiles it, and the names of the passes that are left out; the code
+    is None without an Image pass"""
+    code = None
+    common = []
+    ignored = []
+    for renderpass in shader['renderpass']:
+        if not isinstance(renderpass, dict):
+            continue
+        kind = _pass_type(renderpass)
+        if kind == 'image' and code is None:
+            code = renderpass.get('code', '')
+        elif kind == 'common':
+            common.append(renderpass.get('code', ''))
+        else:
+            ignored.append(renderpass.get('name') or kind)
+    if code is not None and common:
+        code = '\n'.join(common + [code])
+    return code, ignored
+
+
+def _convert_pass(job):
+    code, options = job
+    started = time.perf_counter()
+    try:
+        output = convert_shadertoy_to_opengl(code, **options)
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}', time.perf_counter() - started
+    return output, None, time.perf_counter() - started
+
+
+class ExportSummary:
+    """What convert_exports() did"""
+
+    def __init__(self, converted=0, failed=0, skipped=0, resumed=0, seconds=0.0):
+        self.converted = converted
+        self.failed = failed
+        self.skipped = skipped
+        # Shaders done by an earlier run that this one resumed
+        self.resumed = resumed
+        self.seconds = seconds
+
+    @property
+    def shaders(self):
+        return self.converted + self.failed + self.skipped
+
+    def summary(self):
+        text = (f'{self.shaders} shaders in {self.seconds:.1f}s: {self.converted} converted, '
+                f'{self.failed} failed, {self.skipped} skipped')
+        if self.resumed:
+            text += f' (resumed after {self.resumed})'
+        return text
+
+    def as_dict(self):
+        return {'converted': self.converted, 'failed': self.failed, 'skipped': self.skipped,
+                'resumed': self.resumed, 'seconds': self.seconds}
+
+
+def _load_checkpoint(path, identity):
+    try:
+        with open(path, encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        raise ValueError(f'{path}: not a checkpoint') from None
+    if {key: checkpoint.get(key) for key in identity} != identity:
+        raise ValueError(f'{path}: the checkpoint is for other inputs or options')
+    return checkpoint
+
+
+def convert_exports(inputs, output, options=None, workers=None, resume=False,
+                    on_record=None):
+    """Convert the Image pass of every shader in the Shadertoy JSON exports
+    inputs, writing one JSON line per shader to output
+
+    Each line has the shader's position in the inputs as index, its id and
+    name, a status of 'converted', 'failed' or 'skipped' (no Image pass,
+    or not a shader), the error, the converted code and the passes that
+    were left out.  Shaders are read and converted as a stream on a pool
+    of workers with a bounded number in flight, and lines are written in
+    input order, so memory stays flat however big the exports are.
+
+    output.checkpoint records how far the output is complete.  With resume,
+    a run picks up where the checkpoint says the last one stopped, after
+    cutting off any partial output beyond it; without a checkpoint it
+    starts over.  on_record, if given, is called with each line's dict.
+    """
+    started = time.perf_counter()
+    options = resolve_options(options)
+    checkpoint_path = output + '.checkpoint'
+    identity = {'inputs': [os.path.abspath(path) for path in inputs], 'options': options,
+                'fingerprint': converter_fingerprint()}
+    checkpoint = _load_checkpoint(checkpoint_path, identity) if resume else None
+    # Lines written, and the input and item within it they reach
+    done, position = 0, (0, 0)
+    if checkpoint:
+        done, position = checkpoint['shaders'], (checkpoint['input'], checkpoint['items'])
+    summary = ExportSummary(resumed=done)
+    if checkpoint and checkpoint['complete']:
+        summary.seconds = time.perf_counter() - started
+        return summary
+
+    workers = workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(workers) if workers > 1 else None
+    pending = collections.deque()
+    try:
+        with open(output, 'r+b' if checkpoint else 'wb') as out:
+            if checkpoint:
+                out.truncate(checkpoint['output_bytes'])
+                out.seek(checkpoint['output_bytes'])
+            last_saved = (time.monotonic(), done)
+
+            def save_checkpoint(complete=False):
+                nonlocal last_saved
+                out.flush()
+                os.fsync(out.fileno())
+                state = dict(identity, shaders=done, input=position[0], items=position[1],
+                             output_bytes=out.tell(), complete=complete)
+                atomic_write(checkpoint_path, (json.dumps(state) + '\n').encode('utf-8'))
+                last_saved = (time.monotonic(), done)
+
+            def finish(record, result, reached):
+                nonlocal done, position
+                if result is None:
+                    summary.skipped += 1
+                else:
+                    code, error, seconds = result.result() if pool is not None else result
+                    record.update(status='failed' if error else 'converted', error=error,
+                                  code=code, seconds=round(seconds, 6))
+                    if error:
+                        summary.failed += 1
+                    else:
+                        summary.converted += 1
+                out.write((json.dumps(record) + '\n').encode('utf-8'))
+                if on_record is not None:
+                    on_record(record)
+                done += 1
+                position = reached
+                if (done - last_saved[1] >= CHECKPOINT_SHADERS
+                        or time.monotonic() - last_saved[0] >= CHECKPOINT_SECONDS):
+                    save_checkpoint()
+
+            index = done
+            for number in range(position[0], len(inputs)):
+                skip = position[1] if number == position[0] else 0
+                with open(inputs[number], encoding='utf-8') as f:
+                    # Items the checkpoint covers are passed over, not decoded
+                    for item_number, item in enumerate(iter_export(f, skip), skip):
+                        record, job = _record(item, index, options)
+                        index += 1
+                        if job is None:
+                            result = None
+                        elif pool is None:
+                            result = _convert_pass(job)
+                        else:
+                            result = pool.submit(_convert_pass, job)
+                        pending.append((record, result, (number, item_number + 1)))
+                        limit = workers * PENDING_PER_WORKER if pool is not None else 0
+                        while len(pending) > limit:
+                            finish(*pending.popleft())
+            while pending:
+                finish(*pending.popleft())
+            save_checkpoint(complete=True)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    summary.seconds = time.perf_counter() - started
+    return summary
+
+
+def _record(item, index, options):
+    """The output line for an item of iter_export(), and the conversion
+    job for its Image pass, if it has one"""
+    shader = export_shader(item)
+    info = shader.get('info') if shader is not None else None
+    info = info if isinstance(info, dict) else {}
+    record = {'index': index, 'id': info.get('id'), 'name': info.get('name'),
+              'status': 'skipped', 'error': None, 'code': None, 'seconds': None,
+              'ignored_passes': []}
+    if shader is None:
+        record['error'] = 'not a shader'
+        return record, None
+    code, record['ignored_passes'] = image_pass_code(shader)
+    if code is None:
+        record['error'] = 'no Image pass'
+        return record, None
+    return record, (code, options)
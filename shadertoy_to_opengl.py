@@ -1,174 +1,564 @@
-import tkinter as tk
-from tkinter import ttk
+import hashlib
+import queue
 import re
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+try:
+    import tkinter as tk
+    from tkinter import ttk
+except ImportError:
+    # Headless machines can still convert; only the window needs Tk
+    tk = ttk = None
+
+from conversion_cache import ConversionCache
+from glsl_analysis import (ASSIGN, COMPOUND_ASSIGN, INCREMENT, LOOP_CONDITION, VARIABLE,
+                           build_usage_index, unit_symbols)
+from glsl_ast import optimize_expressions
+from glsl_cost import estimate_cost, shader_constants
+from glsl_highlight import ADDED, REWRITTEN, highlight_tokens, line_edits, rewritten_lines
+from glsl_loops import bound_loops, unbounded_loops, unroll_loops
+from glsl_precision import infer_precision, qualify_precision
+from glsl_uniform_block import (BLOCK_NAME, BLOCK_VERSION, block_declaration, target_glsl_es,
+                                cpp_uniform_struct, packed_order, std140_layout)
+from glsl_lexer import (IDENT, NUMBER, PREPROC, PUNCT, WHITESPACE, RewriteBuffer,
+                        directive_line_end, edits_applied, lex_glsl, matching_bracket, source_span,
+                        split_arguments)
+
+
+def _is_call(code, i):
+    """True when code[i] is an identifier directly followed by '('"""
+    return (code[i].kind == IDENT and i + 1 < len(code) and code[i + 1].text == '('
+            and (i == 0 or code[i - 1].text != '.'))
+
+
+class ShaderFacts(namedtuple('ShaderFacts', 'identifiers called defined_functions '
+                                             'defined_macros uniforms declared_floats')):
+    """What the whole-shader stages need to know about some shader code
+
+    Every field is a set of names found outside comments.  Facts are local
+    to the tokens they come from, so the facts of separate pieces of code
+    combine into the facts of the whole with ShaderFacts.union().
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def union(cls, facts):
+        fields = [set() for _ in cls._fields]
+        for item in facts:
+            for field, names in zip(fields, item):
+                field.update(names)
+        return cls(*map(frozenset, fields))
+
+
+def shader_facts(stream):
+    """ShaderFacts for a token stream, computed once per stream"""
+    return stream.derived('facts', _collect_facts)
+
+
+def _collect_facts(stream):
+    code = stream.code
+    called = set()
+    defined_functions = set()
+    defined_macros = set()
+    uniforms = set()
+    declared_floats = set()
+    for i, tok in enumerate(code):
+        text = tok.text
+        if _is_call(code, i):
+            called.add(text)
+            # A call-like name after a type, with a body, is a definition
+            if i and code[i - 1].kind == IDENT and code[i - 1].text != 'return':
+                close = matching_bracket(code, i + 1)
+                if close is not None and close + 1 < len(code) and code[close + 1].text == '{':
+                    defined_functions.add(text)
+        elif i + 1 < len(code):
+            if tok.kind == PREPROC and text.replace(' ', '') == '#define':
+                defined_macros.add(code[i + 1].text)
+            elif text == 'uniform' and i + 2 < len(code):
+                if code[i + 2].text == '{':
+                    # Members of a uniform block are uniforms too
+                    close = matching_bracket(code, i + 2) or len(code) - 1
+                    uniforms.update(code[j].text for j in range(i + 3, close)
+                                    if code[j].kind == IDENT
+                                    and code[j + 1].text in (';', '[', ','))
+                else:
+                    uniforms.add(code[i + 2].text)
+            elif text == 'float' and code[i + 1].kind == IDENT:
+                declared_floats.add(code[i + 1].text)
+    return ShaderFacts(stream.identifiers, frozenset(called), frozenset(defined_functions),
+                       frozenset(defined_macros), frozenset(uniforms),
+                       frozenset(declared_floats))
+
+
+def _text_facts(text):
+    return shader_facts(lex_glsl(text))
+
+
+def _needs_parens(code, first, stop):
+    """True when code[first:stop] holds an operator outside brackets"""
+    depth = 0
+    for i in range(first, stop):
+        text = code[i].text
+        if text in ('(', '['):
+            depth += 1
+        elif text in (')', ']'):
+            depth -= 1
+        elif depth == 0 and code[i].kind == PUNCT and text != '.':
+            return True
+    return False
+
+
+def _apply_edits(source, start, end, edits):
+    """Text of source[start:end] with sorted (start, end, text) edits applied"""
+    parts = []
+    pos = start
+    for edit_start, edit_end, replacement in edits:
+        parts.append(source[pos:edit_start])
+        parts.append(replacement)
+        pos = edit_end
+    parts.append(source[pos:end])
+    return ''.join(parts)
+
+
+# Calls nested deeper than this inside other rewritten calls are left as
+# they are.  Every level re-reads its arguments, so the bound is what keeps
+# a pathological pow(pow(pow(...))) linear, and real shaders never get near it.
+_MAX_CALL_NESTING = 32
+
+
+def _call_edits(stream, code, first, stop, names, rewrite, nesting=0):
+    """Edits for calls to any of names within code[first:stop]
+
+    rewrite(name, args) receives each argument as (text, needs_parens) with
+    nested calls already rewritten, and returns the replacement for the
+    whole call or None to leave it alone.
+    """
+    if nesting > _MAX_CALL_NESTING:
+        return []
+    edits = []
+    i = first
+    while i < stop:
+        if code[i].text in names and _is_call(code, i):
+            ranges, close = split_arguments(code, i + 1)
+            if close is None:
+                break
+            inner = []
+            args = []
+            for arg_first, arg_stop in ranges:
+                arg_edits = _call_edits(stream, code, arg_first, arg_stop, names, rewrite,
+                                        nesting + 1)
+                inner.extend(arg_edits)
+                if arg_first < arg_stop:
+                    text = _apply_edits(stream.source, code[arg_first].start,
+                                        code[arg_stop - 1].end, arg_edits)
+                else:
+                    text = ''
+                args.append((text, _needs_parens(code, arg_first, arg_stop)))
+            replacement = rewrite(code[i].text, args)
+            if replacement is None:
+                edits.extend(inner)
+            else:
+                edits.append((code[i].start, code[close].end, replacement))
+            i = close + 1
+        else:
+            i += 1
+    return edits
+
+
+def _rewrite_calls(shader_code, names, rewrite):
+    stream = lex_glsl(shader_code)
+    buffer = RewriteBuffer(stream)
+    buffer.extend(_call_edits(stream, stream.code, 0, len(stream.code), names, rewrite))
+    return buffer.apply_source()
+
+
+# Other spellings of GLSL built-ins that are renamed where they are called:
+# Shadertoy (WebGL2) names, and HLSL names common in ported shaders
+CALL_RENAMES = {
+    'texture': 'texture2D',
+    'textureLod': 'texture2DLod',
+    'frac': 'fract',
+    'lerp': 'mix',
+    'fmod': 'mod',
+    'atan2': 'atan',
+    'ddx': 'dFdx',
+    'ddy': 'dFdy',
+    'heaviside': 'step',
+    'smoothStep': 'smoothstep',
+    'rsqrt': 'inversesqrt',
+    'tex2D': 'texture2D',
+    'texCUBE': 'textureCube',
+}
+
+# HLSL type names, renamed wherever they appear
+IDENTIFIER_RENAMES = {
+    'float2': 'vec2',
+    'float3': 'vec3',
+    'float4': 'vec4',
+    'int2': 'ivec2',
+    'int3': 'ivec3',
+    'int4': 'ivec4',
+    'bool2': 'bvec2',
+    'bool3': 'bvec3',
+    'bool4': 'bvec4',
+    'float2x2': 'mat2',
+    'float3x3': 'mat3',
+    'float4x4': 'mat4',
+}
+
+
+class IdentifierRewriter:
+    """Applies a whole rename table in one pass over the token stream
+
+    Every identifier token is looked up once, so the cost of a conversion
+    does not grow with the number of aliases.  Aliases that rename to
+    another alias are resolved when the table is compiled.
+    """
+
+    def __init__(self, call_renames=(), identifier_renames=()):
+        self.call_renames = dict(call_renames)
+        self.identifier_renames = dict(identifier_renames)
+        self._compiled = None
+
+    def register(self, alias, replacement, calls_only=True):
+        """Rename alias to replacement, only where it is called by default"""
+        if not re.fullmatch(r'[A-Za-z_]\w*', alias):
+            raise ValueError(f'not an identifier: {alias!r}')
+        table = self.call_renames if calls_only else self.identifier_renames
+        table[alias] = replacement
+        self._compiled = None
+
+    def compile(self):
+        """Return (call table, identifier table) with alias chains resolved"""
+        if self._compiled is None:
+            merged = dict(self.call_renames)
+            merged.update(self.identifier_renames)
+
+            def resolve(name):
+                seen = {name}
+                while name in merged and merged[name] not in seen:
+                    name = merged[name]
+                    seen.add(name)
+                return name
+
+            self._compiled = (
+                {alias: resolve(alias) for alias in self.call_renames},
+                {alias: resolve(alias) for alias in self.identifier_renames},
+            )
+        return self._compiled
+
+    def rewrite(self, buffer):
+        """Record an edit on buffer for every alias in its stream"""
+        call_table, identifier_table = self.compile()
+        code = buffer.stream.code
+        for i, tok in enumerate(code):
+            if tok.kind != IDENT or (i and code[i - 1].text == '.'):
+                continue
+            replacement = identifier_table.get(tok.text)
+            if replacement is None:
+                replacement = call_table.get(tok.text)
+                if replacement is None or i + 1 == len(code) or code[i + 1].text != '(':
+                    continue
+            buffer.replace_token(tok, replacement)
+
+    def apply(self, shader_code):
+        buffer = RewriteBuffer(lex_glsl(shader_code))
+        self.rewrite(buffer)
+        return buffer.apply_source()
+
+
+identifier_rewriter = IdentifierRewriter(CALL_RENAMES, IDENTIFIER_RENAMES)
+
+
+def register_identifier_alias(alias, replacement, calls_only=True):
+    """Register a project specific alias with the default rewriter"""
+    identifier_rewriter.register(alias, replacement, calls_only)
+
+
+def _operand(arg):
+    text, needs_parens = arg
+    return f'({text})' if needs_parens else text
+
+
+# Operands longer than this are not written out more than once, since
+# expanding nested pow(pow(x, 2.0), 2.0) would double the code per level
+_MAX_REPEATED_OPERAND = 200
+
+
+def _repeated(arg, times):
+    """(x * x ...) with the operand written times times, or None if it is too long"""
+    if len(arg[0]) > _MAX_REPEATED_OPERAND:
+        return None
+    return '(' + ' * '.join([_operand(arg)] * times) + ')'
+
+
+def _prepend(shader_code, text):
+    buffer = RewriteBuffer(lex_glsl(shader_code))
+    buffer.insert(0, text)
+    return buffer.apply_source()
+
+
+# Both the 'in' and the bare form of the mainImage signature
+_MAINIMAGE_SIGNATURES = (
+    ('void', 'mainImage', '(', 'out', 'vec4', None, ',', 'in', 'vec2', None, ')', '{'),
+    ('void', 'mainImage', '(', 'out', 'vec4', None, ',', 'vec2', None, ')', '{'),
+)
+
+
+def _match_signature(code, first):
+    for signature in _MAINIMAGE_SIGNATURES:
+        if first + len(signature) > len(code):
+            continue
+        captures = []
+        for offset, expected in enumerate(signature):
+            tok = code[first + offset]
+            if expected is None:
+                if tok.kind != IDENT:
+                    break
+                captures.append(tok.text)
+            elif tok.text != expected:
+                break
+        else:
+            return captures, first + len(signature) - 1
+    return None, None
+
+
+def _skip_directives(source, code, i):
+    """Index of the first token at or after code[i] outside a directive line"""
+    while i < len(code) and code[i].kind == PREPROC:
+        line_end = directive_line_end(source, code[i].start)
+        while i < len(code) and code[i].start < line_end:
+            i += 1
+    return i
 
 
 def extract_mainimage_and_transform(shader_code):
     """Extract mainImage function and transform it to OpenGL main()"""
-    
-    # Try multiple patterns to handle different Shadertoy formats
-    patterns = [
-        # Standard format with 'in' keyword
-        re.compile(
-            r'void\s+mainImage\s*\(\s*out\s+vec4\s+(\w+)\s*,\s*in\s+vec2\s+(\w+)\s*\)\s*\{',
-            re.MULTILINE | re.DOTALL
-        ),
-        # Format without 'in' keyword (more common in minified code)
-        re.compile(
-            r'void\s+mainImage\s*\(\s*out\s+vec4\s+(\w+)\s*,\s*vec2\s+(\w+)\s*\)\s*\{',
-            re.MULTILINE | re.DOTALL
-        ),
-        # More flexible whitespace handling
-        re.compile(
-            r'void\s+mainImage\s*\(\s*out\s+vec4\s+(\w+)\s*,\s*(?:in\s+)?vec2\s+(\w+)\s*\)\s*\{',
-            re.MULTILINE | re.DOTALL
-        )
-    ]
-    
-    match = None
-    for pattern in patterns:
-        match = pattern.search(shader_code)
-        if match:
-            break
-    
-    if not match:
+
+    stream = lex_glsl(shader_code)
+    code = stream.code
+    source = stream.source
+
+    # Find the mainImage signature
+    start_index = brace_index = None
+    for i in range(1, len(code)):
+        if code[i].text == 'mainImage':
+            captures, brace_index = _match_signature(code, i - 1)
+            if captures:
+                out_var, coord_var = captures
+                start_index = i - 1
+                break
+
+    if start_index is None:
         return shader_code  # fallback
-    
-    out_var, coord_var = match.group(1), match.group(2)
-    start = match.end()  # Position right after the opening brace
-    
+
     # Find the matching closing brace
-    brace_count = 1  # We already have one opening brace
-    i = start
-    while i < len(shader_code) and brace_count > 0:
-        if shader_code[i] == '{':
-            brace_count += 1
-        elif shader_code[i] == '}':
-            brace_count -= 1
-        i += 1
-    
-    if brace_count != 0:
+    close_index = matching_bracket(code, brace_index)
+    if close_index is None:
         return shader_code  # fallback - unmatched braces
-    
-    end = i - 1  # Position of the closing brace
-    
-    # Extract the body (everything between the braces)
-    body = shader_code[start:end]
-    before = shader_code[:match.start()]
-    after = shader_code[i:]  # Everything after the closing brace
-    
-    # Build the new main() function
-    main_lines = []
-    main_lines.append('void main() {')
-    main_lines.append(f'    vec2 {coord_var} = gl_FragCoord.xy;')
-    main_lines.append(f'    vec4 {out_var} = vec4(0.0);')  # Initialize output variable
-    
-    # Process body lines and replace only the LAST assignment to output variable
-    body_lines = body.split('\n')
-    replaced = False
-    
-    # Go through lines in reverse to find the last assignment
-    for idx in range(len(body_lines) - 1, -1, -1):
-        line = body_lines[idx]
-        
-        # Check for assignment to output variable
-        assign_match = re.match(r'\s*' + re.escape(out_var) + r'\s*=\s*(.+);', line)
-        if assign_match and not replaced:
-            expr = assign_match.group(1)
-            # For the final assignment, set gl_FragColor
-            body_lines[idx] = f'    gl_FragColor = {expr};'
-            replaced = True
-        else:
-            # Add proper indentation to all lines
-            if line.strip():
-                body_lines[idx] = '    ' + line
-            else:
-                body_lines[idx] = line
-    
-    main_lines.extend(body_lines)
-    main_lines.append('}')
-    
-    # Compose the new shader code
-    new_code = before.rstrip() + '\n\n' + '\n'.join(main_lines) + '\n' + after.lstrip()
-    return new_code
+
+    start = code[brace_index].end  # Position right after the opening brace
+    end = code[close_index].start  # Position of the closing brace
+
+    # Find the start of the last statement in the body; if it assigns the
+    # output variable it becomes the gl_FragColor write
+    statement_start = close_index
+    for i in range(close_index - 2, brace_index - 1, -1):
+        if code[i].text in (';', '{', '}'):
+            statement_start = _skip_directives(source, code, i + 1)
+            break
+    final_assignment = None
+    if (statement_start + 1 < close_index and code[statement_start].text == out_var
+            and code[statement_start + 1].text == '='):
+        final_assignment = code[statement_start]
+
+    buffer = RewriteBuffer(stream)
+
+    # Replace the signature (and the whitespace before it) with main()
+    header = ['void main() {',
+              f'    vec2 {coord_var} = gl_FragCoord.xy;',
+              f'    vec4 {out_var} = vec4(0.0);',  # Initialize output variable
+              '']
+    first_token = stream.token_index_at(code[start_index].start)
+    header_start = code[start_index].start
+    if first_token > 0 and stream.tokens[first_token - 1].kind == WHITESPACE:
+        header_start = stream.tokens[first_token - 1].start
+    buffer.replace(header_start, start, '\n\n' + '\n'.join(header))
+
+    # Indent every non-blank body line
+    line_start = start
+    while line_start <= end:
+        line_end = source.find('\n', line_start, end)
+        if line_end < 0:
+            line_end = end
+        if source[line_start:line_end].strip():
+            buffer.insert(line_start, '    ')
+        line_start = line_end + 1
+
+    # The final assignment to the output variable sets gl_FragColor
+    closing = '\n}'
+    if final_assignment is not None:
+        buffer.replace_token(final_assignment, 'gl_FragColor')
+    else:
+        closing = f'\n    gl_FragColor = {out_var};\n}}'
+
+    # Close the function; whatever follows it is left as it was
+    buffer.replace(end, code[close_index].end, closing)
+
+    return buffer.apply_source()
 
 
 def apply_shadertoy_conventions(shader_code):
     """Apply Shadertoy to OpenGL conversion conventions"""
-    
-    # 1. Convert texture sampling functions
-    # texture(sampler, uv) -> texture2D(sampler, uv)
-    shader_code = re.sub(r'\btexture\s*\(', 'texture2D(', shader_code)
-    
-    # Handle texture with LOD bias
-    shader_code = re.sub(r'\btextureLod\s*\(', 'texture2DLod(', shader_code)
-    
+
+    # 1. Rename Shadertoy and HLSL spellings of built-in functions and types
+    # texture(sampler, uv) -> texture2D(sampler, uv), frac() -> fract(),
+    # lerp() -> mix(), atan2() -> atan(), ddx() -> dFdx(), float3 -> vec3, ...
+    shader_code = identifier_rewriter.apply(shader_code)
+
     # 2. Convert fragCoord normalization
     # Common pattern: uv = fragCoord/iResolution.xy
-    shader_code = re.sub(
-        r'(\w+)\s*=\s*(\w+)\s*/\s*iResolution\.xy',
-        r'\1 = \2 / iResolution.xy',
-        shader_code
-    )
-    
+    stream = lex_glsl(shader_code)
+    code = stream.code
+    buffer = RewriteBuffer(stream)
+    for i in range(len(code) - 6):
+        if (code[i + 4].text == 'iResolution' and code[i + 1].text == '='
+                and code[i + 3].text == '/' and code[i + 5].text == '.'
+                and code[i + 6].text == 'xy' and code[i].kind == IDENT
+                and code[i + 2].kind in (IDENT, NUMBER)):
+            buffer.replace(code[i].start, code[i + 6].end,
+                           f'{code[i].text} = {code[i + 2].text} / iResolution.xy')
+    shader_code = buffer.apply_source()
+
     # 3. Handle integer division for older GLSL versions
     # Convert int/int to float division where appropriate
-    shader_code = re.sub(r'(\d+)\.0\s*/\s*(\d+)\.0', r'\1.0 / \2.0', shader_code)
-    
+    stream = lex_glsl(shader_code)
+    code = stream.code
+    buffer = RewriteBuffer(stream)
+    for i in range(len(code) - 2):
+        if (code[i + 1].text == '/' and code[i].kind == NUMBER and code[i + 2].kind == NUMBER
+                and re.fullmatch(r'\d+\.0', code[i].text)
+                and re.match(r'\d+\.0', code[i + 2].text)):
+            buffer.replace(code[i].start, code[i + 2].end,
+                           f'{code[i].text} / {code[i + 2].text}')
+    shader_code = buffer.apply_source()
+
     # 4. Convert common Shadertoy function variations
-    # fract() is sometimes written as frac() in other systems
-    shader_code = re.sub(r'\bfrac\s*\(', 'fract(', shader_code)
-    
-    # lerp() -> mix()
-    shader_code = re.sub(r'\blerp\s*\(', 'mix(', shader_code)
-    
     # saturate() -> clamp(x, 0.0, 1.0)
-    shader_code = re.sub(r'\bsaturate\s*\(([^)]+)\)', r'clamp(\1, 0.0, 1.0)', shader_code)
-    
-    # 5. Handle common constants
-    # PI definitions
-    if 'PI' in shader_code and '#define PI' not in shader_code:
-        shader_code = '#define PI 3.14159265359\n' + shader_code
-    
-    # TAU definitions
-    if 'TAU' in shader_code and '#define TAU' not in shader_code:
-        shader_code = '#define TAU 6.28318530718\n' + shader_code
-    
-    # 6. Convert common Shadertoy patterns
+    shader_code = _rewrite_calls(
+        shader_code, ('saturate',),
+        lambda name, args: f'clamp({args[0][0]}, 0.0, 1.0)' if len(args) == 1 else None)
+
+    # 5. Convert common Shadertoy patterns
     # Convert pow(x, 2.0) to x*x for better performance
-    shader_code = re.sub(r'pow\s*\(([^,]+),\s*2\.0\)', r'(\1 * \1)', shader_code)
-    
-    # 7. Handle mod() function (same as GLSL but sometimes written differently)
-    shader_code = re.sub(r'\bfmod\s*\(', 'mod(', shader_code)
-    
-    # 8. Ensure scientific notation has explicit float suffix for compatibility
-    shader_code = re.sub(r'\b(\d+)e([+-]?\d+)\b', r'\1e\2', shader_code)
-    
-    # 9. Handle common GLSL compatibility issues
-    # atan(y, x) parameter order (GLSL uses atan(y, x), some systems use atan2(y, x))
-    shader_code = re.sub(r'\batan2\s*\(', 'atan(', shader_code)
-    
-    # 10. Handle ddx/ddy -> dFdx/dFdy conversion
-    shader_code = re.sub(r'\bddx\s*\(', 'dFdx(', shader_code)
-    shader_code = re.sub(r'\bddy\s*\(', 'dFdy(', shader_code)
-    
-    # 11. Handle step function variations
-    # Some systems use heaviside, GLSL uses step
-    shader_code = re.sub(r'\bheaviside\s*\(([^,]+),\s*([^)]+)\)', r'step(\1, \2)', shader_code)
-    
-    # 12. Handle matrix multiplication syntax
+    shader_code = _rewrite_calls(
+        shader_code, ('pow',),
+        lambda name, args: (_repeated(args[0], 2)
+                            if len(args) == 2 and args[1][0] == '2.0' else None))
+
+    # 6. Handle matrix multiplication syntax
     # Convert mul(matrix, vector) to matrix * vector
-    shader_code = re.sub(r'\bmul\s*\(([^,]+),\s*([^)]+)\)', r'(\1 * \2)', shader_code)
-    
-    # 13. Handle smoothstep variations
-    shader_code = re.sub(r'\bsmoothStep\s*\(', 'smoothstep(', shader_code)
-    
+    shader_code = _rewrite_calls(
+        shader_code, ('mul',),
+        lambda name, args: (f'({_operand(args[0])} * {_operand(args[1])})'
+                            if len(args) == 2 else None))
+
     return shader_code
 
 
 def prepend_uniforms_and_precision(shader_code):
     """Add precision qualifiers and uniforms that are referenced in the code"""
-    
+    return _prepend(shader_code, _uniforms_header(_text_facts(shader_code)))
+
+
+# Standard Shadertoy uniforms
+_STANDARD_UNIFORMS = {
+    'iTime': 'uniform float iTime;',
+    'iResolution': 'uniform vec2 iResolution;',
+    'iMouse': 'uniform vec4 iMouse;',
+    'iFrame': 'uniform int iFrame;',
+    'iDate': 'uniform vec4 iDate;',
+    'iTimeDelta': 'uniform float iTimeDelta;',
+    'iFrameRate': 'uniform float iFrameRate;',
+    'iChannelTime': 'uniform float iChannelTime[4];',
+    'iChannelResolution': 'uniform vec3 iChannelResolution[4];',
+    'iSampleRate': 'uniform float iSampleRate;'
+}
+
+# Additional common uniforms found in some Shadertoy shaders
+_ADDITIONAL_UNIFORMS = {
+    'iGlobalTime': 'uniform float iGlobalTime;',  # Legacy name for iTime
+    'iChannelOffset': 'uniform vec2 iChannelOffset[4];',
+    'iKeyboard': 'uniform sampler2D iKeyboard;',
+    'iSound': 'uniform sampler2D iSound;',
+    'iFft': 'uniform sampler2D iFft;',
+    'iMusic': 'uniform sampler2D iMusic;',
+    'iMusicData': 'uniform sampler2D iMusicData;',
+}
+
+
+def _uniform_types():
+    """name -> type of every uniform the header may declare, arrays as 'float[]'"""
+    types = {}
+    for declaration in list(_STANDARD_UNIFORMS.values()) + list(_ADDITIONAL_UNIFORMS.values()):
+        _, type_name, name = declaration.rstrip(';').split()
+        if name.endswith(']'):
+            name = name[:name.index('[')]
+            type_name += '[]'
+        types[name] = type_name
+    for i in range(4):
+        types[f'iChannel{i}'] = 'sampler2D'
+        types[f'iChannelCube{i}'] = 'samplerCube'
+        types[f'iChannel3D{i}'] = 'sampler3D'
+    return types
+
+
+def _uniform_member(declaration):
+    """(type, name, count) of a 'uniform type name;' declaration"""
+    _, type_name, name = declaration.rstrip(';').split()
+    count = None
+    if name.endswith(']'):
+        name, count = name[:-1].split('[')
+        count = int(count)
+    return type_name, name, count
+
+
+def _block_members():
+    """(type, name, count) of every uniform a uniform block can hold"""
+    members = []
+    for declaration in list(_STANDARD_UNIFORMS.values()) + list(_ADDITIONAL_UNIFORMS.values()):
+        member = _uniform_member(declaration)
+        if not member[0].startswith('sampler'):
+            members.append(member)
+    return members
+
+
+_BLOCK_MEMBERS = _block_members()
+
+
+def _uniform_block_header(facts):
+    # The used uniforms that are not samplers, in one std140 block; the
+    # uniforms header then leaves them out
+    used = facts.identifiers - facts.uniforms
+    members = [member for member in _BLOCK_MEMBERS if member[1] in used]
+    if not members:
+        return ''
+    layout, _ = std140_layout(packed_order(members))
+    return block_declaration(layout, BLOCK_NAME) + '\n'
+
+
+def _version_header(facts):
+    return BLOCK_VERSION + '\n'
+
+
+def _uniforms_header(facts):
+    # Uniforms the shader already declares itself
+    used = facts.identifiers - facts.uniforms
+
     # Precision qualifiers for fragment shaders
     precision_lines = [
         '#ifdef GL_ES',
@@ -176,164 +566,126 @@ def prepend_uniforms_and_precision(shader_code):
         '#endif',
         ''
     ]
-    
-    # Standard Shadertoy uniforms
-    uniform_defs = {
-        'iTime': 'uniform float iTime;',
-        'iResolution': 'uniform vec2 iResolution;',
-        'iMouse': 'uniform vec4 iMouse;',
-        'iFrame': 'uniform int iFrame;',
-        'iDate': 'uniform vec4 iDate;',
-        'iTimeDelta': 'uniform float iTimeDelta;',
-        'iFrameRate': 'uniform float iFrameRate;',
-        'iChannelTime': 'uniform float iChannelTime[4];',
-        'iChannelResolution': 'uniform vec3 iChannelResolution[4];',
-        'iSampleRate': 'uniform float iSampleRate;'
-    }
-    
+
+    uniforms = _detected_uniforms(used)
+
+    # Add common #define statements if they're referenced but not defined
+    defines = []
+    for name in ('HW_PERFORMANCE', 'CHEAP_NORMALS', 'MOUSE_INVERT'):
+        if name in used and name not in facts.defined_macros:
+            defines.append(f'#define {name} 1')
+
+    # Combine precision, defines, uniforms, and shader code
+    result_lines = precision_lines + defines
+    if defines:
+        result_lines.append('')
+
+    result_lines.extend(uniforms)
+    if uniforms:
+        result_lines.append('')  # Add blank line after uniforms
+
+    return '\n'.join(result_lines)
+
+
+def _detected_uniforms(used):
+    """Declarations of the Shadertoy uniforms among the used names"""
     # Check for texture channels (iChannel0-3)
     channel_uniforms = []
     for i in range(4):
-        if f'iChannel{i}' in shader_code:
+        if f'iChannel{i}' in used:
             channel_uniforms.append(f'uniform sampler2D iChannel{i};')
-    
+
     # Check for cubemap channels (less common but exists)
     cubemap_uniforms = []
     for i in range(4):
-        if f'iChannelCube{i}' in shader_code:
+        if f'iChannelCube{i}' in used:
             cubemap_uniforms.append(f'uniform samplerCube iChannelCube{i};')
-    
+
     # Check for 3D texture channels (rare but exists)
     texture3d_uniforms = []
     for i in range(4):
-        if f'iChannel3D{i}' in shader_code:
+        if f'iChannel3D{i}' in used:
             texture3d_uniforms.append(f'uniform sampler3D iChannel3D{i};')
-    
-    # Additional common uniforms found in some Shadertoy shaders
-    additional_uniforms = {
-        'iGlobalTime': 'uniform float iGlobalTime;',  # Legacy name for iTime
-        'iChannelOffset': 'uniform vec2 iChannelOffset[4];',
-        'iKeyboard': 'uniform sampler2D iKeyboard;',
-        'iSound': 'uniform sampler2D iSound;',
-        'iFft': 'uniform sampler2D iFft;',
-        'iMusic': 'uniform sampler2D iMusic;',
-        'iMusicData': 'uniform sampler2D iMusicData;',
-    }
-    
+
     # Only add uniforms that are actually used
-    uniforms = [u for key, u in uniform_defs.items() if key in shader_code]
+    uniforms = [u for key, u in _STANDARD_UNIFORMS.items() if key in used]
     uniforms.extend(channel_uniforms)
     uniforms.extend(cubemap_uniforms)
     uniforms.extend(texture3d_uniforms)
-    uniforms.extend([u for key, u in additional_uniforms.items() if key in shader_code])
-    
-    # Add common #define statements if they're referenced
-    defines = []
-    if 'HW_PERFORMANCE' in shader_code:
-        defines.append('#define HW_PERFORMANCE 1')
-    if 'CHEAP_NORMALS' in shader_code:
-        defines.append('#define CHEAP_NORMALS 1')
-    if 'MOUSE_INVERT' in shader_code:
-        defines.append('#define MOUSE_INVERT 1')
-    
-    # Combine precision, defines, uniforms, and shader code
-    result_lines = precision_lines + defines
-    if defines:
-        result_lines.append('')
-    
-    result_lines.extend(uniforms)
-    if uniforms:
-        result_lines.append('')  # Add blank line after uniforms
-    
-    return '\n'.join(result_lines) + shader_code
+    uniforms.extend([u for key, u in _ADDITIONAL_UNIFORMS.items() if key in used])
+    return uniforms
+
+
+def detected_uniforms(shader_code):
+    """(type, name, count) of each Shadertoy uniform shader_code uses, as
+    prepend_uniforms_and_precision() detects them; count is None unless the
+    uniform is an array
+
+    Works on converted code too, where the uniforms are declared already.
+    """
+    return [_uniform_member(declaration)
+            for declaration in _detected_uniforms(_text_facts(shader_code).identifiers)]
+
+
+def _needs_initialization(index, decl):
+    """Whether decl may be read before it is definitely assigned
+
+    Increments, compound assignments and loop conditions always need a
+    starting value.  A plain read needs one unless a plain assignment in
+    the declaring scope itself (not in a branch or loop) finished first.
+    """
+    if decl.name in index.macro_identifiers:
+        # Macro bodies are not analysed; initializing is always safe
+        return True
+    assigned_at = None
+    for use in index.uses_of(decl):
+        if use.kind in (INCREMENT, COMPOUND_ASSIGN, LOOP_CONDITION):
+            return True
+        if use.kind == ASSIGN:
+            if assigned_at is None and use.scope is decl.scope:
+                assigned_at = use.end
+        elif assigned_at is None or use.index < assigned_at:
+            return True
+    return False
 
 
-def fix_variable_initialization(shader_code):
+def _initializable(decl):
+    """Whether decl is a plain float variable declared without a value"""
+    return (decl.type == 'float' and decl.role == VARIABLE and not decl.qualifiers
+            and not decl.initialized and not decl.array)
+
+
+# Uses of a piece of code's declarations from code outside it: globals read
+# elsewhere, and float names that macros elsewhere mention.  constants are
+# the (name, (value, is_float)) of #define and const names defined
+# elsewhere that the code mentions, for the loop passes.
+ExternalUses = namedtuple('ExternalUses', 'reads macros constants')
+NO_EXTERNAL_USES = ExternalUses(frozenset(), frozenset(), frozenset())
+
+
+def fix_variable_initialization(shader_code, external=NO_EXTERNAL_USES):
     """Fix common variable initialization issues in Shadertoy code"""
-    
-    # Look for uninitialized float variables that are used in loops or operations
-    # Handle multi-line declarations with comments
-    
-    # Pattern to match float declarations that span multiple lines
-    float_decl_pattern = r'float\s+([^;]+);'
-    matches = list(re.finditer(float_decl_pattern, shader_code, re.MULTILINE | re.DOTALL))
-    
-    # Process matches in reverse order to avoid index issues when replacing
-    for match in reversed(matches):
-        full_match = match.group(0)
-        var_list = match.group(1)
-        
-        # Remove comments and newlines from the variable list
-        var_list_clean = re.sub(r'//[^\n]*', '', var_list)  # Remove comments
-        var_list_clean = re.sub(r'\s+', ' ', var_list_clean)  # Normalize whitespace
-        
-        # Split by comma to get individual variable names
-        vars_in_decl = [var.strip() for var in var_list_clean.split(',') if var.strip()]
-        
-        # Check if any of these variables need initialization
-        needs_initialization = {}
-        for var in vars_in_decl:
-            var_name = var.strip()
-            
-            # Check various patterns that indicate a variable needs initialization
-            patterns_to_check = [
-                # Pre/post increment/decrement
-                rf'\b{var_name}\+\+|\+\+{var_name}\b',
-                rf'\b{var_name}--|\--{var_name}\b',
-                # Compound assignment operators
-                rf'\b{var_name}\s*[+\-*/]\s*=',
-                # Used in arithmetic operations (likely needs initialization)
-                rf'\b{var_name}\s*[+\-*/]\s*[^=]',
-                # Used in comparisons (might need initialization)
-                rf'\b{var_name}\s*[<>]=?',
-                # Used in for loop conditions
-                rf'for\s*\([^;]*{var_name}[^;]*;[^;]*{var_name}[^;]*;',
-                # Used in while conditions
-                rf'while\s*\([^)]*{var_name}[^)]*\)',
-            ]
-            
-            for pattern in patterns_to_check:
-                if re.search(pattern, shader_code):
-                    # Special handling for loop iterator variables
-                    if re.search(rf'for\s*\([^;]*;\s*{var_name}\+\+\s*<', shader_code):
-                        # This is likely a loop iterator that should start from 0
-                        needs_initialization[var_name] = '0.0'
-                    elif re.search(rf'{var_name}\s*[+\-*/]\s*=', shader_code):
-                        # This is used in compound assignment, needs initialization
-                        needs_initialization[var_name] = '0.0'
-                    elif re.search(rf'\b{var_name}\+\+|\+\+{var_name}', shader_code):
-                        # This is incremented, likely needs to start from 0
-                        needs_initialization[var_name] = '0.0'
-                    else:
-                        # Default initialization
-                        needs_initialization[var_name] = '0.0'
-                    break
-        
-        # If any variables need initialization, reconstruct the declaration
-        if needs_initialization:
-            new_vars = []
-            for v in vars_in_decl:
-                v = v.strip()
-                if v in needs_initialization:
-                    new_vars.append(f'{v} = {needs_initialization[v]}')
-                else:
-                    new_vars.append(v)
-            
-            new_decl = f'float {", ".join(new_vars)};'
-            shader_code = shader_code.replace(full_match, new_decl)
-    
-    return shader_code
 
+    # Look for uninitialized float variables that are used in loops or
+    # operations, resolving every use to its own declaration so a local of
+    # the same name in another function does not count
+    stream = lex_glsl(shader_code)
+    index = build_usage_index(stream)
 
-def handle_common_shadertoy_functions(shader_code):
-    """Handle common Shadertoy-specific function patterns"""
-    
-    # Add common utility functions that are often used in Shadertoy
-    utility_functions = []
-    
-    # Add hash functions if referenced
-    if re.search(r'\bhash\s*\(', shader_code) and 'float hash(' not in shader_code:
-        utility_functions.append('''
+    buffer = RewriteBuffer(stream)
+    for decl in index.declarations:
+        if _initializable(decl) and (
+                decl.name in external.macros
+                or (decl.scope.kind == 'global' and decl.name in external.reads)
+                or _needs_initialization(index, decl)):
+            buffer.insert(decl.token.end, ' = 0.0')
+
+    return buffer.apply_source()
+
+
+# Utility functions commonly used in Shadertoy: (name, return type, source, requires)
+_UTILITY_FUNCTIONS = (
+    ('hash', '''
 // Hash function commonly used in Shadertoy
 float hash(vec2 p) {
     return fract(sin(dot(p, vec2(127.1, 311.7))) * 43758.5453123);
@@ -341,11 +693,8 @@ float hash(vec2 p) {
 
 float hash(float n) {
     return fract(sin(n) * 43758.5453123);
-}''')
-    
-    # Add noise functions if referenced
-    if re.search(r'\bnoise\s*\(', shader_code) and 'float noise(' not in shader_code:
-        utility_functions.append('''
+}''', ()),
+    ('noise', '''
 // Simple noise function
 float noise(vec2 p) {
     vec2 i = floor(p);
@@ -353,162 +702,735 @@ float noise(vec2 p) {
     vec2 u = f * f * (3.0 - 2.0 * f);
     return mix(mix(hash(i + vec2(0.0, 0.0)), hash(i + vec2(1.0, 0.0)), u.x),
                mix(hash(i + vec2(0.0, 1.0)), hash(i + vec2(1.0, 1.0)), u.x), u.y);
-}''')
-    
-    # Add rotation matrix function if referenced
-    if re.search(r'\brot\s*\(', shader_code) and 'mat2 rot(' not in shader_code:
-        utility_functions.append('''
+}''', ('hash',)),
+    ('rot', '''
 // Rotation matrix
 mat2 rot(float a) {
     float c = cos(a), s = sin(a);
     return mat2(c, -s, s, c);
-}''')
-    
-    # Add common SDF functions if referenced
-    if re.search(r'\bsdfBox\s*\(', shader_code) and 'float sdfBox(' not in shader_code:
-        utility_functions.append('''
+}''', ()),
+    ('sdfBox', '''
 // Box SDF
 float sdfBox(vec3 p, vec3 b) {
     vec3 q = abs(p) - b;
     return length(max(q, 0.0)) + min(max(q.x, max(q.y, q.z)), 0.0);
-}''')
-    
-    if re.search(r'\bsdfSphere\s*\(', shader_code) and 'float sdfSphere(' not in shader_code:
-        utility_functions.append('''
+}''', ()),
+    ('sdfSphere', '''
 // Sphere SDF
 float sdfSphere(vec3 p, float r) {
     return length(p) - r;
-}''')
-    
-    # Add palette function if referenced
-    if re.search(r'\bpalette\s*\(', shader_code) and 'vec3 palette(' not in shader_code:
-        utility_functions.append('''
+}''', ()),
+    ('palette', '''
 // Palette function commonly used in Shadertoy
 vec3 palette(float t, vec3 a, vec3 b, vec3 c, vec3 d) {
     return a + b * cos(6.28318 * (c * t + d));
-}''')
-    
+}''', ()),
+)
+
+
+def handle_common_shadertoy_functions(shader_code):
+    """Handle common Shadertoy-specific function patterns"""
+
     # Prepend utility functions to shader code
-    if utility_functions:
-        shader_code = '\n'.join(utility_functions) + '\n' + shader_code
-    
-    return shader_code
+    header = _utility_functions_header(_text_facts(shader_code))
+    return _prepend(shader_code, header) if header else shader_code
+
+
+def _utility_functions_header(facts):
+    # Helpers that are called but not defined, plus the helpers they call
+    wanted = {name for name, _, _ in _UTILITY_FUNCTIONS if name in facts.called}
+    for name, _, requires in reversed(_UTILITY_FUNCTIONS):
+        if name in wanted:
+            wanted.update(requires)
+
+    # Add common utility functions that are often used in Shadertoy
+    utility_functions = [source for name, source, _ in _UTILITY_FUNCTIONS
+                         if name in wanted and name not in facts.defined_functions]
+    return '\n'.join(utility_functions) + '\n' if utility_functions else ''
+
+
+def add_shadertoy_constants(shader_code):
+    """Define PI and TAU when the shader uses them without defining them"""
+    header = _constants_header(_text_facts(shader_code))
+    return _prepend(shader_code, header) if header else shader_code
+
+
+def _constants_header(facts):
+    # Handle common constants, unless the shader defines them itself
+    defined = facts.defined_macros | facts.declared_floats
+    constants = ''
+
+    # TAU definitions
+    if 'TAU' in facts.identifiers and 'TAU' not in defined:
+        constants += '#define TAU 6.28318530718\n'
+
+    # PI definitions
+    if 'PI' in facts.identifiers and 'PI' not in defined:
+        constants += '#define PI 3.14159265359\n'
+
+    return constants
 
 
 def fix_loop_semantics(shader_code):
     """Fix loop semantics that might differ between Shadertoy and OpenGL"""
-    
+
     # Handle for loops with pre-increment in condition
     # Pattern: for(init; var++<value; ) where var is used as iterator
-    loop_pattern = r'for\s*\(([^;]*);([^;]*);([^)]*)\)'
-    matches = list(re.finditer(loop_pattern, shader_code))
-    
-    for match in reversed(matches):
-        init_part = match.group(1).strip()
-        condition_part = match.group(2).strip()
-        increment_part = match.group(3).strip()
-        
+    stream = lex_glsl(shader_code)
+    code = stream.code
+
+    buffer = RewriteBuffer(stream)
+    for i, tok in enumerate(code):
+        if tok.text != 'for' or i + 1 >= len(code) or code[i + 1].text != '(':
+            continue
+        # Split the loop header on its two top-level semicolons
+        parts, close = split_arguments(code, i + 1, ';')
+        if parts is None or len(parts) != 3:
+            continue
+        (init_first, init_stop), (cond_first, cond_stop), (inc_first, inc_stop) = parts
+
         # Check for patterns like "i++<20" in condition
-        pre_increment_match = re.match(r'(\w+)\+\+\s*<\s*(.+)', condition_part)
-        if pre_increment_match:
-            var_name = pre_increment_match.group(1)
-            limit = pre_increment_match.group(2)
-            
-            # Reconstruct the loop with proper semantics
+        if (cond_stop - cond_first >= 4 and code[cond_first].kind == IDENT
+                and code[cond_first + 1].text == '++' and code[cond_first + 2].text == '<'):
+            var_name = code[cond_first].text
+            limit = source_span(stream, code, cond_first + 3, cond_stop)
+            init_part = source_span(stream, code, init_first, init_stop)
+            increment_part = source_span(stream, code, inc_first, inc_stop)
+
+            # Reconstruct the loop with proper semantics, keeping any
+            # increment the loop already had
             new_condition = f'{var_name} < {limit}'
             new_increment = f'{var_name}++'
-            
+            if increment_part:
+                new_increment += f', {increment_part}'
+
             new_loop = f'for({init_part}; {new_condition}; {new_increment})'
-            shader_code = shader_code.replace(match.group(0), new_loop)
-    
-    return shader_code
+            buffer.replace(tok.start, code[close].end, new_loop)
+
+    return buffer.apply_source()
+
+
+_UNIFORM_TYPES = _uniform_types()
 
 
 def optimize_performance(shader_code):
-    """Apply performance optimizations common in OpenGL"""
-    
-    # Replace expensive operations with cheaper alternatives
-    
-    # Replace pow(x, 2.0) with x*x (already done in apply_shadertoy_conventions)
-    # Replace pow(x, 3.0) with x*x*x
-    shader_code = re.sub(r'pow\s*\(([^,]+),\s*3\.0\)', r'(\1 * \1 * \1)', shader_code)
-    
-    # Replace pow(x, 0.5) with sqrt(x)
-    shader_code = re.sub(r'pow\s*\(([^,]+),\s*0\.5\)', r'sqrt(\1)', shader_code)
-    
-    # Replace pow(x, -1.0) with 1.0/x
-    shader_code = re.sub(r'pow\s*\(([^,]+),\s*-1\.0\)', r'(1.0 / \1)', shader_code)
-    
+    """Apply performance optimizations common in OpenGL
+
+    Function bodies are parsed into expression trees (see glsl_ast), where
+    constants are folded, pow() with small integer exponents becomes
+    multiplication, division by a constant becomes multiplication by its
+    reciprocal, mix(a, b, 0.5) becomes (a + b) * 0.5, and pure expressions
+    a block computes repeatedly, such as texture fetches of the same
+    coordinates, are computed once.
+    """
+
     # Replace normalize(vec) when length is known to be 1
     # This is complex to detect automatically, so we'll leave it as is
-    
-    # Replace mix(a, b, 0.5) with (a + b) * 0.5
-    shader_code = re.sub(r'mix\s*\(([^,]+),\s*([^,]+),\s*0\.5\)', r'((\1 + \2) * 0.5)', shader_code)
-    
-    return shader_code
+
+    return optimize_expressions(shader_code, _UNIFORM_TYPES)
 
 
 def add_compatibility_extensions(shader_code):
     """Add OpenGL extensions that might be needed"""
-    
+
+    # Add extensions at the beginning if any are needed
+    header = _extensions_header(_text_facts(shader_code))
+    return _prepend(shader_code, header) if header else shader_code
+
+
+def _extensions_header(facts):
+    called = facts.called
     extensions = []
-    
+
     # Check if derivative functions are used
-    if re.search(r'\b(dFdx|dFdy|fwidth)\s*\(', shader_code):
+    if called & {'dFdx', 'dFdy', 'fwidth'}:
         extensions.append('#extension GL_OES_standard_derivatives : enable')
-    
+
     # Check if texture array functions are used
-    if re.search(r'\btexture2DArray\s*\(', shader_code):
+    if 'texture2DArray' in called:
         extensions.append('#extension GL_EXT_texture_array : enable')
-    
+
     # Check if texture LOD functions are used
-    if re.search(r'\btexture2DLod\s*\(', shader_code):
+    if 'texture2DLod' in called:
         extensions.append('#extension GL_EXT_shader_texture_lod : enable')
-    
-    # Add extensions at the beginning if any are needed
-    if extensions:
-        shader_code = '\n'.join(extensions) + '\n\n' + shader_code
-    
-    return shader_code
 
+    return '\n'.join(extensions) + '\n\n' if extensions else ''
 
-def convert_shadertoy_to_opengl(shader_code):
-    """Main conversion function with improved processing"""
-    if not shader_code.strip():
+
+# Top-level structure: comments and directive lines are skipped whole, so
+# braces and semicolons inside them do not count
+_UNIT_SCAN_RE = re.compile(r'//[^\n]*|/\*.*?(?:\*/|\Z)|^[ \t]*#(?:\\\r?\n|[^\n])*|[{};)]',
+                           re.DOTALL | re.MULTILINE)
+
+
+def split_top_level_units(source):
+    """Split a shader into (start, end) ranges of its top-level units
+
+    A unit is a function definition, a global declaration or struct up to
+    its semicolon, or a directive line.  Comments and whitespace before a
+    unit belong to it, and the ranges cover the whole source.
+    """
+    units = []
+    start = 0
+    depth = 0
+    function_body = False
+    previous = ''
+    for m in _UNIT_SCAN_RE.finditer(source):
+        text = m.group()
+        if text.startswith(('//', '/*')):
+            continue
+        if text.lstrip().startswith('#'):
+            if depth == 0:
+                units.append((start, m.end()))
+                start = m.end()
+            continue
+        if text == '{':
+            if depth == 0:
+                function_body = previous == ')'
+            depth += 1
+        elif text == '}':
+            depth = max(depth - 1, 0)
+            if depth == 0 and function_body:
+                units.append((start, m.end()))
+                start = m.end()
+        elif text == ';' and depth == 0:
+            units.append((start, m.end()))
+            start = m.end()
+        previous = text
+    if start < len(source) or not units:
+        units.append((start, len(source)))
+    return units
+
+
+def _live_units(streams):
+    """Which of the units in streams main() can reach, or None when unknown
+
+    Starting from main() and everything that has to stay anyway, a unit is
+    live when a live unit mentions a name it defines.  Names are matched
+    by text alone, so overloads and shadowing only ever keep more.
+    """
+    symbols = [unit_symbols(stream) for stream in streams]
+    if (any(unit.pastes for unit in symbols)
+            or not any('main' in unit.defines for unit in symbols)):
+        return None
+    defined_by = {}
+    for i, unit in enumerate(symbols):
+        for name in unit.defines:
+            defined_by.setdefault(name, []).append(i)
+    live = [unit.root for unit in symbols]
+    pending = [i for i, unit in enumerate(symbols) if unit.root]
+    while pending:
+        for name in streams[pending.pop()].identifiers:
+            for i in defined_by.get(name, ()):
+                if not live[i]:
+                    live[i] = True
+                    pending.append(i)
+    return live
+
+
+def remove_unused_code(shader_code):
+    """Drop the functions, globals, uniforms and macros main() never uses"""
+    units = [shader_code[start:end] for start, end in split_top_level_units(shader_code)]
+    live = _live_units([lex_glsl(unit) for unit in units])
+    if live is None:
         return shader_code
-    
-    # Step 1: Add compatibility extensions
-    code = add_compatibility_extensions(shader_code)
-    
-    # Step 2: Fix variable initialization issues
-    code = fix_variable_initialization(code)
-    
-    # Step 3: Fix loop semantics
-    code = fix_loop_semantics(code)
-    
-    # Step 4: Add common utility functions
-    code = handle_common_shadertoy_functions(code)
-    
+    return ''.join(unit for unit, keep in zip(units, live) if keep)
+
+
+# Per-unit facts the other units' conversion depends on
+UnitFacts = namedtuple('UnitFacts', 'global_floats float_names external_reads macro_names '
+                                    'identifiers defines_constants')
+
+
+def _unit_facts(unit_code):
+    stream = lex_glsl(unit_code)
+    index = build_usage_index(stream)
+    floats = [decl for decl in index.declarations if _initializable(decl)]
+    return UnitFacts(
+        frozenset(decl.name for decl in floats if decl.scope.kind == 'global'),
+        frozenset(decl.name for decl in floats),
+        frozenset(use.name for uses in index.uses.values() for use in uses
+                  if use.declaration is None and use.kind != ASSIGN),
+        frozenset(index.macro_identifiers),
+        frozenset(stream.identifiers),
+        any(tok.text == 'const' or (tok.kind == PREPROC and tok.text[1:].strip() == 'define')
+            for tok in stream.code))
+
+
+class StageStats:
+    """Totals for one stage over a conversion"""
+
+    __slots__ = ('calls', 'seconds', 'bytes_in', 'bytes_out', 'rewrites', 'skipped')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.rewrites = 0
+        self.skipped = 0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class ConversionProfile:
+    """Per-stage wall time, sizes and rewrite counts of a conversion
+
+    Pass one to convert_shadertoy_to_opengl() or IncrementalConverter.convert()
+    to fill it in; stages that run once per unit accumulate over the units.
+    Without a profile nothing is measured.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.seconds = 0.0
+        self.units_converted = 0
+        self.units_reused = 0
+
+    def _stats(self, name):
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats()
+        return stats
+
+    def record(self, name, seconds, bytes_in, bytes_out, rewrites):
+        stats = self._stats(name)
+        stats.calls += 1
+        stats.seconds += seconds
+        stats.bytes_in += bytes_in
+        stats.bytes_out += bytes_out
+        stats.rewrites += rewrites
+
+    def record_skip(self, name):
+        self._stats(name).skipped += 1
+
+    def slowest(self, count=3):
+        return sorted(self.stages.items(), key=lambda item: -item[1].seconds)[:count]
+
+    def summary(self):
+        """One line for a status bar"""
+        units = self.units_converted + self.units_reused
+        line = (f'{self.seconds * 1000:.1f} ms, '
+                f'{self.units_converted} of {units} units converted')
+        slowest = ', '.join(f'{name} {stats.seconds * 1000:.1f} ms'
+                            for name, stats in self.slowest() if stats.calls)
+        return f'{line}; slowest: {slowest}' if slowest else line
+
+    def as_dict(self):
+        return {
+            'seconds': self.seconds,
+            'units_converted': self.units_converted,
+            'units_reused': self.units_reused,
+            'stages': {name: stats.as_dict() for name, stats in self.stages.items()},
+        }
+
+
+def _run_stage(profile, name, stage, code, *args):
+    if profile is None:
+        return stage(code, *args)
+    rewrites = edits_applied()
+    started = time.perf_counter()
+    result = stage(code, *args)
+    profile.record(name, time.perf_counter() - started, len(code), len(result),
+                   edits_applied() - rewrites)
+    return result
+
+
+class ConversionPass(namedtuple('ConversionPass', 'name run option requires skip_unchanged')):
+    """One step of the conversion pipeline
+
+    option names the conversion option that enables the pass, or is None
+    for passes that always run.  requires lists passes that must run
+    before this one; with skip_unchanged the pass only runs when one of
+    them changed something.  A disabled requirement never changes anything.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, name, run, option=None, requires=(), skip_unchanged=False):
+        return super().__new__(cls, name, run, option, tuple(requires), skip_unchanged)
+
+
+# Conversion options and their defaults
+DEFAULT_OPTIONS = {
+    'fix_loops': True,
+    'utility_functions': True,
+    'optimize': True,
+    'remove_unused': True,
+    'uniform_block': False,
+    'glsl_es': False,
+    'unroll_loops': False,
+    'bound_loops': False,
+    'precision_qualifiers': False,
+}
+
+# What each option does, as shown next to its checkbox
+OPTION_LABELS = {
+    'fix_loops': 'Auto-fix loop semantics',
+    'utility_functions': 'Add utility functions',
+    'optimize': 'Apply optimizations',
+    'remove_unused': 'Remove unused code',
+    'uniform_block': 'Pack uniforms into a std140 block',
+    'glsl_es': 'GLSL ES 3.00 for uniform blocks (WebGL2)',
+    'unroll_loops': 'Unroll small loops',
+    'bound_loops': 'Constant loop bounds (GLES2)',
+    'precision_qualifiers': 'Per-variable precision',
+}
+
+# Options whose passes need the constants of the whole shader
+_CONSTANT_OPTIONS = ('unroll_loops', 'bound_loops')
+
+# Passes that rewrite one top-level unit: run(unit code, ExternalUses) -> code
+UNIT_PASSES = (
+    # Step 1: Fix variable initialization issues
+    ConversionPass('fix_variable_initialization', fix_variable_initialization),
+    # Step 2: Fix loop semantics
+    ConversionPass('fix_loop_semantics', lambda code, external: fix_loop_semantics(code),
+                   'fix_loops', ('fix_variable_initialization',)),
+    # Step 3: Unroll small loops with a constant trip count
+    ConversionPass('unroll_loops',
+                   lambda code, external: unroll_loops(code, dict(external.constants)),
+                   'unroll_loops', ('fix_loop_semantics',)),
+    # Step 4: Give the remaining loops constant bounds, as GLSL ES 1.0 needs
+    ConversionPass('bound_loops',
+                   lambda code, external: bound_loops(code, dict(external.constants)),
+                   'bound_loops', ('unroll_loops',)),
     # Step 5: Transform mainImage to main
-    code = extract_mainimage_and_transform(code)
-    
+    ConversionPass('extract_mainimage_and_transform',
+                   lambda code, external: extract_mainimage_and_transform(code)),
     # Step 6: Apply Shadertoy conventions
-    code = apply_shadertoy_conventions(code)
-    
+    ConversionPass('apply_shadertoy_conventions',
+                   lambda code, external: apply_shadertoy_conventions(code)),
     # Step 7: Apply performance optimizations
-    code = optimize_performance(code)
-    
-    # Step 8: Add precision qualifiers and uniforms
-    code = prepend_uniforms_and_precision(code)
-    
-    return code
+    ConversionPass('optimize_performance', lambda code, external: optimize_performance(code),
+                   'optimize', ('apply_shadertoy_conventions',)),
+)
+
+# Passes that build a header from the facts of the converted shader:
+# run(ShaderFacts) -> text.  Each header goes in front of the previous ones.
+HEADER_PASSES = (
+    # Step 8: Add common utility functions
+    ConversionPass('handle_common_shadertoy_functions', _utility_functions_header,
+                   'utility_functions'),
+    # Step 9: Define the common constants
+    ConversionPass('add_shadertoy_constants', _constants_header),
+    # Step 10: Gather the uniforms into one block, when asked to
+    ConversionPass('pack_uniform_block', _uniform_block_header, 'uniform_block'),
+    # Step 11: Add precision qualifiers and uniforms
+    ConversionPass('prepend_uniforms_and_precision', _uniforms_header),
+    # Step 12: Add compatibility extensions; they must precede everything else
+    ConversionPass('add_compatibility_extensions', _extensions_header,
+                   requires=('handle_common_shadertoy_functions',)),
+    # Step 13: Uniform blocks need a newer GLSL, and #version must come first
+    ConversionPass('add_version_directive', _version_header, 'uniform_block',
+                   ('pack_uniform_block',), skip_unchanged=True),
+)
+
+# Passes over the whole converted shader, headers included: run(code) -> code
+SHADER_PASSES = (
+    # Step 14: Give every declaration the precision it needs
+    ConversionPass('qualify_precision', qualify_precision, 'precision_qualifiers'),
+    # Step 15: Target GLES 3 and WebGL2 instead of desktop GL with the version
+    ConversionPass('target_glsl_es', target_glsl_es, 'glsl_es'),
+)
+
+
+def resolve_options(options=None):
+    """DEFAULT_OPTIONS updated with options, rejecting unknown names"""
+    resolved = dict(DEFAULT_OPTIONS)
+    for name, value in (options or {}).items():
+        if name not in resolved:
+            raise ValueError(f'unknown conversion option: {name!r}')
+        resolved[name] = bool(value)
+    return resolved
+
+
+def _enabled_passes(passes, options, earlier=()):
+    known = set(earlier)
+    for conversion_pass in passes:
+        for name in conversion_pass.requires:
+            if name not in known:
+                raise ValueError(f'pass {conversion_pass.name!r} requires {name!r}, '
+                                 f'which does not run before it')
+        known.add(conversion_pass.name)
+    return tuple(conversion_pass for conversion_pass in passes
+                 if conversion_pass.option is None or options[conversion_pass.option])
+
+
+def _skipped(conversion_pass, changed):
+    return conversion_pass.skip_unchanged and changed.isdisjoint(conversion_pass.requires)
+
+
+class PassManager:
+    """The enabled passes for one set of options
+
+    Disabled passes are dropped when the manager is built, so they cost
+    nothing per conversion.  Every pass reports whether it changed the
+    code, and passes that only react to changes are skipped otherwise.
+    """
+
+    def __init__(self, options=None, unit_passes=UNIT_PASSES, header_passes=HEADER_PASSES,
+                 shader_passes=SHADER_PASSES):
+        self.options = resolve_options(options)
+        self.unit_passes = _enabled_passes(unit_passes, self.options)
+        self.header_passes = _enabled_passes(
+            header_passes, self.options, (p.name for p in unit_passes))
+        self.shader_passes = _enabled_passes(
+            shader_passes, self.options, (p.name for p in unit_passes + header_passes))
+        # Identifies what the passes do, for caching their results
+        self.key = tuple(p.name for p in
+                         self.unit_passes + self.header_passes + self.shader_passes)
+        self.needs_constants = any(self.options[name] for name in _CONSTANT_OPTIONS)
+
+    def convert_unit(self, unit_code, external, profile=None):
+        """Run the unit passes; returns (code, ShaderFacts, names of passes that changed it)"""
+        code = unit_code
+        changed = set()
+        for conversion_pass in self.unit_passes:
+            if _skipped(conversion_pass, changed):
+                if profile is not None:
+                    profile.record_skip(conversion_pass.name)
+                continue
+            result = _run_stage(profile, conversion_pass.name, conversion_pass.run,
+                                code, external)
+            if result != code:
+                changed.add(conversion_pass.name)
+            code = result
+        return code, _text_facts(code), frozenset(changed)
+
+    def live_units(self, pieces, profile=None):
+        """Indexes of the converted units to keep: those main() can reach
+
+        Every unit is kept when remove_unused is off or the reachable code
+        cannot be told apart from the rest.
+        """
+        if not self.options['remove_unused']:
+            return range(len(pieces))
+        started = time.perf_counter() if profile is not None else None
+        live = _live_units([lex_glsl(piece) for piece in pieces])
+        kept = range(len(pieces)) if live is None else [i for i, keep in enumerate(live) if keep]
+        if profile is not None:
+            profile.record('remove_unused_code', time.perf_counter() - started,
+                           sum(map(len, pieces)), sum(len(pieces[i]) for i in kept),
+                           len(pieces) - len(kept))
+        return kept
+
+    def header(self, facts, body='', changed=frozenset(), profile=None):
+        """Everything the header passes put in front of the converted units"""
+        changed = set(changed)
+        header = ''
+        for conversion_pass in self.header_passes:
+            if _skipped(conversion_pass, changed):
+                if profile is not None:
+                    profile.record_skip(conversion_pass.name)
+                continue
+            if profile is None:
+                text = conversion_pass.run(facts)
+            else:
+                started = time.perf_counter()
+                text = conversion_pass.run(facts)
+                # A header is one insertion in front of everything so far
+                size = len(header) + len(body)
+                profile.record(conversion_pass.name, time.perf_counter() - started,
+                               size, size + len(text), 1 if text else 0)
+            if text:
+                changed.add(conversion_pass.name)
+                # Later headers must see what this one declares or calls
+                facts = ShaderFacts.union((facts, _text_facts(text)))
+                header = text + header
+        return header
+
+    def finish(self, code, changed=frozenset(), profile=None):
+        """Run the shader passes over the assembled shader"""
+        for conversion_pass in self.shader_passes:
+            if _skipped(conversion_pass, changed):
+                if profile is not None:
+                    profile.record_skip(conversion_pass.name)
+                continue
+            code = _run_stage(profile, conversion_pass.name, conversion_pass.run, code)
+        return code
+
+
+class IncrementalConverter:
+    """Converts shaders one top-level unit at a time, reusing unchanged units
+
+    The per-unit passes only look at the unit they rewrite plus the few
+    facts about it that the rest of the shader determines, so a unit's
+    result is cached by its text, those facts and the enabled passes.
+    After an edit only the units that changed, or whose context changed,
+    are converted again; the headers are rebuilt from the cached facts of
+    every unit main() can reach.
+    """
+
+    def __init__(self, cache_size=4096):
+        self.cache_size = cache_size
+        self._facts = OrderedDict()      # unit text -> UnitFacts
+        self._converted = OrderedDict()  # (unit text, ExternalUses, passes) -> convert_unit()
+        self._managers = {}
+        self.units_converted = 0
+        self.units_reused = 0
+
+    def _cached(self, cache, key, build):
+        try:
+            value = cache[key]
+        except KeyError:
+            value = build()
+            if self.cache_size:
+                cache[key] = value
+                while len(cache) > self.cache_size:
+                    cache.popitem(last=False)
+            return value, False
+        cache.move_to_end(key)
+        return value, True
+
+    def pass_manager(self, options=None):
+        key = tuple(sorted(resolve_options(options).items()))
+        manager = self._managers.get(key)
+        if manager is None:
+            manager = self._managers[key] = PassManager(dict(key))
+        return manager
+
+    def convert(self, shader_code, profile=None, **options):
+        if not shader_code.strip():
+            return shader_code
+        started = time.perf_counter() if profile is not None else None
+        manager = self.pass_manager(options)
+
+        units = [shader_code[start:end] for start, end in split_top_level_units(shader_code)]
+        unit_facts = [self._cached(self._facts, unit, lambda: _unit_facts(unit))[0]
+                      for unit in units]
+        reads = frozenset().union(*(facts.external_reads for facts in unit_facts))
+        macros = frozenset().union(*(facts.macro_names for facts in unit_facts))
+        constants = {}
+        if manager.needs_constants:
+            for unit, facts in zip(units, unit_facts):
+                if facts.defines_constants:
+                    constants = shader_constants(lex_glsl(unit), constants)
+
+        pieces = []
+        shader = []
+        changed = set()
+        reused_units = 0
+        for unit, facts in zip(units, unit_facts):
+            external = ExternalUses(
+                facts.global_floats & reads, facts.float_names & macros,
+                frozenset((name, constants[name]) for name in facts.identifiers & constants.keys()))
+            (code, code_facts, unit_changed), reused = self._cached(
+                self._converted, (unit, external, manager.key),
+                lambda: manager.convert_unit(unit, external, profile))
+            reused_units += reused
+            pieces.append(code)
+            shader.append(code_facts)
+            changed.update(unit_changed)
+
+        kept = manager.live_units(pieces, profile)
+        if len(kept) < len(pieces):
+            changed.add('remove_unused_code')
+            pieces = [pieces[i] for i in kept]
+            shader = [shader[i] for i in kept]
+
+        body = ''.join(pieces)
+        result = manager.header(ShaderFacts.union(shader), body, changed, profile) + body
+        result = manager.finish(result, changed, profile)
+        self.units_reused += reused_units
+        self.units_converted += len(units) - reused_units
+        if profile is not None:
+            profile.units_reused += reused_units
+            profile.units_converted += len(units) - reused_units
+            profile.seconds += time.perf_counter() - started
+        return result
+
+
+# Modules whose code decides the conversion output
+_CONVERTER_MODULES = ('glsl_lexer', 'glsl_analysis', 'glsl_ast', 'glsl_cost', 'glsl_loops',
+                      'glsl_precision', 'glsl_uniform_block', __name__)
+_source_digest = None
+
+
+def converter_fingerprint():
+    """Hash identifying the conversion rules currently in effect
+
+    Covers the source of the converter modules and the registered aliases,
+    so results cached under one fingerprint are never reused after a rule
+    changes.
+    """
+    global _source_digest
+    if _source_digest is None:
+        digest = hashlib.sha256()
+        for name in _CONVERTER_MODULES:
+            with open(sys.modules[name].__file__, 'rb') as f:
+                digest.update(f.read())
+        _source_digest = digest.hexdigest()
+    call_table, identifier_table = identifier_rewriter.compile()
+    rules = repr((sorted(call_table.items()), sorted(identifier_table.items())))
+    return hashlib.sha256((_source_digest + rules).encode()).hexdigest()
+
+
+def convert_shadertoy_to_opengl(shader_code, profile=None, **options):
+    """Main conversion function with improved processing
+
+    Steps 1-7 (UNIT_PASSES) run on each top-level unit (function,
+    declaration or directive line) on its own; units main() cannot reach
+    are then dropped, steps 8-13 (HEADER_PASSES) build the headers the
+    remaining code needs, with extensions first as GLSL requires, and
+    steps 14-15 (SHADER_PASSES) work on the assembled shader.  Keyword
+    options from DEFAULT_OPTIONS switch passes on and off.  Pass a
+    ConversionProfile to record what each stage cost.
+    """
+    if not shader_code.strip():
+        return shader_code
+    return IncrementalConverter(cache_size=0).convert(shader_code, profile, **options)
 
 
-class ShaderToyToOpenGLApp(tk.Tk):
+def open_conversion_cache(directory=None, **limits):
+    """ConversionCache for the rules in effect now
+
+    Pass conversion_cache.default_cache_dir() as directory to keep results
+    between runs; without one the cache only lives in memory.
+    """
+    return ConversionCache(converter_fingerprint(), directory, **limits)
+
+
+class ShaderToyToOpenGLApp(tk.Tk if tk is not None else object):
+    # Wait this long after the last keystroke before converting
+    DEBOUNCE_MS = 300
+    # How often finished conversions are picked up while one is running
+    POLL_MS = 30
+    # Lines above and below the visible ones highlighted along with them
+    HIGHLIGHT_MARGIN = 20
+    HIGHLIGHT_FOREGROUNDS = {
+        'keyword': '#0000c0',
+        'type': '#267f99',
+        'builtin': '#795e26',
+        'uniform': '#a000a0',
+        'number': '#098658',
+        'comment': '#008000',
+        'preprocessor': '#9b4f00',
+    }
+    # Output lines the converter wrote itself
+    MARK_BACKGROUNDS = {REWRITTEN: '#fff4c8', ADDED: '#e6f4e6'}
+    
     def __init__(self):
         super().__init__()
         self.title("Shadertoy to OpenGL/JUCE Converter (Enhanced)")
         self.geometry("1200x900")
+        
+        # Conversions run on a worker thread; every request gets a new
+        # generation number and only the newest one's result is shown
+        self._generation = 0
+        self._debounce_id = None
+        self._poll_id = None
+        self._jobs = queue.Queue()
+        self._results = queue.Queue()
+        # Owned by the worker thread; keeps the units of earlier conversions
+        self._converter = IncrementalConverter()
+        # Highlighting is done for the visible lines of a text widget once
+        # it is idle; lines already done are remembered until it changes
+        self._highlighted = {}
+        self._highlight_ids = {}
+        threading.Thread(target=self._conversion_worker, daemon=True).start()
+        
         self.create_widgets()
     
     def create_widgets(self):
@@ -526,16 +1448,43 @@ class ShaderToyToOpenGLApp(tk.Tk):
         options_frame.pack(fill="x", padx=10, pady=5)
         
         # Add options for different conversion modes
-        self.auto_fix_loops = tk.BooleanVar(value=True)
-        self.add_utility_functions = tk.BooleanVar(value=True)
-        self.optimize_performance = tk.BooleanVar(value=True)
+        self.auto_fix_loops = tk.BooleanVar(value=DEFAULT_OPTIONS['fix_loops'])
+        self.add_utility_functions = tk.BooleanVar(value=DEFAULT_OPTIONS['utility_functions'])
+        self.optimize_performance = tk.BooleanVar(value=DEFAULT_OPTIONS['optimize'])
+        self.remove_unused = tk.BooleanVar(value=DEFAULT_OPTIONS['remove_unused'])
+        self.uniform_block = tk.BooleanVar(value=DEFAULT_OPTIONS['uniform_block'])
+        self.glsl_es = tk.BooleanVar(value=DEFAULT_OPTIONS['glsl_es'])
+        self.unroll_loops = tk.BooleanVar(value=DEFAULT_OPTIONS['unroll_loops'])
+        self.bound_loops = tk.BooleanVar(value=DEFAULT_OPTIONS['bound_loops'])
+        self.precision_qualifiers = tk.BooleanVar(value=DEFAULT_OPTIONS['precision_qualifiers'])
         
-        ttk.Checkbutton(options_frame, text="Auto-fix loop semantics", 
-                       variable=self.auto_fix_loops).pack(side="left", padx=5)
-        ttk.Checkbutton(options_frame, text="Add utility functions", 
-                       variable=self.add_utility_functions).pack(side="left", padx=5)
-        ttk.Checkbutton(options_frame, text="Apply optimizations", 
-                       variable=self.optimize_performance).pack(side="left", padx=5)
+        ttk.Checkbutton(options_frame, text=OPTION_LABELS['fix_loops'],
+                       variable=self.auto_fix_loops,
+                       command=self.update_output).pack(side="left", padx=5)
+        ttk.Checkbutton(options_frame, text=OPTION_LABELS['utility_functions'],
+                       variable=self.add_utility_functions,
+                       command=self.update_output).pack(side="left", padx=5)
+        ttk.Checkbutton(options_frame, text=OPTION_LABELS['optimize'],
+                       variable=self.optimize_performance,
+                       command=self.update_output).pack(side="left", padx=5)
+        ttk.Checkbutton(options_frame, text=OPTION_LABELS['remove_unused'],
+                       variable=self.remove_unused,
+                       command=self.update_output).pack(side="left", padx=5)
+        ttk.Checkbutton(options_frame, text=OPTION_LABELS['uniform_block'],
+                       variable=self.uniform_block,
+                       command=self.update_output).pack(side="left", padx=5)
+        ttk.Checkbutton(options_frame, text=OPTION_LABELS['glsl_es'],
+                       variable=self.glsl_es,
+                       command=self.update_output).pack(side="left", padx=5)
+        ttk.Checkbutton(options_frame, text=OPTION_LABELS['unroll_loops'],
+                       variable=self.unroll_loops,
+                       command=self.update_output).pack(side="left", padx=5)
+        ttk.Checkbutton(options_frame, text=OPTION_LABELS['bound_loops'],
+                       variable=self.bound_loops,
+                       command=self.update_output).pack(side="left", padx=5)
+        ttk.Checkbutton(options_frame, text=OPTION_LABELS['precision_qualifiers'],
+                       variable=self.precision_qualifiers,
+                       command=self.update_output).pack(side="left", padx=5)
         
         # Input section
         input_frame = ttk.Frame(self)
@@ -551,12 +1500,14 @@ class ShaderToyToOpenGLApp(tk.Tk):
                                   font=("Consolas", 10))
         input_scrollbar = ttk.Scrollbar(input_frame, orient="vertical",
                                         command=self.input_text.yview)
-        self.input_text.configure(yscrollcommand=input_scrollbar.set)
+        self.input_text.configure(yscrollcommand=lambda first, last: self._scrolled(
+            self.input_text, input_scrollbar, first, last))
+        self._configure_highlighting(self.input_text)
         
         self.input_text.pack(side="left", fill="both", expand=True)
         input_scrollbar.pack(side="right", fill="y")
         
-        self.input_text.bind("<KeyRelease>", self.update_output)
+        self.input_text.bind("<KeyRelease>", self.schedule_update)
         
         # Convert button
         convert_frame = ttk.Frame(self)
@@ -573,12 +1524,16 @@ class ShaderToyToOpenGLApp(tk.Tk):
         ttk.Label(output_label_frame, text="Output (OpenGL/JUCE):").pack(side="left")
         ttk.Button(output_label_frame, text="Copy to Clipboard",
                    command=self.copy_output).pack(side="right")
+        ttk.Button(output_label_frame, text="Copy C++ Struct",
+                   command=self.copy_uniform_struct).pack(side="right", padx=5)
         
         self.output_text = tk.Text(output_frame, height=18, wrap="none",
                                    font=("Consolas", 10))
         output_scrollbar = ttk.Scrollbar(output_frame, orient="vertical",
                                          command=self.output_text.yview)
-        self.output_text.configure(yscrollcommand=output_scrollbar.set)
+        self.output_text.configure(yscrollcommand=lambda first, last: self._scrolled(
+            self.output_text, output_scrollbar, first, last))
+        self._configure_highlighting(self.output_text)
         
         self.output_text.pack(side="left", fill="both", expand=True)
         output_scrollbar.pack(side="right", fill="y")
@@ -590,22 +1545,188 @@ class ShaderToyToOpenGLApp(tk.Tk):
         self.status_var.set("Ready - Enhanced converter with improved loop handling and optimizations")
         ttk.Label(self, textvariable=self.status_var, relief="sunken").pack(
             side="bottom", fill="x")
+        
+        # Static cost estimate of the output, with the loops worth a look
+        self.cost_var = tk.StringVar()
+        ttk.Label(self, textvariable=self.cost_var, justify="left").pack(
+            side="bottom", fill="x", padx=10)
+    
+    def _configure_highlighting(self, widget):
+        for tag, colour in self.HIGHLIGHT_FOREGROUNDS.items():
+            widget.tag_configure(tag, foreground=colour)
+        for tag, colour in self.MARK_BACKGROUNDS.items():
+            widget.tag_configure(tag, background=colour)
+            widget.tag_lower(tag)
+        self._highlighted[widget] = set()
+    
+    def _scrolled(self, widget, scrollbar, first, last):
+        """yscrollcommand of the text widgets: they call it whenever what
+        they show moves, so newly visible lines get highlighted"""
+        scrollbar.set(first, last)
+        self.schedule_highlight(widget)
+    
+    def _text_changed(self, widget):
+        # Tags move along with the text, but an edit can open or close a
+        # comment and so change how any later line reads
+        self._highlighted[widget].clear()
+        self.schedule_highlight(widget)
+    
+    def schedule_highlight(self, widget):
+        """Highlight the visible lines of widget once the window is idle"""
+        if widget not in self._highlight_ids:
+            self._highlight_ids[widget] = self.after_idle(self._highlight_visible, widget)
+    
+    def _highlight_visible(self, widget):
+        """Highlight the lines of widget on screen, and HIGHLIGHT_MARGIN
+        lines around them, that are not highlighted yet"""
+        del self._highlight_ids[widget]
+        done = self._highlighted[widget]
+        top = int(widget.index("@0,0").split(".")[0])
+        bottom = int(widget.index(f"@0,{widget.winfo_height()}").split(".")[0])
+        last_line = int(widget.index("end-1c").split(".")[0])
+        lines = [line for line in range(max(1, top - self.HIGHLIGHT_MARGIN),
+                                        min(last_line, bottom + self.HIGHLIGHT_MARGIN) + 1)
+                 if line not in done]
+        if not lines:
+            return
+        start = f"{lines[0]}.0"
+        end = f"{lines[-1]}.end"
+        # Start from the comment the first line is inside, if any
+        opening = widget.search("/*", start, stopindex="1.0", backwards=True)
+        if (opening and "//" not in widget.get(f"{opening} linestart", opening)
+                and not widget.search("*/", f"{opening}+2c", stopindex=start)):
+            start = opening
+        for tag in self.HIGHLIGHT_FOREGROUNDS:
+            widget.tag_remove(tag, start, end)
+        ranges = {}
+        for tag, first, stop in highlight_tokens(widget.get(start, end), _UNIFORM_TYPES):
+            ranges.setdefault(tag, []).extend((f"{start}+{first}c", f"{start}+{stop}c"))
+        for tag, indices in ranges.items():
+            widget.tag_add(tag, *indices)
+        done.update(lines)
+    
+    def _show_output(self, output_code, marks):
+        """Put output_code in the output pane, replacing only the lines
+        that changed so the view stays where it was"""
+        widget = self.output_text
+        old_code = widget.get("1.0", "end-1c")
+        old_lines = int(widget.index("end-1c").split(".")[0])
+        view = widget.yview()[0], widget.xview()[0]
+        widget.config(state="normal")
+        for first, stop, text in line_edits(old_code, output_code):
+            # The last line of old_code may have no newline to delete
+            end = f"{stop + 1}.0" if stop < old_lines else "end-1c"
+            widget.delete(f"{first + 1}.0", end)
+            widget.insert(f"{first + 1}.0", text)
+        for tag in self.MARK_BACKGROUNDS:
+            widget.tag_remove(tag, "1.0", "end")
+        for tag, first, stop in marks:
+            widget.tag_add(tag, f"{first}.0", f"{stop}.0")
+        widget.config(state="disabled")
+        widget.yview_moveto(view[0])
+        widget.xview_moveto(view[1])
+        self._text_changed(widget)
+    
+    def schedule_update(self, event=None):
+        """Convert once typing has paused for DEBOUNCE_MS"""
+        self._text_changed(self.input_text)
+        if self._debounce_id is not None:
+            self.after_cancel(self._debounce_id)
+        self._debounce_id = self.after(self.DEBOUNCE_MS, self.update_output)
+        self.status_var.set("Pending - output is out of date")
     
     def update_output(self, event=None):
-        try:
-            input_code = self.input_text.get("1.0", "end-1c")
-            
-            # Apply conversion with current settings
-            output_code = convert_shadertoy_to_opengl(input_code)
-            
-            self.output_text.config(state="normal")
-            self.output_text.delete("1.0", "end")
-            self.output_text.insert("1.0", output_code)
-            self.output_text.config(state="disabled")
-            
-            self.status_var.set("Conversion complete - Enhanced processing applied")
-        except Exception as e:
-            self.status_var.set(f"Error: {str(e)}")
+        """Start converting the current input on the worker thread"""
+        if self._debounce_id is not None:
+            self.after_cancel(self._debounce_id)
+            self._debounce_id = None
+        
+        input_code = self.input_text.get("1.0", "end-1c")
+        self._generation += 1
+        self._jobs.put((self._generation, input_code, self.conversion_options()))
+        self.status_var.set("Converting...")
+        if self._poll_id is None:
+            self._poll_id = self.after(self.POLL_MS, self._poll_results)
+    
+    def conversion_options(self):
+        """Options for convert_shadertoy_to_opengl() from the checkboxes"""
+        return {
+            'fix_loops': self.auto_fix_loops.get(),
+            'utility_functions': self.add_utility_functions.get(),
+            'optimize': self.optimize_performance.get(),
+            'remove_unused': self.remove_unused.get(),
+            'uniform_block': self.uniform_block.get(),
+            'glsl_es': self.glsl_es.get(),
+            'unroll_loops': self.unroll_loops.get(),
+            'bound_loops': self.bound_loops.get(),
+            'precision_qualifiers': self.precision_qualifiers.get(),
+        }
+    
+    def _conversion_worker(self):
+        while True:
+            job = self._jobs.get()
+            # Skip requests that were superseded while waiting
+            while True:
+                try:
+                    job = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+            generation, input_code, options = job
+            profile = ConversionProfile()
+            try:
+                # Apply conversion with current settings
+                output_code = self._converter.convert(input_code, profile, **options)
+                marks = rewritten_lines(input_code, output_code)
+            except Exception as e:
+                self._results.put((generation, None, None, None, None, None, e))
+                continue
+            # The report is extra: a failure in it must not hide the output
+            try:
+                cost = estimate_cost(output_code)
+                notes = self.output_notes(output_code, options)
+            except Exception as e:
+                cost = None
+                notes = [f"No cost estimate: {e}"]
+            self._results.put((generation, output_code, profile, cost, notes, marks, None))
+    
+    @staticmethod
+    def output_notes(output_code, options):
+        """Lines about the output worth a look, besides its cost"""
+        notes = []
+        capped = [loop for loop in unbounded_loops(output_code) if loop.capped]
+        if capped:
+            lines = ', '.join(f"line {loop.line}" for loop in capped)
+            notes.append(f"Loop bounds not proven, capped at {capped[0].trip_count} "
+                         f"iterations: {lines}")
+        if options['precision_qualifiers']:
+            diagnostics = infer_precision(output_code).diagnostics
+            notes.extend(f"Precision: {diagnostic.describe()}" for diagnostic in diagnostics[:3])
+        return notes
+    
+    def _poll_results(self):
+        self._poll_id = None
+        while True:
+            try:
+                (generation, output_code, profile, cost, notes, marks,
+                 error) = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self._generation:
+                continue  # stale: newer input arrived while converting
+            if error is not None:
+                self.status_var.set(f"Error: {str(error)}")
+            else:
+                self._show_output(output_code, marks)
+                
+                self.status_var.set(f"Output is current - {profile.summary()}")
+                if cost is None:
+                    self.cost_var.set('\n'.join(notes))
+                else:
+                    flagged = [loop.describe() for loop in cost.flagged()[:3]]
+                    self.cost_var.set('\n'.join([f"Estimated cost: {cost.summary()}"]
+                                                 + flagged + notes))
+            return
+        self._poll_id = self.after(self.POLL_MS, self._poll_results)
     
     def copy_output(self):
         try:
@@ -619,24 +1740,62 @@ class ShaderToyToOpenGLApp(tk.Tk):
         except Exception as e:
             self.status_var.set(f"Copy error: {str(e)}")
     
+    def copy_uniform_struct(self):
+        """Copy the C++ struct matching the output's uniform block"""
+        output_code = self.output_text.get("1.0", "end-1c")
+        try:
+            struct_code = cpp_uniform_struct(output_code)
+        except ValueError as e:
+            self.status_var.set(f"No C++ struct: {e} (enable the uniform block option)")
+            return
+        self.clipboard_clear()
+        self.clipboard_append(struct_code)
+        self.status_var.set("Copied the C++ uniform struct to clipboard")
+    
     def paste_input(self):
         try:
             clipboard_text = self.clipboard_get()
             self.input_text.delete("1.0", "end")
             self.input_text.insert("1.0", clipboard_text)
+            self._text_changed(self.input_text)
             self.update_output()
             self.status_var.set("Pasted from clipboard")
         except tk.TclError:
             self.status_var.set("Clipboard empty or not text")
     
     def clear_all(self):
+        if self._debounce_id is not None:
+            self.after_cancel(self._debounce_id)
+            self._debounce_id = None
+        self._generation += 1  # discard any conversion still running
+        if self._poll_id is not None:
+            # Nothing for the new generation is coming to poll for
+            self.after_cancel(self._poll_id)
+            self._poll_id = None
         self.input_text.delete("1.0", "end")
         self.output_text.config(state="normal")
         self.output_text.delete("1.0", "end")
         self.output_text.config(state="disabled")
+        self._text_changed(self.input_text)
+        self._text_changed(self.output_text)
+        self.cost_var.set("")
         self.status_var.set("Cleared")
 
 
-if __name__ == "__main__":
+def main(argv=None):
+    """Open the window, or convert from the command line when given arguments"""
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        from batch_convert import main as batch_main
+        return batch_main(argv)
+    if tk is None:
+        print('tkinter is not available; pass shader files or directories to convert '
+              'them from the command line (see --help)', file=sys.stderr)
+        return 2
     app = ShaderToyToOpenGLApp()
     app.mainloop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())